@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking of fiducial markers to measure the xy drift of a recording,
+frame by frame while it runs or afterwards.
+"""
+
+import numpy as np
+from scipy.ndimage import uniform_filter, maximum_filter
+
+import tormenta.analysis.tools as tools
+import tormenta.analysis.maxima as maxima
+
+
+def fiducials_from_frames(frames, alpha=5, n=5, fwhm=None):
+    """ Returns the positions of the n brightest emitters found in the mean
+    of frames. frames can be a single image or a (n, x, y) stack."""
+
+    image = np.asarray(frames, dtype=float)
+    if image.ndim > 2:
+        image = image.mean(0)
+
+    if fwhm is None:
+        fwhm = tools.get_fwhm(670, 1.42) / 120
+    mm = maxima.Maxima(image, fw=fwhm, win_size=int(np.ceil(fwhm)),
+                       kernel=tools.kernel(fwhm), xkernel=tools.xkernel(fwhm))
+    mm.find(alpha)
+    if len(mm.positions) == 0:
+        return np.zeros((0, 2), dtype=int)
+
+    mm.getParameters()
+    order = np.argsort(mm.results['brightness'])[::-1]
+    return mm.positions[order[:n]]
+
+
+def fiducials_from_table(molecules, nframes, min_fraction=0.8, n=5,
+                         radius=1):
+    """ Returns the positions of the emitters present in at least min_fraction
+    of the nframes frames of the localization table molecules. Those are the
+    fiducial beads (or any other persistent emitter) of the measurement."""
+
+    x = np.round(molecules['fit_x']).astype(int)
+    y = np.round(molecules['fit_y']).astype(int)
+    shape = (x.max() + 1, y.max() + 1)
+
+    # Number of localizations per pixel, summed in a (2*radius + 1)**2 area
+    counts = np.bincount(np.ravel_multi_index((x, y), shape),
+                         minlength=shape[0]*shape[1]).reshape(shape)
+    size = 2*radius + 1
+    counts = uniform_filter(counts.astype(float), size) * size**2
+
+    peaks = (counts == maximum_filter(counts, 2*size + 1))
+    peaks &= counts >= min_fraction * nframes
+    candidates = np.array(np.nonzero(peaks)).T
+    order = np.argsort(counts[peaks])[::-1]
+
+    # Flat peaks give several maxima for the same emitter, keep the first one
+    kept = []
+    for c in candidates[order]:
+        if all(not(tools.overlaps(c, k, size)) for k in kept):
+            kept.append(c)
+    candidates = np.array(kept[:n]).reshape(-1, 2)
+
+    # Refine each candidate with the mean position of its localizations
+    positions = np.zeros((len(candidates), 2))
+    for k, (cx, cy) in enumerate(candidates):
+        near = (np.abs(x - cx) <= radius) & (np.abs(y - cy) <= radius)
+        positions[k] = (molecules['fit_x'][near].mean(),
+                        molecules['fit_y'][near].mean())
+
+    return positions
+
+
+def drift_from_table(molecules, fiducials, nframes, radius=1):
+    """ Drift trace computed from the localizations of the fiducials in the
+    table, without any extra fitting. Returns a (nframes, 2) array with the
+    mean displacement of the fiducials relative to the first frame in which
+    each of them was found. Frames without any fiducial are set to nan."""
+
+    tracks = np.full((len(fiducials), nframes, 2), np.nan)
+    for k, (fx, fy) in enumerate(fiducials):
+        dx = molecules['fit_x'] - fx
+        dy = molecules['fit_y'] - fy
+        near = np.nonzero((np.abs(dx) <= radius) & (np.abs(dy) <= radius))[0]
+
+        # Closest localization to the fiducial in each frame
+        order = np.lexsort((dx[near]**2 + dy[near]**2,
+                            molecules['frame'][near]))
+        near = near[order]
+        frames, first = np.unique(molecules['frame'][near], return_index=True)
+        near = near[first]
+        keep = frames < nframes
+        tracks[k, frames[keep], 0] = molecules['fit_x'][near[keep]]
+        tracks[k, frames[keep], 1] = molecules['fit_y'][near[keep]]
+
+    return relative_drift(tracks)
+
+
+def relative_drift(tracks):
+    """ Combines the (nfiducials, nframes, 2) tracks into a single drift
+    trace. Each track is referred to its first valid position."""
+
+    if len(tracks) == 0:
+        return np.zeros(tracks.shape[1:])
+
+    disp = np.full(tracks.shape, np.nan)
+    for k, track in enumerate(tracks):
+        valid = np.nonzero(~np.isnan(track[:, 0]))[0]
+        if len(valid) > 0:
+            disp[k] = track - track[valid[0]]
+
+    valid = ~np.isnan(disp[:, :, 0])
+    nvalid = valid.sum(0)
+    drift = np.where(valid[:, :, np.newaxis], disp, 0).sum(0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drift /= nvalid[:, np.newaxis]
+    drift[nvalid == 0] = np.nan
+
+    return drift
+
+
+class FiducialTracker(object):
+    """ Tracks a handful of fiducials through a sequence of frames by fitting
+    them inside small windows around their last known position. It's cheap
+    enough to be run frame by frame during a recording (see update) as well
+    as on whole stacks afterwards (see track)."""
+
+    def __init__(self, positions, fwhm=None, search=3):
+
+        if fwhm is None:
+            fwhm = tools.get_fwhm(670, 1.42) / 120
+        self.fwhm = fwhm
+        self.win_size = int(np.ceil(self.fwhm))
+        self.search = search
+
+        self.positions = np.array(positions, dtype=float).reshape(-1, 2)
+        self.reset()
+
+    def reset(self):
+        self.current = self.positions.copy()
+        self.reference = np.full(self.positions.shape, np.nan)
+        self.tracks = []
+
+    @property
+    def n(self):
+        return len(self.positions)
+
+    def fit(self, frame, center):
+        """ Fits the emitter closest to center. Returns its position in frame
+        coordinates or nan if it couldn't be found."""
+
+        ws = self.win_size
+        r = self.search + ws
+        cx, cy = int(center[0]), int(center[1])
+        x1, y1 = max(cx - r, 0), max(cy - r, 0)
+        roi = frame[x1:cx + r + 1, y1:cy + r + 1]
+
+        # Brightest pixel of the search window, away from the frame borders
+        px, py = np.unravel_index(np.argmax(roi), roi.shape)
+        px, py = px + x1, py + y1
+        if (px < ws or py < ws or px + ws >= frame.shape[0] or
+                py + ws >= frame.shape[1]):
+            return np.nan, np.nan
+
+        area = frame[px - ws:px + ws + 1, py - ws:py + ws + 1].astype(float)
+        bkg = np.full(area.shape, area.min())
+        try:
+            fit = maxima.fit_area(area, self.fwhm, bkg)
+        except (Warning, ValueError):
+            return np.nan, np.nan
+
+        # Same coordinates convention as Maxima.fit
+        return px - ws + fit[1], py - ws + fit[2]
+
+    def update(self, frame):
+        """ Fits all the fiducials in frame and returns the drift relative to
+        the first frame."""
+
+        pos = np.array([self.fit(frame, c) for c in self.current])
+        found = ~np.isnan(pos[:, 0])
+        self.current[found] = pos[found]
+        self.tracks.append(pos)
+
+        first = found & np.isnan(self.reference[:, 0])
+        self.reference[first] = pos[first]
+        disp = pos - self.reference
+        valid = ~np.isnan(disp[:, 0])
+        if np.any(valid):
+            return disp[valid].mean(0)
+        else:
+            return np.array([np.nan, np.nan])
+
+    def track(self, frames):
+        """ Drift trace of a whole stack of frames."""
+
+        self.reset()
+        for frame in frames:
+            self.update(frame)
+
+        return self.drift()
+
+    def drift(self):
+        """ (nframes, 2) drift trace of the frames seen so far."""
+        if len(self.tracks) == 0:
+            return np.zeros((0, 2))
+        return relative_drift(np.array(self.tracks).transpose(1, 0, 2))
@@ -143,6 +143,7 @@ class Maxima():
             self.drop_border()
         else:
             self.positions = np.zeros((0, 2), dtype=int)
+            self.overlaps = 0
 
     def drop_overlapping(self):
         """Drop overlapping spots."""
@@ -10,15 +10,18 @@ import time
 import numpy as np
 import matplotlib.pyplot as plt
 import math
+from abc import ABC, abstractmethod
 from scipy.ndimage import affine_transform
+from scipy.spatial import cKDTree
 import tifffile as tiff
 import h5py as hdf
 from pyqtgraph.Qt import QtCore
 from tkinter import Tk, filedialog
-import multiprocessing as mp
+from collections import deque
 
 from tormenta.analysis.maxima import Maxima
 import tormenta.utils as utils
+import tormenta.workers as workers
 
 
 # epsilon for testing whether a number is close to zero
@@ -192,7 +195,7 @@ def remove_bad_points(points):
 
 
 def matrix_from_points(v0, v1, shear=True, scale=True, usesvd=True):
-    """Return affine transform matrix to register two point sets.
+    r"""Return affine transform matrix to register two point sets.
 
     v0 and v1 are shape (\*, ndims) arrays of at least ndims non-homogeneous
     coordinates, where ndims is the dimensionality of the coordinate space.
@@ -387,6 +390,333 @@ def h_affine_transform(image, H):
     return affine_transform(image, H[:2, :2], (H[0, 2], H[1, 2]))
 
 
+class Remapper(object):
+    """ Resamples images of shape inShape at fixed source coordinates using
+    bilinear interpolation. coords is a (2, x, y) array with the input
+    coordinates of every output pixel, as in scipy.ndimage.map_coordinates.
+    Output pixels that map outside the input image are set to 0.
+
+    Integer indices and weights are computed only once, so transforming a
+    frame (or a whole (n, x, y) block of frames) takes just four gathers and
+    a weighted sum."""
+
+    def __init__(self, coords, inShape):
+
+        self.inShape = tuple(inShape)
+        self.shape = coords.shape[1:]
+
+        x, y = coords[0].ravel(), coords[1].ravel()
+        valid = ((x >= 0) & (x <= self.inShape[0] - 1) &
+                 (y >= 0) & (y <= self.inShape[1] - 1))
+        self.mask = valid.reshape(self.shape)
+        self.valid = np.nonzero(valid)[0]
+        x, y = x[self.valid], y[self.valid]
+
+        x0 = np.floor(x).clip(0, max(self.inShape[0] - 2, 0)).astype(np.intp)
+        y0 = np.floor(y).clip(0, max(self.inShape[1] - 2, 0)).astype(np.intp)
+        fx = (x - x0).astype(np.float32)
+        fy = (y - y0).astype(np.float32)
+
+        ncols = self.inShape[1]
+        i00 = x0*ncols + y0
+        self.indices = np.array([i00, i00 + 1, i00 + ncols, i00 + ncols + 1])
+        self.weights = np.array([(1 - fx)*(1 - fy), (1 - fx)*fy,
+                                 fx*(1 - fy), fx*fy], dtype=np.float32)
+
+    def transform(self, data, out=None):
+        """ Transforms a single frame or a (n, x, y) block of frames. The
+        result has the dtype of data unless out is given."""
+
+        data = np.asarray(data)
+        flat = data.reshape((-1, self.inShape[0]*self.inShape[1]))
+
+        acc = self.weights[0] * np.take(flat, self.indices[0], axis=1)
+        for k in range(1, 4):
+            acc += self.weights[k] * np.take(flat, self.indices[k], axis=1)
+
+        if out is None:
+            out = np.zeros(data.shape[:-2] + self.shape, dtype=data.dtype)
+        flatOut = out.reshape((-1, self.shape[0]*self.shape[1]))
+
+        if np.issubdtype(flatOut.dtype, np.integer):
+            info = np.iinfo(flatOut.dtype)
+            np.rint(acc, out=acc)
+            np.clip(acc, info.min, info.max, out=acc)
+
+        flatOut[:] = 0
+        flatOut[:, self.valid] = acc
+        return out
+
+
+class AffineTransformer(Remapper):
+    """ Precomputed version of h_affine_transform for images of a given
+    shape. Build it once per (H, shape) and use transform on every frame."""
+
+    def __init__(self, H, shape):
+
+        self.H = np.array(H, dtype=np.float64)
+        grid = np.indices(shape, dtype=np.float64)
+        coords = np.tensordot(self.H[:2, :2], grid, axes=1)
+        coords += self.H[:2, 2].reshape(2, 1, 1)
+        super().__init__(coords, shape)
+
+
+class Warp(ABC):
+    """ Base class of the non-rigid registrations between channels. Like the
+    affine matrix H, a warp maps channel 0 coordinates to channel 1 ones
+    (forward) and it also has the mapping back (inverse). Both work on
+    (n, 2) arrays of localization coordinates, with the pixel centers at
+    +0.5 as in the fit results.
+
+    Subclasses implement fit, forward, inverse and params."""
+
+    kind = None
+
+    @abstractmethod
+    def params(self):
+        """ Arrays needed to rebuild the warp, as a dict."""
+
+    @abstractmethod
+    def forward(self, points):
+        """ Channel 1 coordinates of the channel 0 points."""
+
+    @abstractmethod
+    def inverse(self, points):
+        """ Channel 0 coordinates of the channel 1 points."""
+
+    def asarray(self):
+        return np.concatenate([np.ravel(v) for k, v in
+                               sorted(self.params().items())])
+
+    def coords(self, shape, step=16384):
+        """ Channel 1 pixel coordinates of every channel 0 pixel of an image
+        of the given shape, as needed by Remapper. It's evaluated in blocks
+        of step pixels to limit the memory used by the kernels."""
+
+        grid = np.indices(shape, dtype=np.float64).reshape(2, -1).T + 0.5
+        coords = np.zeros(grid.shape)
+        for i in range(0, len(grid), step):
+            coords[i:i + step] = self.forward(grid[i:i + step]) - 0.5
+        return coords.T.reshape((2,) + tuple(shape))
+
+    def save(self, filename):
+        np.savez(filename, kind=self.kind, **self.params())
+
+    def store(self, group):
+        """ Saves the warp in an hdf5 group."""
+        group.attrs['kind'] = self.kind
+        for name, value in self.params().items():
+            group.create_dataset(name=name, data=value)
+
+
+class PolynomialWarp(Warp):
+    """ Polynomial mapping between channels. Forward and inverse are fitted
+    independently from the same pairs of points."""
+
+    kind = 'polynomial'
+
+    def __init__(self, order, coefs, invCoefs, norm, invNorm):
+        self.order = int(order)
+        self.coefs = np.asarray(coefs)
+        self.invCoefs = np.asarray(invCoefs)
+        self.norm = np.asarray(norm)
+        self.invNorm = np.asarray(invNorm)
+
+    @staticmethod
+    def terms(points, order, norm):
+        """ Design matrix with the monomials of the normalized coordinates up
+        to the given order."""
+
+        u, v = ((points - norm[0]) / norm[1]).T
+        return np.array([u**i * v**(n - i) for n in range(order + 1)
+                         for i in range(n + 1)]).T
+
+    @classmethod
+    def fit(cls, v0, v1, order=3):
+        v0 = np.asarray(v0, dtype=np.float64)
+        v1 = np.asarray(v1, dtype=np.float64)
+        if len(v0) < (order + 1)*(order + 2) // 2:
+            raise ValueError('Not enough points for a polynomial of order '
+                             '{}'.format(order))
+
+        norm = np.array([v0.mean(0), v0.std(0)])
+        invNorm = np.array([v1.mean(0), v1.std(0)])
+        coefs = np.linalg.lstsq(cls.terms(v0, order, norm), v1, rcond=None)[0]
+        invCoefs = np.linalg.lstsq(cls.terms(v1, order, invNorm), v0,
+                                   rcond=None)[0]
+        return cls(order, coefs, invCoefs, norm, invNorm)
+
+    def params(self):
+        return {'order': self.order, 'coefs': self.coefs,
+                'invCoefs': self.invCoefs, 'norm': self.norm,
+                'invNorm': self.invNorm}
+
+    def forward(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        return np.dot(self.terms(points, self.order, self.norm), self.coefs)
+
+    def inverse(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        return np.dot(self.terms(points, self.order, self.invNorm),
+                      self.invCoefs)
+
+
+class ThinPlateSpline(Warp):
+    """ Thin-plate spline mapping between channels. It goes exactly through
+    the control points unless smoothing is larger than 0."""
+
+    kind = 'tps'
+
+    def __init__(self, centers, weights, affine, invCenters, invWeights,
+                 invAffine):
+        self.centers = np.asarray(centers)
+        self.weights = np.asarray(weights)
+        self.affine = np.asarray(affine)
+        self.invCenters = np.asarray(invCenters)
+        self.invWeights = np.asarray(invWeights)
+        self.invAffine = np.asarray(invAffine)
+
+    @staticmethod
+    def kernel(points, centers):
+        d2 = np.sum((points[:, np.newaxis, :] - centers[np.newaxis])**2, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = 0.5 * d2 * np.log(d2)
+        k[d2 == 0] = 0
+        return k
+
+    @classmethod
+    def solve(cls, v0, v1, smoothing):
+        n = len(v0)
+        P = np.hstack((np.ones((n, 1)), v0))
+        A = np.zeros((n + 3, n + 3))
+        A[:n, :n] = cls.kernel(v0, v0) + smoothing*np.identity(n)
+        A[:n, n:] = P
+        A[n:, :n] = P.T
+        b = np.zeros((n + 3, 2))
+        b[:n] = v1
+        sol = np.linalg.solve(A, b)
+        return sol[:n], sol[n:]
+
+    @classmethod
+    def fit(cls, v0, v1, smoothing=0):
+        v0 = np.asarray(v0, dtype=np.float64)
+        v1 = np.asarray(v1, dtype=np.float64)
+        if len(v0) < 3:
+            raise ValueError('At least 3 pairs of points are needed')
+
+        weights, affine = cls.solve(v0, v1, smoothing)
+        invWeights, invAffine = cls.solve(v1, v0, smoothing)
+        return cls(v0, weights, affine, v1, invWeights, invAffine)
+
+    def params(self):
+        return {'centers': self.centers, 'weights': self.weights,
+                'affine': self.affine, 'invCenters': self.invCenters,
+                'invWeights': self.invWeights, 'invAffine': self.invAffine}
+
+    @classmethod
+    def evaluate(cls, points, centers, weights, affine):
+        points = np.asarray(points, dtype=np.float64)
+        out = affine[0] + np.dot(points, affine[1:])
+        out += np.dot(cls.kernel(points, centers), weights)
+        return out
+
+    def forward(self, points):
+        return self.evaluate(points, self.centers, self.weights, self.affine)
+
+    def inverse(self, points):
+        return self.evaluate(points, self.invCenters, self.invWeights,
+                             self.invAffine)
+
+
+warpKinds = {cls.kind: cls for cls in [PolynomialWarp, ThinPlateSpline]}
+
+
+def load_registration(filename):
+    """ Loads an affine matrix (.npy) or a warp (.npz) saved with Warp.save.
+    """
+
+    if os.path.splitext(filename)[1] == '.npz':
+        with np.load(filename) as data:
+            params = {k: data[k] for k in data.files if k != 'kind'}
+            return warpKinds[str(data['kind'])](**params)
+    else:
+        return np.load(filename)
+
+
+def store_registration(h5file, H):
+    """ Saves the registration next to the data of a measurement."""
+
+    if isinstance(H, Warp):
+        H.store(h5file.create_group('Warp'))
+    else:
+        h5file.create_dataset(name='Affine matrix', data=H)
+
+
+def make_transformer(H, shape):
+    """ Remapper that corrects channel 1 images of the given shape, for an
+    affine matrix or a warp. Once built, both cost the same per frame."""
+
+    if isinstance(H, Warp):
+        return Remapper(H.coords(shape), shape)
+    else:
+        return AffineTransformer(H, shape)
+
+
+def transform_points(points, H):
+    """ Maps the (n, 2) array of points through the affine matrix H, or
+    through the forward mapping if H is a Warp."""
+
+    if isinstance(H, Warp):
+        return H.forward(points)
+
+    points = np.asarray(points, dtype=np.float64)
+    return np.dot(points, H[:2, :2].T) + H[:2, 2]
+
+
+def register_localizations(molecules, H):
+    """ Maps the fit_x, fit_y coordinates of the channel 1 localizations in
+    molecules to channel 0 coordinates. It's equivalent to localizing the
+    channel 1 frames after correcting them with h_affine_transform, but
+    without resampling the images.
+
+    H maps channel 0 pixels to channel 1 pixels (see matrix_from_points), so
+    the localizations are transformed with its inverse. Fit coordinates have
+    the pixel centers at +0.5 (see maxima.fit_area). H can also be a Warp.
+    """
+
+    points = np.zeros((len(molecules), 2))
+    points[:, 0] = molecules['fit_x']
+    points[:, 1] = molecules['fit_y']
+    if isinstance(H, Warp):
+        points = H.inverse(points)
+    else:
+        points = transform_points(points - 0.5, np.linalg.inv(H)) + 0.5
+
+    registered = molecules.copy()
+    registered['fit_x'] = points[:, 0]
+    registered['fit_y'] = points[:, 1]
+    return registered
+
+
+def crop_localizations(molecules, xlim, ylim, shift=True):
+    """ Keeps the localizations inside the area given by xlim, ylim (see
+    get_affine_shapes). If shift is True, coordinates are referred to the
+    cropped area, as they would be if they were localized in the _corrected
+    stacks."""
+
+    keep = ((molecules['fit_x'] >= xlim[0]) & (molecules['fit_x'] < xlim[1]) &
+            (molecules['fit_y'] >= ylim[0]) & (molecules['fit_y'] < ylim[1]))
+    cropped = molecules[keep]
+
+    if shift:
+        cropped['fit_x'] -= xlim[0]
+        cropped['fit_y'] -= ylim[0]
+        cropped['maxima_x'] -= xlim[0]
+        cropped['maxima_y'] -= ylim[0]
+
+    return cropped
+
+
 def matrix_from_stack(filename, Hfilename):
 
     images = load_images(filename)
@@ -420,6 +750,200 @@ def transformation_check(H, filename):
     print('Maximum distance: ', np.max(dist))
 
 
+def localize_beads(image, alpha=2.5):
+    """ Returns the (n, 2) fitted positions of the beads in image."""
+
+    mm = Maxima(np.asarray(image, dtype=float))
+    mm.find(alpha=alpha)
+    if len(mm.positions) == 0:
+        return np.zeros((0, 2))
+    mm.getParameters()
+    mm.fit()
+    return np.array([mm.results['fit_x'], mm.results['fit_y']]).T
+
+
+def coarse_shift(images):
+    """ Translation from images[0] to images[1] given by the peak of their
+    cross-correlation. Used as the starting point for pairing the beads."""
+
+    shape = images[0].shape
+    a = images[0] - np.mean(images[0])
+    b = images[1] - np.mean(images[1])
+
+    # Zero padding to avoid the wrap-around of the circular correlation
+    s = (2*shape[0], 2*shape[1])
+    corr = np.fft.irfft2(np.fft.rfft2(b, s) * np.conj(np.fft.rfft2(a, s)), s)
+    peak = np.array(np.unravel_index(np.argmax(corr), s))
+    peak[peak >= np.array(shape)] -= np.array(s)[peak >= np.array(shape)]
+
+    return peak.astype(float)
+
+
+def translation_matrix(shift):
+    H = np.identity(3)
+    H[:2, 2] = shift
+    return H
+
+
+def pair_points(p0, p1, H, max_dist=3):
+    """ Pairs the points of both channels that are mutual nearest neighbours
+    after mapping p0 through H, and that are closer than max_dist. Returns
+    the indices of the pairs in p0 and p1."""
+
+    if len(p0) == 0 or len(p1) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    p0H = transform_points(p0, H)
+    d01, i01 = cKDTree(p1).query(p0H, distance_upper_bound=max_dist)
+    d10, i10 = cKDTree(p0H).query(p1, distance_upper_bound=max_dist)
+
+    idx0 = np.nonzero(i01 < len(p1))[0]
+    idx1 = i01[idx0]
+    mutual = i10[idx1] == idx0
+
+    return idx0[mutual], idx1[mutual]
+
+
+def ransac_matrix(v0, v1, tol=0.5, n_iter=500, seed=None):
+    """ Robust version of matrix_from_points. Affine matrices are estimated
+    from random sets of three pairs and the one that agrees with most of
+    the pairs within tol pixels is refitted with all of them. Returns the
+    matrix and the boolean mask of the inliers."""
+
+    n = len(v0)
+    if n < 3:
+        raise ValueError('At least 3 pairs of points are needed')
+
+    rng = np.random.RandomState(seed)
+    best = (0, np.inf, np.ones(n, dtype=bool))
+    for i in range(n_iter):
+        sample = rng.choice(n, 3, replace=False)
+        try:
+            H = matrix_from_points(v0[sample], v1[sample])
+        except np.linalg.LinAlgError:
+            continue
+        if not np.all(np.isfinite(H)):
+            continue
+
+        dist = np.linalg.norm(transform_points(v0, H) - v1, axis=1)
+        inliers = dist < tol
+        count, cost = inliers.sum(), dist[inliers].sum()
+        if count > best[0] or (count == best[0] and cost < best[1]):
+            best = (count, cost, inliers)
+
+    # Refit with all the inliers until they don't change
+    inliers = best[2]
+    for i in range(10):
+        H = matrix_from_points(v0[inliers], v1[inliers])
+        dist = np.linalg.norm(transform_points(v0, H) - v1, axis=1)
+        newInliers = dist < tol
+        if newInliers.sum() < 3 or np.array_equal(newInliers, inliers):
+            break
+        inliers = newInliers
+
+    return H, inliers
+
+
+def print_residuals(v0, v1, H, name=''):
+    """ Reports the distances between the pairs after the transformation,
+    like transformation_check does."""
+
+    dist = np.linalg.norm(transform_points(v0, H) - v1, axis=1)
+    if len(dist) > 0:
+        print(name + 'Pairs: {}'.format(len(dist)))
+        print(name + 'Mean distance: ', np.mean(dist))
+        print(name + 'Maximum distance: ', np.max(dist))
+
+    return dist
+
+
+def auto_pairs(filenames, H=None, alpha=2.5, max_dist=3):
+    """ Localizes the beads in both channels of each stack and pairs them.
+    Without H, channels are pre-aligned with coarse_shift. Returns the
+    paired points of all stacks together."""
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    v0, v1 = [], []
+    for filename in filenames:
+        images = load_images(filename)
+        p0 = localize_beads(images[0], alpha)
+        p1 = localize_beads(images[1], alpha)
+
+        if H is None:
+            Hk = translation_matrix(coarse_shift(images.astype(float)))
+        else:
+            Hk = H
+        idx0, idx1 = pair_points(p0, p1, Hk, max_dist)
+        print(time.strftime("%Y-%m-%d %H:%M:%S") +
+              ' {}: {} and {} beads, {} pairs'.format(
+              os.path.split(filename)[1], len(p0), len(p1), len(idx0)))
+
+        v0.append(p0[idx0])
+        v1.append(p1[idx1])
+
+    return np.concatenate(v0), np.concatenate(v1)
+
+
+def auto_matrix_from_stacks(filenames, Hfilename=None, alpha=2.5, max_dist=3,
+                            tol=0.5):
+    """ Headless version of matrix_from_stack. Beads from all the stacks are
+    paired automatically and the matrix is estimated with ransac_matrix.
+    Pairs are made again with the resulting matrix, which also catches the
+    beads that the initial translation missed."""
+
+    v0, v1 = auto_pairs(filenames, alpha=alpha, max_dist=max_dist)
+    H, inliers = ransac_matrix(v0, v1, tol)
+
+    v0, v1 = auto_pairs(filenames, H, alpha, tol)
+    H, inliers = ransac_matrix(v0, v1, tol)
+
+    print('Transformation matrix 1 --> 0')
+    print(H)
+    print('Outliers: {}'.format(np.sum(~inliers)))
+    print_residuals(v0[inliers], v1[inliers], H)
+    if Hfilename is not None:
+        np.save(Hfilename, H)
+
+    return H
+
+
+def auto_warp_from_stacks(filenames, Wfilename=None, kind='polynomial',
+                          alpha=2.5, max_dist=3, tol=0.5, **kwargs):
+    """ Like auto_matrix_from_stacks but fitting a non-rigid Warp of the
+    given kind ('polynomial' or 'tps'), with kwargs passed to its fit. The
+    affine RANSAC step is only used to discard wrong pairs, so its tolerance
+    is max_dist to keep the beads that the affine model can't register."""
+
+    v0, v1 = auto_pairs(filenames, alpha=alpha, max_dist=max_dist)
+    H, inliers = ransac_matrix(v0, v1, max_dist)
+    W = warpKinds[kind].fit(v0[inliers], v1[inliers], **kwargs)
+
+    v0, v1 = auto_pairs(filenames, W, alpha, tol)
+    W = warpKinds[kind].fit(v0, v1, **kwargs)
+
+    print('Affine residuals')
+    print_residuals(v0, v1, H)
+    print('Warp residuals')
+    print_residuals(v0, v1, W)
+    if Wfilename is not None:
+        W.save(Wfilename)
+
+    return W
+
+
+def auto_transformation_check(H, filenames, alpha=2.5, max_dist=2):
+    """ Headless version of transformation_check."""
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    for filename in filenames:
+        v0, v1 = auto_pairs(filename, H, alpha, max_dist)
+        print_residuals(v0, v1, H, os.path.split(filename)[1] + ' ')
+
+
 def find_largest_rectangle(a):
     ''' Adapted from
     http://stackoverflow.com/questions/2478447/
@@ -434,81 +958,183 @@ def find_largest_rectangle(a):
     0 0 1 0 0 0''
     a = np.fromstring(s, dtype=int, sep=' ').reshape(6, 6)
     find_largest_rectangle(a)
+
+    Returns the (start, stop) rows and columns of the largest rectangle of
+    nonzero elements of a, to be used as a[xlim[0]:xlim[1], ylim[0]:ylim[1]].
     '''
 
-    a = (1 - a).astype(np.int)
-
-    area_max = (0, [])
-
-    w = np.zeros(dtype=int, shape=a.shape)
-    h = np.zeros(dtype=int, shape=a.shape)
-    for r in range(a.shape[0]):
-        for c in range(a.shape[1]):
-            if a[r][c] == 1:
-                continue
-            if r == 0:
-                h[r][c] = 1
-            else:
-                h[r][c] = h[r - 1][c] + 1
-            if c == 0:
-                w[r][c] = 1
-            else:
-                w[r][c] = w[r][c - 1] + 1
-            minw = w[r][c]
-            for dh in range(h[r][c]):
-                minw = min(minw, w[r-dh][c])
-                area = (dh + 1)*minw
+    # Histogram of the heights of the valid columns ending at each row,
+    # updated with one NumPy operation per row. The largest rectangle ending
+    # at a row is found with a single stack sweep over the histogram.
+    valid = np.asarray(a) != 0
+    ncols = valid.shape[1]
+    heights = np.zeros(ncols, dtype=int)
+
+    area_max = (0, [(0, 0), (0, 0)])
+    for r, row in enumerate(valid):
+        heights = np.where(row, heights + 1, 0)
+
+        h = heights.tolist() + [0]
+        stack = []
+        for c, height in enumerate(h):
+            start = c
+            while stack and stack[-1][1] >= height:
+                start, top = stack.pop()
+                area = top*(c - start)
                 if area > area_max[0]:
-                    area_max = (area, [(r-dh, r), (c-minw + 1, c)])
+                    area_max = (area, [(r - top + 1, r + 1), (start, c)])
+            stack.append((start, height))
 
-#    print('area', area_max[0])
     xlim, ylim = area_max[1]
 
-    return xlim, ylim
-
-
-def get_affine_shapes(chShape, H):
-
-    data = np.ones(chShape)
-    datac = h_affine_transform(data, H)
-
-#    indices = np.where(datac == 1)
-#
-#    # This may only work with the present setup and two-color scheme
-#    ylim = (indices[1].min() + 1, indices[1].max() + 1)
-#    xmin = indices[0].min()
-#    while True:
-#        if np.sum(datac[xmin, ylim[0]:ylim[1]] == 0) == 0:
-#            # If all the elements are ones
-#            break
-#        else:
-#            xmin += 1
-#
-#    xmax = indices[0].max()
-#    while True:
-#        if np.sum(datac[xmax, ylim[0]:ylim[1]] == 0) == 0:
-#            break
-#        else:
-#            xmax -= 1
-#
-#    xlim = (xmin, xmax + 1)
-#    ylim = (indices[1].min(), indices[1].max() + 1)
-
-    xlim, ylim = find_largest_rectangle(datac)
+    return tuple(xlim), tuple(ylim)
+
+
+def get_affine_shapes(chShape, H, Hname=None):
+    """ Largest area of channel 1 that is fully covered by the data after
+    transforming it with H, an affine matrix or a Warp. If Hname (the file
+    of H) is given, results are cached in a file next to it."""
+
+    chShape = tuple(chShape[-2:])
+    key = 'x'.join(str(s) for s in chShape)
+    cache = {}
+    if Hname is not None:
+        Hkey = H.asarray() if isinstance(H, Warp) else H
+        cacheName = utils.insertSuffix(Hname, '_shapes', '.npz')
+        cache = load_shapes_cache(cacheName, Hkey)
+
+    if key in cache:
+        lims = cache[key].tolist()
+        xlim, ylim = tuple(lims[:2]), tuple(lims[2:])
+    else:
+        mask = make_transformer(H, chShape).mask
+        xlim, ylim = find_largest_rectangle(mask.astype(int))
+        if Hname is not None:
+            cache[key] = np.array(xlim + ylim)
+            try:
+                np.savez(cacheName, H=Hkey, **cache)
+            except OSError:
+                pass
+
     cropShape = (xlim[1] - xlim[0], ylim[1] - ylim[0])
 
     return xlim, ylim, cropShape
 
 
+def load_shapes_cache(filename, H):
+    """ Returns the shapes cached in filename as a dict, or an empty one if
+    the file doesn't exist or was computed for another matrix."""
+
+    try:
+        with np.load(filename) as data:
+            if not np.array_equal(data['H'], H):
+                return {}
+            return {k: data[k] for k in data.files if k != 'H'}
+    except (IOError, OSError, KeyError, ValueError):
+        return {}
+
+
+class TiffStack(object):
+    """ Sliceable view of the pages of an open TiffFile. Frames are only read
+    when they are requested."""
+
+    def __init__(self, tt):
+        self.tt = tt
+        self.shape = (len(tt.pages),) + tuple(tt.pages[0].shape)
+        self.dtype = tt.pages[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        pages = range(*key.indices(self.shape[0]))
+        data = self.tt.asarray(key=pages)
+        return data.reshape((len(pages),) + self.shape[1:])
+
+
+def corrected_shape(shape, H, Hname=None):
+    """ Shape of the two-color stack of the given shape after
+    transform_stack. Also returns the channel side and crop limits."""
+
+    side = (shape[1] - 10) // 2
+    xlim, ylim, cropShape = get_affine_shapes((side, shape[2]), H, Hname)
+    outShape = (shape[0], 2*cropShape[0], cropShape[1])
+
+    return outShape, side, xlim, ylim
+
+
+def transform_stack(data, H, Hname=None, blockSize=128, pool=None):
+    """ Generator that corrects a two-color stack block by block. data can be
+    any sliceable (n, x, y) object, like an hdf5 dataset or a TiffStack. It
+    yields the index of the first frame of each block and the block with
+    both channels cropped to the area of get_affine_shapes, channel 0 on top
+    and the transformed channel 1 below, in frame order.
+
+    Blocks are transformed as background jobs of pool, the shared
+    WorkerPool by default. No more than two blocks per process are in
+    flight, so the memory in use is set by blockSize and not by the length
+    of the stack."""
+
+    outShape, side, xlim, ylim = corrected_shape(data.shape, H, Hname)
+    n = data.shape[0]
+    if pool is None:
+        pool = workers.shared()
+    maxPending = 2*pool.processes
+
+    init = workers.Initializer(initTransformer, H, (side, data.shape[2]),
+                               side, xlim, ylim)
+    pending = deque()
+    try:
+        for start in range(0, n, blockSize):
+            block = data[start:start + blockSize]
+            job = pool.submit(transformBlock, (block,), workers.BACKGROUND,
+                              init)
+            pending.append((start, job))
+            while len(pending) >= maxPending:
+                start, result = pending.popleft()
+                yield start, result.get()
+
+        while len(pending) > 0:
+            start, result = pending.popleft()
+            yield start, result.get()
+
+    finally:
+        for start, result in pending:
+            result.cancel()
+
+
+# Per process state of the transform_stack workers
+_worker = {}
+
+
+def initTransformer(H, chShape, side, xlim, ylim):
+    _worker['transformer'] = make_transformer(H, chShape)
+    _worker['side'] = side
+    _worker['crop'] = (slice(None), slice(*xlim), slice(*ylim))
+
+
+def transformBlock(block):
+
+    side = _worker['side']
+    crop = _worker['crop']
+    ch1 = _worker['transformer'].transform(block[:, -side:])
+    return np.concatenate((block[:, :side][crop], ch1[crop]), 1)
+
+
 class HtransformStack(QtCore.QObject):
     """ Transforms all frames of channel 1 using matrix H."""
 
     finished = QtCore.pyqtSignal()
 
+    def __init__(self, blockSize=128, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.blockSize = blockSize
+
     def run(self):
-        Hname = utils.getFilename("Select affine transformation matrix",
-                                  [('npy files', '.npy')])
-        H = np.load(Hname)
+        Hname = utils.getFilename("Select channel registration",
+                                  [('npy files', '.npy'),
+                                   ('npz files', '.npz')])
+        H = load_registration(Hname)
 
         text = "Select files for affine transformation"
         filenames = utils.getFilenames(text, types=[],
@@ -524,68 +1150,40 @@ class HtransformStack(QtCore.QObject):
                         hdf.File(filename2, 'w') as f1:
 
                     dat0 = f0['data']
-                    xlim, ylim, cropShape = get_affine_shapes(dat0.shape, H)
-                    print(dat0.shape)
-                    dat1 = self.mpStack(dat0, xlim, ylim, H)
-
-                    # Store
-                    f1.create_dataset(name='data', data=dat1)
-#                    f1['data'][:, -cropShape[0]:, :] = im1c
+                    outShape = corrected_shape(dat0.shape, H, Hname)[0]
+                    chunks = (min(self.blockSize, outShape[0]),) + outShape[1:]
+                    dat1 = f1.create_dataset(name='data', shape=outShape,
+                                             dtype=dat0.dtype, chunks=chunks)
+                    for start, block in transform_stack(dat0, H, Hname,
+                                                        self.blockSize):
+                        dat1[start:start + len(block)] = block
 
             elif ext in ['.tiff', '.tif']:
                 with tiff.TiffFile(filename) as tt:
 
-                    dat0 = tt.asarray()
-                    if len(dat0.shape) > 2:
-                        results = get_affine_shapes(dat0.shape, H)
-                        xlim, ylim, cropShape = results
-                        dat1 = self.mpStack(dat0, xlim, ylim, H)
-                        tiff.imsave(filename2, dat1)
+                    if len(tt.pages) > 1:
+                        dat0 = TiffStack(tt)
+                        with tiff.TiffWriter(filename2, bigtiff=True) as tw:
+                            for start, block in transform_stack(
+                                    dat0, H, Hname, self.blockSize):
+                                for frame in block:
+                                    tw.save(frame)
 
                     else:
+                        dat0 = tt.asarray()
                         sh0 = np.array([0.5*dat0.shape[0] - 5, dat0.shape[1]])
                         sh0 = sh0.astype(np.int)
                         tiff.imsave(utils.insertSuffix(filename, '_ch0'),
                                     dat0[:sh0[0], :])
+                        ch1 = dat0[-sh0[0]:, :]
+                        transformer = make_transformer(H, ch1.shape)
                         tiff.imsave(utils.insertSuffix(filename, '_ch1'),
-                                    h_affine_transform(dat0[-sh0[0]:, :], H))
+                                    transformer.transform(ch1))
 
             print(time.strftime("%Y-%m-%d %H:%M:%S") + ' done')
 
         self.finished.emit()
 
-    def mpStack(self, dat0, xlim, ylim, H):
-
-        # Multiprocessing
-        n = len(dat0)
-        cpus = mp.cpu_count()
-        step = n // cpus
-        chunks = [[i*step, (i + 1)*step] for i in np.arange(cpus)]
-        chunks[-1][1] = n
-        args = [[dat0[i:j, -dat0.shape[1]:, :], H] for i, j in chunks]
-        pool = mp.Pool(processes=cpus)
-        results = pool.map(transformChunk, args)
-        pool.close()
-        pool.join()
-        im1c = np.concatenate(results[:])
-
-        # Stack channels
-        im1c = im1c[:, xlim[0]:xlim[1], ylim[0]:ylim[1]]
-        im0 = dat0[:, :dat0.shape[0], :][:, xlim[0]:xlim[1], ylim[0]:ylim[1]]
-        return np.append(im0, im1c, 1)
-
-
-def transformChunk(args):
-
-    data, H = args
-
-    n = len(data)
-    out = np.zeros(data.shape, dtype=np.uint16)
-    for f in np.arange(n):
-        out[f] = h_affine_transform(data[f], H)
-
-    return out
-
 
 if __name__ == '__main__':
 
@@ -594,19 +1192,28 @@ if __name__ == '__main__':
     types = [('tiff files', '.tiff'), ('hdf5 files', '.hdf5'),
              ('all files', '.*')]
 
-    filename = filedialog.askopenfilename(filetypes=types, parent=root,
-                                          title='Load bead stack')
-    folder = os.path.split(filename)[0]
+    filenames = filedialog.askopenfilenames(filetypes=types, parent=root,
+                                            title='Load bead stacks')
+    folder = os.path.split(filenames[0])[0]
 
-    arrayType = [('numpy array', '.npy')]
+    arrayType = [('numpy array', '.npy'), ('warp', '.npz')]
     Hfilename = filedialog.asksaveasfilename(filetypes=arrayType,
                                              parent=root, initialdir=folder,
-                                             title='Save affine matrix')
+                                             title='Save registration')
     root.destroy()
 
-    H = matrix_from_stack(filename, Hfilename)
-    print('Checking transformation with same stack')
-    transformation_check(H, filename)
+    auto = input('Automatic bead pairing? (y/n) ') == 'y'
+    if auto:
+        kind = input('Registration model (affine/polynomial/tps) ')
+        if kind in warpKinds:
+            Hfilename = utils.insertSuffix(Hfilename, '', '.npz')
+            H = auto_warp_from_stacks(filenames, Hfilename, kind)
+        else:
+            H = auto_matrix_from_stacks(filenames, Hfilename)
+    else:
+        H = matrix_from_stack(filenames[0], Hfilename)
+        print('Checking transformation with same stack')
+        transformation_check(H, filenames[0])
 
     check = input('Check the transformation with another stack? (y/n) ') == 'y'
     if check:
@@ -616,5 +1223,8 @@ if __name__ == '__main__':
         filename = filedialog.askopenfilename(filetypes=types, parent=root,
                                               initialdir=folder, title=title)
         root.destroy()
-        transformation_check(H, filename)
+        if auto:
+            auto_transformation_check(H, filename)
+        else:
+            transformation_check(H, filename)
         input('Press any key to exit...')
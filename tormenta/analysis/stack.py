@@ -9,18 +9,21 @@ import os
 import time
 import numpy as np
 import h5py as hdf
-import multiprocessing as mp
+from collections import deque
 import tifffile as tiff
 
 import matplotlib.pyplot as plt
-from scipy.ndimage.filters import median_filter
+from scipy.ndimage import median_filter
 
 from pyqtgraph.Qt import QtCore
 from tkinter import Tk, filedialog
 
 import tormenta.utils as utils
+import tormenta.workers as workers
 import tormenta.analysis.tools as tools
 import tormenta.analysis.maxima as maxima
+import tormenta.analysis.fiducials as fiducials
+import tormenta.analysis.registration as reg
 
 
 def convert(word):
@@ -59,21 +62,31 @@ def split_two_colors(files):
 
 
 class Stack(object):
-    """Measurement stored in a hdf5 file"""
+    """Measurement stored in a hdf5 file or in a raw recording, which is
+    read through a memory map."""
 
     def __init__(self, filename=None, imagename='data'):
 
         if filename is None:
-            filename = ask_file('Select hdf5 file')
-
-        self.file = hdf.File(filename, 'r')
-
-        # Loading of measurements (i.e., images) in HDF5 file
-        self.imageData = self.file[imagename].value
+            filename = ask_file('Select hdf5 or raw file')
+
+        if os.path.splitext(filename)[1] == '.raw':
+            # Raw frames with the layout and attributes in the sidecar file
+            self.file = hdf.File(os.path.splitext(filename)[0] +
+                                 '_raw_metadata.hdf5', 'r')
+            self.attrs = self.file.attrs
+            self.imageData = np.memmap(filename, dtype=self.attrs['dtype'],
+                                       mode='r',
+                                       shape=tuple(self.attrs['shape']))
+        else:
+            self.file = hdf.File(filename, 'r')
+
+            # Loading of measurements (i.e., images) in HDF5 file
+            self.imageData = self.file[imagename].value
+            self.attrs = self.file[imagename].attrs
         self.nframes = len(self.imageData)
 
         # Attributes loading as attributes of the stack
-        self.attrs = self.file[imagename].attrs
         try:
             self.lambda_em = self.attrs['lambda_em']
         except:
@@ -98,27 +111,83 @@ class Stack(object):
 
     def localize_molecules(self, ran=(0, None), fit_model='2d'):
 
+        self.molecules = self.localize(self.imageData, ran, fit_model)
+
+    def localize(self, data, ran=(0, None), fit_model='2d', pool=None):
+        """ Localizes the molecules in frames ran[0]:ran[1] of data, which
+        can be the whole stack or a region of it (i.e. a channel), as
+        background jobs of pool, the shared WorkerPool by default."""
+
         if ran[1] is None:
-            ran = (0, self.nframes)
+            ran = (ran[0], self.nframes)
 
         self.fit_parameters = maxima.fit_par(fit_model)
         self.dt = maxima.results_dt(self.fit_parameters)
 
-        cpus = mp.cpu_count()
+        if pool is None:
+            pool = workers.shared()
+        cpus = pool.processes
         step = (ran[1] - ran[0]) // cpus
-        chunks = [[i*step, (i + 1)*step] for i in np.arange(cpus)]
+        chunks = [[ran[0] + i*step, ran[0] + (i + 1)*step]
+                  for i in np.arange(cpus)]
         chunks[-1][1] = ran[1]
 
         max_args = (self.fit_parameters, self.dt, self.fwhm, self.win_size,
                     self.kernel, self.xkernel)
-        args = [[self.imageData[i:j], i, fit_model, max_args]
-                for i, j in chunks]
+        args = [[data[i:j], i, fit_model, max_args] for i, j in chunks]
 
-        pool = mp.Pool(processes=cpus)
-        results = pool.map(localize_chunk, args)
-        pool.close()
-        pool.join()
-        self.molecules = np.concatenate(results[:])
+        jobs = [pool.submit(localize_chunk, (arg,)) for arg in args]
+        try:
+            results = [job.get() for job in jobs]
+        finally:
+            for job in jobs:
+                job.cancel()
+        return np.concatenate(results[:])
+
+    def localize_two_colors(self, H, side=None, ran=(0, None),
+                            fit_model='2d', crop=True, Hname=None):
+        """ Localizes both channels of a raw two-color stack and maps the
+        channel 1 results to channel 0 coordinates through H. If crop is True,
+        only the localizations inside the area given by get_affine_shapes are
+        kept, referred to that area. Hname is passed to get_affine_shapes for
+        caching."""
+
+        shape = self.imageData.shape
+        if side is None:
+            side = (shape[1] - 10) // 2
+
+        self.molecules0 = self.localize(self.imageData[:, :side], ran,
+                                        fit_model)
+        molecules1 = self.localize(self.imageData[:, -side:], ran, fit_model)
+        self.molecules1 = reg.register_localizations(molecules1, H)
+
+        if crop:
+            xlim, ylim, cropShape = reg.get_affine_shapes((side, shape[2]), H,
+                                                          Hname)
+            self.molecules0 = reg.crop_localizations(self.molecules0, xlim,
+                                                     ylim)
+            self.molecules1 = reg.crop_localizations(self.molecules1, xlim,
+                                                     ylim)
+
+        return self.molecules0, self.molecules1
+
+    def track_drift(self, n=5, from_table=False):
+        """ Drift trace of the stack computed from its n brightest persistent
+        emitters. If from_table is True, the fiducials and their positions are
+        taken from the localization results instead of fitting the frames."""
+
+        if from_table:
+            fids = fiducials.fiducials_from_table(self.molecules, self.nframes,
+                                                  n=n)
+            self.drift = fiducials.drift_from_table(self.molecules, fids,
+                                                    self.nframes)
+        else:
+            fids = fiducials.fiducials_from_frames(self.imageData[:10], n=n,
+                                                   fwhm=self.fwhm)
+            tracker = fiducials.FiducialTracker(fids, self.fwhm)
+            self.drift = tracker.track(self.imageData)
+
+        return self.drift
 
     def scatter_plot(self):
         plt.plot(self.molecules['fit_y'], self.molecules['fit_x'], 'bo',
@@ -159,14 +228,58 @@ class Stack(object):
         self.file.close()
 
 
+class LocalizeTwoColors(QtCore.QObject):
+    """ Localizes both channels of raw two-color stacks and registers the
+    channel 1 results with matrix H. Unlike HtransformStack, no corrected copy
+    of the data is written."""
+
+    finished = QtCore.pyqtSignal()
+
+    def run(self):
+        Hname = utils.getFilename("Select channel registration",
+                                  [('npy files', '.npy'),
+                                   ('npz files', '.npz')])
+        H = reg.load_registration(Hname)
+
+        text = "Select two-color stacks for localization"
+        types = [('hdf5 files', '.hdf5'), ('raw files', '.raw')]
+        filenames = utils.getFilenames(text, types=types,
+                                       initialdir=os.path.split(Hname)[0])
+        for filename in filenames:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                  ' Localizing stack ' + os.path.split(filename)[1])
+
+            stack = Stack(filename)
+            ch0, ch1 = stack.localize_two_colors(H, Hname=Hname)
+            stack.close()
+
+            locsName = utils.insertSuffix(filename, '_locs')
+            with hdf.File(locsName, 'w') as ff:
+                ff.create_dataset(name='ch0', data=ch0)
+                ff.create_dataset(name='ch1', data=ch1)
+                reg.store_registration(ff, H)
+
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' done')
+
+        self.finished.emit()
+
+
 def localize_chunk(args, index=0):
 
     stack, init_frame, fit_model, max_args = args
+    bkg_stack = bkg_estimation(stack)
+    return localize_frames(stack, bkg_stack, init_frame, fit_model, max_args,
+                           index)
+
+
+def localize_frames(stack, bkg_stack, init_frame, fit_model, max_args,
+                    index=0):
+    """ Localizes the molecules of every frame in stack given its background
+    bkg_stack. Frames are numbered from init_frame."""
+
     fit_parameters, res_dt, fwhm, win_size, kernel, xkernel = max_args
     n_frames = len(stack)
 
-    bkg_stack = bkg_estimation(stack)
-
     # I create a big array, I'll keep the non-null part at the end
     nn = int(np.ceil((n_frames + 1)*np.prod(stack.shape[1:])/(win_size + 1)))
     results = np.zeros(nn, dtype=res_dt)
@@ -202,6 +315,34 @@ def localize_chunk(args, index=0):
     return results[0:index]
 
 
+def localize_online(frames, bkg, init_frame, fit_model, max_args):
+    """ Localization of the frames of a running acquisition, all of them
+    with the same background image. Frames that can't be fitted are skipped
+    instead of stopping the whole batch."""
+
+    results = []
+    for n, frame in enumerate(frames):
+        try:
+            results.append(localize_frames(frame[np.newaxis],
+                                           bkg[np.newaxis], init_frame + n,
+                                           fit_model, max_args))
+        except (Warning, ValueError):
+            pass
+
+    if len(results) > 0:
+        return np.concatenate(results)
+    else:
+        return np.zeros(0, dtype=max_args[1])
+
+
+def localization_args(fwhm, fit_model='2d'):
+    """ max_args of localize_frames for a given fwhm in pixels."""
+
+    fit_parameters = maxima.fit_par(fit_model)
+    return (fit_parameters, maxima.results_dt(fit_parameters), fwhm,
+            int(np.ceil(fwhm)), tools.kernel(fwhm), tools.xkernel(fwhm))
+
+
 def bkg_estimation(data_stack, window=101):
     ''' Background estimation. It's a running (time) mean.
     Hoogendoorn et al. in "The fidelity of stochastic single-molecule
@@ -226,6 +367,81 @@ def subtractChunk(data):
     return subtData.astype(np.int16)
 
 
+def subtract_block(block, first, last, window=101):
+    """ Background subtracted frames first to last of block. The frames
+    before first and after last are only the halo needed by the temporal
+    filter of bkg_estimation. The result is int16 like in subtractChunk,
+    but clipped instead of wrapped around."""
+    subtracted = block[first:last] - bkg_estimation(block, window)[first:last]
+    return np.clip(subtracted, -2**15, 2**15 - 1).astype(np.int16)
+
+
+def subtract_stack(data, window=101, blockSize=256, pool=None):
+    """ Generator of the background subtracted stack, block by block. data
+    can be any sliceable (n, x, y) object, like an hdf5 dataset or a
+    TiffStack. Each block is read with window//2 extra frames at each side,
+    so the result is the same as filtering the whole stack at once. It
+    yields the index of the first frame of each block and the block as
+    int16, in frame order.
+
+    Blocks are processed as background jobs of pool, the shared WorkerPool
+    by default, with at most two blocks per process in flight."""
+
+    n = len(data)
+    halo = window // 2
+    if pool is None:
+        pool = workers.shared()
+    maxPending = 2*pool.processes
+
+    pending = deque()
+    try:
+        for start in range(0, n, blockSize):
+            stop = min(start + blockSize, n)
+            first = max(start - halo, 0)
+            block = data[first:min(stop + halo, n)]
+            args = (block, start - first, stop - first, window)
+            pending.append((start, pool.submit(subtract_block, args)))
+            while len(pending) >= maxPending:
+                start, result = pending.popleft()
+                yield start, result.get()
+
+        while len(pending) > 0:
+            start, result = pending.popleft()
+            yield start, result.get()
+
+    finally:
+        for start, result in pending:
+            result.cancel()
+
+
+def subtract_background(data, out, window=101, blockSize=256, pool=None):
+    """ Writes the background subtracted stack data into out, a preallocated
+    uint16 dataset or array of the same shape. Like in subtractChunk, the
+    minimum of the result is subtracted so it fits in uint16.
+
+    The minimum is only known at the end, so every block is written with the
+    running minimum of the blocks seen until then as offset. Blocks written
+    before the minimum was found are fixed afterwards, which usually means
+    a few of them. Returns the offset."""
+
+    offsets = []
+    offset = None
+    for start, block in subtract_stack(data, window, blockSize, pool):
+        low = int(block.min())
+        offset = low if offset is None else min(offset, low)
+        offsets.append((start, len(block), offset))
+        out[start:start + len(block)] = np.clip(block.astype(np.int32) -
+                                                offset, 0, 2**16 - 1)
+
+    for start, n, blockOffset in offsets:
+        if blockOffset != offset:
+            block = out[start:start + n].astype(np.int32)
+            block += blockOffset - offset
+            out[start:start + n] = np.clip(block, 0, 2**16 - 1)
+
+    return offset
+
+
 if __name__ == "__main__":
 
     split_two_colors(ask_files('Select hdf5 file'))
@@ -2,7 +2,7 @@ import numpy as np
 from scipy.signal import fftconvolve
 from scipy.ndimage import center_of_mass
 import scipy.optimize as opt
-from scipy.ndimage.interpolation import shift
+from scipy.ndimage import shift
 
 
 # with open("d1.raw", 'rb') as d1:
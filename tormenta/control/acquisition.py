@@ -0,0 +1,955 @@
+# -*- coding: utf-8 -*-
+"""
+Recording pipeline of the control GUI: the ring buffer between the
+camera readout and its consumers, the file formats frames are written to
+and the acquisition routines that run without the GUI.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+import numpy as np
+import h5py as hdf
+import tifffile as tiff
+
+import tormenta.analysis.registration as reg
+import tormenta.analysis.stack as stack
+import tormenta.workers as workers
+
+
+class FrameRing(object):
+    """ Preallocated ring buffer of frames with a single producer and any
+    number of consumers. The producer puts frames in acquisition order and
+    every consumer sees all of them, through its own cursor. Consumers read
+    views of the buffer with peek and free them with release, so frames are
+    never copied after being put. The producer waits if the slowest consumer
+    is a whole buffer behind.
+
+    :param capacity: number of frames in the buffer
+    :param frameShape: shape of each frame
+    """
+
+    def __init__(self, capacity, frameShape, dtype=np.uint16):
+
+        self.capacity = int(capacity)
+        self.frameShape = tuple(frameShape)
+        self.buffer = np.zeros((self.capacity,) + self.frameShape, dtype=dtype)
+        self.written = 0
+        self.closed = False
+        self.cursors = {}
+        self.highWater = {}
+        self.cond = threading.Condition()
+
+    def addConsumer(self, name):
+        with self.cond:
+            self.cursors[name] = self.written
+            self.highWater[name] = 0
+
+    def removeConsumer(self, name):
+        """ Stops waiting for consumer name, for example if it failed."""
+        with self.cond:
+            self.cursors.pop(name, None)
+            self.cond.notify_all()
+
+    def depth(self, name=None):
+        """ Frames not yet released by consumer name, or by the slowest one
+        if name is None."""
+        with self.cond:
+            return self._depth(name)
+
+    def _depth(self, name=None):
+        if name is not None:
+            return self.written - self.cursors[name]
+        elif len(self.cursors) > 0:
+            return self.written - min(self.cursors.values())
+        else:
+            return 0
+
+    def stats(self):
+        """ Current depth and high-water mark of every consumer."""
+        with self.cond:
+            return {name: (self._depth(name), self.highWater[name])
+                    for name in self.cursors}
+
+    def put(self, frames):
+        """ Copies frames into the buffer, waiting for free space if needed.
+        Batches larger than the buffer are put in pieces."""
+
+        frames = np.asarray(frames)
+        k = 0
+        while k < len(frames):
+            with self.cond:
+                while self._depth() >= self.capacity:
+                    self.cond.wait()
+
+                slot = self.written % self.capacity
+                n = min(len(frames) - k, self.capacity - self._depth(),
+                        self.capacity - slot)
+                self.buffer[slot:slot + n] = frames[k:k + n]
+                self.written += n
+                k += n
+
+                for name in self.cursors:
+                    self.highWater[name] = max(self.highWater[name],
+                                               self._depth(name))
+                self.cond.notify_all()
+
+    def close(self):
+        """ No more frames will be put. Consumers get None once they read
+        everything that was put before."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def peek(self, name, maxFrames=None):
+        """ Waits for new frames for consumer name and returns the index of
+        the first one and a view of them, or None if the ring is closed and
+        there is nothing left. The view is only valid until release."""
+
+        with self.cond:
+            while self.written == self.cursors[name] and not self.closed:
+                self.cond.wait()
+
+            start = self.cursors[name]
+            if self.written == start:
+                return None
+
+            slot = start % self.capacity
+            n = min(self.written - start, self.capacity - slot)
+            if maxFrames is not None:
+                n = min(n, maxFrames)
+            return start, self.buffer[slot:slot + n]
+
+    def release(self, name, n):
+        with self.cond:
+            self.cursors[name] += n
+            self.cond.notify_all()
+
+
+class FramePool(object):
+    """ Preallocated frames handed out in turn by next, to read the camera
+    without allocating a new array every time. A frame is reused n calls
+    later, so it shouldn't be kept longer than that."""
+
+    def __init__(self, shape, n=3, dtype=np.uint16):
+        self.frames = np.zeros((n,) + tuple(shape), dtype=dtype)
+        self.i = 0
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    def next(self):
+        frame = self.frames[self.i]
+        self.i = (self.i + 1) % len(self.frames)
+        return frame
+
+
+class FrameLog(object):
+    """ Camera frame number and readout time of every stored frame of a
+    recording of up to n frames, in the order they're written, and the
+    number of frames lost in the camera buffer before being read. All the
+    frames of a batch get the time of its readout, it's not the acquisition
+    time of the frame. Lost frames aren't stored, so they're the gaps in the
+    frame numbers."""
+
+    def __init__(self, n):
+        self.timestamps = np.zeros(n)
+        self.frameNumbers = np.zeros(n, dtype=np.int64)
+        self.stored = 0
+        self.lost = 0
+
+    def add(self, first, last, t):
+        """ Logs camera frames first to last (1-based, inclusive), read at
+        time t."""
+        previous = self.frameNumbers[self.stored - 1] if self.stored else 0
+        self.lost += max(0, first - previous - 1)
+        k = self.stored
+        n = last - first + 1
+        self.timestamps[k:k + n] = t
+        self.frameNumbers[k:k + n] = np.arange(first, last + 1)
+        self.stored += n
+
+
+class Timings(object):
+    """ Time spent in each step of a recording, added by the readout and the
+    consumer threads. Every step keeps its number of batches and frames, the
+    total time and the slowest batch."""
+
+    def __init__(self):
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, dt, nframes=1):
+        with self.lock:
+            batches, frames, total, slowest = self.steps.get(name,
+                                                             (0, 0, 0, 0))
+            self.steps[name] = (batches + 1, frames + nframes, total + dt,
+                                max(slowest, dt))
+
+    def perFrame(self, name):
+        """ Mean time per frame of step name, in ms."""
+        with self.lock:
+            batches, frames, total, slowest = self.steps.get(name,
+                                                             (0, 0, 0, 0))
+        return 1000 * total / max(frames, 1)
+
+    def attrs(self):
+        """ (name, value) pairs of the timing statistics, in ms."""
+        with self.lock:
+            steps = sorted(self.steps.items())
+        attrs = []
+        for name, (batches, frames, total, slowest) in steps:
+            attrs.append((name + ' time per frame (ms)',
+                          1000 * total / max(frames, 1)))
+            attrs.append((name + ' slowest batch (ms)', 1000 * slowest))
+            attrs.append((name + ' batches', batches))
+        return attrs
+
+
+class RingConsumer(threading.Thread):
+    """ Thread that hands all the frames of a FrameRing to func(start,
+    frames), in order. If func raises, the exception is kept in error and
+    the consumer leaves the ring so it doesn't block the producer. frames
+    counts the frames handed to func without errors. The time spent in
+    func is added to timings under the consumer name."""
+
+    def __init__(self, ring, func, name, maxFrames=None, timings=None):
+        super().__init__(name=name, daemon=True)
+        self.ring = ring
+        self.func = func
+        self.maxFrames = maxFrames
+        self.timings = timings
+        self.error = None
+        self.frames = 0
+        self.ring.addConsumer(name)
+
+    def run(self):
+        try:
+            while True:
+                item = self.ring.peek(self.name, self.maxFrames)
+                if item is None:
+                    break
+                start, frames = item
+                t0 = time.perf_counter()
+                self.func(start, frames)
+                if self.timings is not None:
+                    self.timings.add(self.name, time.perf_counter() - t0,
+                                     len(frames))
+                self.frames += len(frames)
+                self.ring.release(self.name, len(frames))
+
+        except Exception as e:
+            self.error = e
+            self.ring.removeConsumer(self.name)
+
+
+class Preview(object):
+    """ Live preview of a recording for the GUI. The readout thread offers
+    frames and at most maxRate per second are kept, reduced by binning (mean
+    of binning x binning blocks) or decimation into a preallocated buffer.
+    notify is called when a new preview is ready, but only if the previous
+    one was taken already: if the GUI is slow, the buffer is overwritten and
+    it just gets the most recent frame when it calls take."""
+
+    def __init__(self, frameShape, maxRate=10, binning=1, decimate=False,
+                 notify=None):
+
+        self.maxRate = maxRate
+        self.binning = max(1, int(binning))
+        self.decimate = decimate
+        self.notify = notify
+        self.shape = (frameShape[0] // self.binning,
+                      frameShape[1] // self.binning)
+        self.buffer = np.zeros(self.shape, dtype=np.float32)
+        self.out = np.zeros(self.shape, dtype=np.float32)
+        self.lock = threading.Lock()
+        self.pending = False
+        self.lastTime = 0
+        self.index = 0
+        self.skipped = 0
+
+    def reduce(self, frame, out):
+        k = self.binning
+        h, w = self.shape
+        frame = frame[:h*k, :w*k]
+        if k == 1:
+            out[:] = frame
+        elif self.decimate:
+            out[:] = frame[::k, ::k]
+        else:
+            np.mean(frame.reshape(h, k, w, k), axis=(1, 3), out=out)
+
+    def offer(self, frame, index=0):
+        """ Returns True if the frame was kept for the preview."""
+
+        now = time.time()
+        if now - self.lastTime < 1 / self.maxRate:
+            self.skipped += 1
+            return False
+        self.lastTime = now
+
+        with self.lock:
+            self.reduce(frame, self.buffer)
+            self.index = index
+            notify = not(self.pending)
+            self.pending = True
+
+        if notify and self.notify is not None:
+            self.notify()
+        return True
+
+    def take(self):
+        """ Returns the most recent preview and the index of its frame. The
+        array is reused by the next take."""
+        with self.lock:
+            self.out[:] = self.buffer
+            self.pending = False
+            return self.out, self.index
+
+
+def saveAttrs(h5obj, attrs):
+    for item in attrs:
+        if item[1] is not None:
+            h5obj.attrs[item[0]] = item[1]
+
+
+# Lossless filters offered for the hdf5 recordings
+compressions = [None, 'lzf', 'gzip']
+
+
+def datasetOptions(shape, chunkFrames=1, compression=None):
+    """ create_dataset keyword arguments for a stack of the given shape with
+    chunkFrames whole frames per chunk. Compressed datasets also use the
+    shuffle filter, which makes 16 bit camera data much more compressible.
+    gzip is used at its fastest level."""
+
+    chunks = (int(max(1, min(chunkFrames, shape[0]))),) + tuple(shape[1:])
+    options = {'chunks': chunks}
+    if compression is not None:
+        options['compression'] = compression
+        options['shuffle'] = True
+        if compression == 'gzip':
+            options['compression_opts'] = 1
+    return options
+
+
+class HDF5Store(object):
+    """ Writes frames into a preallocated hdf5 dataset. The dataset is
+    shrunk to the number of frames recorded when it's closed. See
+    datasetOptions for chunkFrames and compression."""
+
+    def __init__(self, filename, dataname, shape, chunkFrames=1,
+                 compression=None):
+        self.file = hdf.File(filename, 'w')
+        self.shape = tuple(shape)
+        options = datasetOptions(self.shape, chunkFrames, compression)
+        self.dataset = self.file.create_dataset(name=dataname,
+                                                shape=self.shape,
+                                                maxshape=self.shape,
+                                                dtype=np.uint16, **options)
+
+    def write(self, start, frames):
+        self.dataset[start:start + len(frames)] = frames
+
+    def close(self, nframes, attrs, extra=None):
+        """ Saves attrs in the dataset. extra(h5file) can save anything else
+        in the same file."""
+
+        try:
+            if nframes < self.shape[0]:
+                self.dataset.resize((nframes,) + self.shape[1:])
+            saveAttrs(self.dataset, attrs)
+            if extra is not None:
+                extra(self.file)
+        finally:
+            self.file.close()
+
+
+def needsBigTiff(shape):
+    """ Classic TIFF files can't be larger than 4 GB and many readers only
+    support up to 2 GB, so bigger stacks are saved as BigTIFF."""
+    return np.prod(shape, dtype=np.int64) * 2 > 2**31
+
+
+def tiffWriter(filename, shape):
+    """ TiffWriter for a uint16 stack of shape, BigTIFF if needed. The
+    tifffile versions with TiffWriter.write take the software tag in write
+    instead, see writeTiff."""
+    bigtiff = needsBigTiff(shape)
+    if hasattr(tiff.TiffWriter, 'write'):
+        return tiff.TiffWriter(filename, bigtiff=bigtiff)
+    return tiff.TiffWriter(filename, bigtiff=bigtiff, software='Tormenta')
+
+
+def writeTiff(tw, data, umxpx=None, **kwargs):
+    """ Writes the frames data to the TiffWriter tw, with the pixel size
+    umxpx in um if given. Newer tifffile versions replaced save by write and
+    the resolution unit extratag by resolutionunit, and only append to the
+    previous pages contiguously one page at a time."""
+    if umxpx is not None:
+        kwargs['resolution'] = (1/umxpx, 1/umxpx)
+    if hasattr(tw, 'write'):
+        if umxpx is not None:
+            kwargs['resolutionunit'] = 3
+        if kwargs.get('contiguous', False):
+            for page in data.reshape((-1,) + data.shape[-2:]):
+                tw.write(page, software='Tormenta', **kwargs)
+            return
+        return tw.write(data, software='Tormenta', **kwargs)
+    if umxpx is not None:
+        kwargs['extratags'] = [('resolution_unit', 'H', 1, 3, True)]
+    return tw.save(data, **kwargs)
+
+
+def saveMetadata(metaName, attrs, extra=None):
+    with hdf.File(metaName, 'w') as metaFile:
+        for item in attrs:
+            if item[1] is not None:
+                metaFile[item[0]] = item[1]
+        if extra is not None:
+            extra(metaFile)
+
+
+class TiffStore(object):
+    """ Writes frames as pages of a TIFF file, so it's correctly opened in
+    ImageJ or in python through tifffile. Each batch is written with a
+    single call, as contiguous pages. The attrs are saved in the metaName
+    hdf5 file."""
+
+    def __init__(self, filename, umxpx, shape, metaName=None):
+        self.file = tiffWriter(filename, shape)
+        self.umxpx = umxpx
+        if metaName is None:
+            metaName = os.path.splitext(filename)[0] + '_metadata.hdf5'
+        self.metaName = metaName
+
+    def write(self, start, frames):
+        writeTiff(self.file, np.ascontiguousarray(frames), self.umxpx,
+                  photometric='minisblack', contiguous=True)
+
+    def close(self, nframes, attrs, extra=None):
+        self.file.close()
+        saveMetadata(self.metaName, attrs, extra)
+
+
+class TiffMemmapStore(object):
+    """ Preallocated TIFF file mapped in memory, frames are written by slice
+    assignment. If the recording is stopped early, the recorded frames are
+    copied block by block into a TIFF file of the right length that
+    replaces the preallocated one. The number of recorded frames is also
+    saved in the metadata."""
+
+    def __init__(self, filename, umxpx, shape, metaName=None,
+                 blockFrames=256):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.resolution = (1/umxpx, 1/umxpx)
+        self.blockFrames = blockFrames
+        self.data = tiff.memmap(filename, shape=self.shape, dtype=np.uint16,
+                                bigtiff=needsBigTiff(self.shape),
+                                resolution=self.resolution,
+                                photometric='minisblack')
+        if metaName is None:
+            metaName = os.path.splitext(filename)[0] + '_metadata.hdf5'
+        self.metaName = metaName
+
+    def write(self, start, frames):
+        self.data[start:start + len(frames)] = frames
+
+    def truncate(self, nframes):
+        """ Replaces the file by one with only the first nframes frames."""
+        shape = (nframes,) + self.shape[1:]
+        tmpName = self.filename + '.tmp'
+        with tiffWriter(tmpName, shape) as tw:
+            for i in range(0, nframes, self.blockFrames):
+                block = np.array(self.data[i:min(i + self.blockFrames,
+                                                 nframes)])
+                writeTiff(tw, block, photometric='minisblack',
+                          resolution=self.resolution, contiguous=True)
+        del self.data
+        os.replace(tmpName, self.filename)
+
+    def close(self, nframes, attrs, extra=None):
+        self.data.flush()
+        if 0 < nframes < self.shape[0]:
+            self.truncate(nframes)
+        else:
+            del self.data
+        saveMetadata(self.metaName, attrs + [('Recorded frames', nframes)],
+                     extra)
+
+
+def rawMetaName(filename):
+    """ Sidecar of a raw recording. It's not named like the tiff metadata
+    files so converting it to tiff doesn't overwrite it."""
+    return os.path.splitext(filename)[0] + '_raw_metadata.hdf5'
+
+
+class RawStore(object):
+    """ Append-only stream of uint16 frames in C order, written through a
+    large buffer so the disk only sees big sequential writes. The layout
+    (shape and dtype) and the attrs are saved as attributes of the sidecar
+    hdf5 file given by rawMetaName, which also gets anything saved by
+    extra. If timestamps or frameNumbers are given, with a value for every
+    written frame in the same order, their first nframes values are saved
+    in the sidecar as the timestamps and frame numbers datasets. See
+    readRaw and convertRaw."""
+
+    def __init__(self, filename, shape, bufferMB=16, timestamps=None,
+                 frameNumbers=None):
+        self.filename = filename
+        self.frameShape = tuple(shape[1:])
+        self.timestamps = timestamps
+        self.frameNumbers = frameNumbers
+        self.file = open(filename, 'wb', buffering=bufferMB*2**20)
+
+    def write(self, start, frames):
+        self.file.write(np.ascontiguousarray(frames, dtype=np.uint16).data)
+
+    def close(self, nframes, attrs, extra=None):
+        self.file.close()
+        with hdf.File(rawMetaName(self.filename), 'w') as metaFile:
+            saveAttrs(metaFile, attrs)
+            metaFile.attrs['shape'] = (nframes,) + self.frameShape
+            metaFile.attrs['dtype'] = np.dtype(np.uint16).str
+            if self.timestamps is not None:
+                dataset = metaFile.create_dataset(
+                    name='timestamps', data=self.timestamps[:nframes])
+                dataset.attrs['description'] = (
+                    'Time when each frame was read from the camera, shared '
+                    'by all the frames read together, not the acquisition '
+                    'time.')
+            if self.frameNumbers is not None:
+                dataset = metaFile.create_dataset(
+                    name='frame numbers', data=self.frameNumbers[:nframes])
+                dataset.attrs['description'] = (
+                    'Camera frame number (1-based) of each frame. Frames '
+                    'lost in the camera buffer are the gaps.')
+            if extra is not None:
+                extra(metaFile)
+
+
+def readRaw(filename, mode='r'):
+    """ Returns a memory map of the frames of a raw recording and the open
+    sidecar file."""
+
+    metaFile = hdf.File(rawMetaName(filename), 'r')
+    shape = tuple(metaFile.attrs['shape'])
+    data = np.memmap(filename, dtype=metaFile.attrs['dtype'], mode=mode,
+                     shape=shape)
+    return data, metaFile
+
+
+def convertRaw(filename, recFormat='hdf5', dataname='data', blockFrames=256,
+               chunkFrames=1, compression=None):
+    """ Converts a raw recording to hdf5 or tiff, block by block. The attrs
+    of the sidecar are saved like in a regular recording of that format and
+    its datasets are copied. Returns the name of the new file."""
+
+    data, metaFile = readRaw(filename)
+    with metaFile:
+        base = os.path.splitext(filename)[0]
+        newName = base + '.' + recFormat
+        while os.path.exists(newName):
+            base += '_converted'
+            newName = base + '.' + recFormat
+
+        if recFormat == 'hdf5':
+            store = HDF5Store(newName, dataname, data.shape, chunkFrames,
+                              compression)
+        else:
+            umxpx = 1
+            if 'element_size_um' in metaFile.attrs:
+                umxpx = metaFile.attrs['element_size_um'][-1]
+            store = TiffStore(newName, umxpx, data.shape)
+
+        for i in range(0, len(data), blockFrames):
+            store.write(i, np.array(data[i:i + blockFrames]))
+
+        attrs = [(k, v) for k, v in metaFile.attrs.items()
+                 if k not in ['shape', 'dtype']]
+
+        def copyDatasets(h5file):
+            for name in metaFile:
+                metaFile.copy(name, h5file)
+
+        store.close(len(data), attrs, copyDatasets)
+
+    del data
+    return newName
+
+
+class RawConverter(threading.Thread):
+    """ Converts raw recordings with convertRaw in the background. kwargs
+    are passed to convertRaw."""
+
+    def __init__(self, filenames, **kwargs):
+        super().__init__(daemon=True)
+        self.filenames = filenames
+        self.kwargs = kwargs
+
+    def run(self):
+        for filename in self.filenames:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' Converting ' +
+                  os.path.split(filename)[1])
+            try:
+                convertRaw(filename, **self.kwargs)
+                print(time.strftime("%Y-%m-%d %H:%M:%S") + ' done')
+            except Exception as e:
+                print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                      ' Conversion failed: ' + repr(e))
+
+
+class CorrectedStore(object):
+    """ Corrects two-color frames before writing them to store. Channel 1 is
+    transformed with H, both channels are cropped to xlim, ylim and stacked
+    with channel 0 on top.
+
+    The correction runs as acquisition jobs of pool, the shared WorkerPool
+    by default, so write only copies the frames into a job and returns, and
+    the frames can be released from the ring right away. Results are
+    written in order as they get ready. Up to maxPending batches can be
+    waiting in the pool: the correction can lag behind the acquisition and
+    catch up later, and it only slows down the raw data when both the pool
+    and the ring buffer are full.
+    """
+
+    def __init__(self, store, H, chShape, side, xlim, ylim, pool=None,
+                 maxPending=None):
+        self.store = store
+        if pool is None:
+            pool = workers.shared()
+        self.pool = pool
+        if maxPending is None:
+            maxPending = 4*pool.processes
+        self.maxPending = maxPending
+
+        self.init = workers.Initializer(reg.initTransformer, H, chShape,
+                                        side, xlim, ylim)
+        self.pending = deque()
+        self.lag = 0
+        self.maxLag = 0
+
+    def write(self, start, frames):
+        job = self.pool.submit(reg.transformBlock, (np.array(frames),),
+                               workers.ACQUISITION, self.init)
+        self.pending.append((start, len(frames), job))
+        self.lag += len(frames)
+        self.maxLag = max(self.maxLag, self.lag)
+
+        # Write whatever is ready, wait only if the pool is full
+        while len(self.pending) > 0 and (self.pending[0][2].ready() or
+                                         len(self.pending) >= self.maxPending):
+            self.flushOne()
+
+    def flushOne(self):
+        start, n, job = self.pending.popleft()
+        self.store.write(start, job.get().astype(np.uint16))
+        self.lag -= n
+
+    def close(self, nframes, attrs, extra=None):
+        try:
+            while len(self.pending) > 0:
+                self.flushOne()
+        finally:
+            for start, n, job in self.pending:
+                job.cancel()
+            attrs = attrs + [('Correction maximum lag', self.maxLag)]
+            self.store.close(nframes, attrs, extra)
+
+
+class OnlineLocalizer(object):
+    """ Localizes the frames of a recording while it runs, to be used as a
+    RingConsumer function. Batches are localized as interactive jobs of pool,
+    the shared WorkerPool by default, with the Maxima code of
+    stack.localize_frames, against a running mean of the background. If
+    maxPending batches are already waiting, new batches are skipped, so the
+    localization never holds the ring buffer, and it never takes the
+    processes the pool keeps for the acquisition.
+
+    Results are kept in a table and rendered into a super-resolution image
+    with zoom times smaller pixels, available through take.
+
+    :param fwhm: fwhm of the PSF in pixels
+    """
+
+    def __init__(self, frameShape, fwhm, zoom=10, fit_model='2d',
+                 pool=None, maxPending=None):
+
+        self.zoom = zoom
+        self.fit_model = fit_model
+        self.max_args = stack.localization_args(fwhm, fit_model)
+        if pool is None:
+            pool = workers.shared()
+        self.pool = pool
+        if maxPending is None:
+            maxPending = 2*pool.processes
+        self.maxPending = maxPending
+        self.pending = deque()
+
+        self.bkg = None
+        self.table = []
+        self.localized = 0
+        self.skipped = 0
+        self.shape = (frameShape[0]*zoom, frameShape[1]*zoom)
+        self.image = np.zeros(self.shape, dtype=np.float32)
+        self.out = np.zeros(self.shape, dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def write(self, start, frames):
+
+        self.collect()
+
+        # Background as a running mean of the frames
+        if self.bkg is None:
+            self.bkg = frames.mean(0)
+        else:
+            self.bkg += 0.05*(frames.mean(0) - self.bkg)
+
+        if len(self.pending) >= self.maxPending:
+            self.skipped += len(frames)
+            return
+
+        args = (np.array(frames), self.bkg.copy(), start, self.fit_model,
+                self.max_args)
+        job = self.pool.submit(stack.localize_online, args,
+                               workers.INTERACTIVE)
+        self.pending.append((len(frames), job))
+
+    def collect(self, wait=False):
+        """ Adds the finished batches to the table and the image."""
+        while len(self.pending) > 0 and (wait or self.pending[0][1].ready()):
+            n, job = self.pending.popleft()
+            self.add(job.get())
+            self.localized += n
+
+    def add(self, results):
+        self.table.append(results)
+
+        x = (results['fit_x']*self.zoom).astype(int)
+        y = (results['fit_y']*self.zoom).astype(int)
+        inside = ((x >= 0) & (x < self.shape[0]) &
+                  (y >= 0) & (y < self.shape[1]))
+        index = np.ravel_multi_index((x[inside], y[inside]), self.shape)
+        counts = np.bincount(index, minlength=self.image.size)
+        with self.lock:
+            self.image += counts.reshape(self.shape)
+
+    def take(self):
+        """ Copy of the super-resolution image, reused by the next take."""
+        with self.lock:
+            self.out[:] = self.image
+        return self.out
+
+    def molecules(self):
+        if len(self.table) > 0:
+            return np.concatenate(self.table)
+        else:
+            return np.zeros(0, dtype=self.max_args[1])
+
+    def close(self, filename=None):
+        """ Waits for the pending batches and saves the table in filename."""
+        try:
+            self.collect(wait=True)
+        finally:
+            for n, job in self.pending:
+                job.cancel()
+
+        if filename is not None:
+            with hdf.File(filename, 'w') as f:
+                dataset = f.create_dataset(name='molecules',
+                                           data=self.molecules())
+                dataset.attrs['Localized frames'] = self.localized
+                dataset.attrs['Skipped frames'] = self.skipped
+                f.create_dataset(name='image', data=self.image)
+
+
+def stagePosition(stage):
+    """ z position of the focus stage in um."""
+    z = stage.zPosition
+    try:
+        return z.to('um').magnitude
+    except AttributeError:
+        return float(z)
+
+
+def stageMoving(stage):
+    """ Motion status reported by the focus stage, through zMoving or the
+    moving Feat of the Prior driver, of the stage or of its zobject. None if
+    the stage doesn't report it."""
+    for obj in (stage, getattr(stage, 'zobject', None)):
+        for name in ('zMoving', 'moving'):
+            moving = getattr(obj, name, None)
+            if moving is not None:
+                return bool(moving)
+    return None
+
+
+def waitSettled(stage, target=None, tolerance=0.005, timeout=2, period=0.005,
+                reads=3):
+    """ Waits for the focus stage to stop at target (um). A stage with some
+    command latency can still be at the previous position, so the position
+    has to get within tolerance (um) of target first. Then stages reporting
+    their motion are polled until they stop, the others until reads
+    consecutive positions agree within tolerance. Without target, only the
+    second condition is checked. Returns the position in um."""
+
+    t0 = time.time()
+    last = []
+    while time.time() - t0 < timeout:
+        position = stagePosition(stage)
+        if target is None or abs(position - target) <= tolerance:
+            moving = stageMoving(stage)
+            if moving is False:
+                return position
+            last = (last + [position])[-reads:]
+            if (moving is None and len(last) == reads and
+                    max(last) - min(last) <= tolerance):
+                return position
+        else:
+            last = []
+        time.sleep(period)
+
+    raise TimeoutError("The focus stage didn't settle in "
+                       "{} s".format(timeout))
+
+
+def waitFrames(camera, last, timeout=5, period=0.002):
+    """ Waits until the camera acquired image last (1-based)."""
+    t0 = time.time()
+    while camera.n_images_acquired < last:
+        if time.time() - t0 > timeout:
+            raise TimeoutError('The camera acquired no images in '
+                               '{} s'.format(timeout))
+        time.sleep(period)
+
+
+def acquireZStack(camera, stage, steps, step, filename, frameShape,
+                  nFrames=8, umxpx=None, move=None, start=None,
+                  tolerance=0.005):
+    """ Acquires a stack of steps planes step apart, a length Quantity,
+    starting one step above start, while the camera runs until aborted.
+    start is the position (um) the stage was sent to, by default the one it
+    settles at. After each move the stage is left to settle at the plane
+    within tolerance (um), see waitSettled, and the first image after that,
+    that could have been exposed during the motion, is dropped. The next
+    nFrames images are read from the camera buffer and averaged into a
+    float32 plane, that's written to the TIFF file filename right away, so
+    the stack never has to fit in memory. The stage is moved with move(dz),
+    stage.zMoveRelative by default, and the z positions of the planes are
+    saved with the other attrs in the metadata file. Returns the
+    positions."""
+
+    if move is None:
+        move = stage.zMoveRelative
+    if start is None:
+        start = waitSettled(stage, tolerance=tolerance)
+    stepUm = step.to('um').magnitude
+    buffer = np.empty((nFrames,) + tuple(frameShape), dtype=np.uint16)
+    positions = []
+
+    # Planes are float32, twice the size of the frames needsBigTiff expects
+    shape = (2*steps,) + tuple(frameShape)
+    with tiffWriter(filename, shape) as tw:
+        for s in range(steps):
+            move(step)
+            target = start + (s + 1)*stepUm
+            positions.append(waitSettled(stage, target, tolerance))
+            first = camera.n_images_acquired + 2
+            last = first + nFrames - 1
+            waitFrames(camera, last)
+            frames = camera.images16_into(first, last, buffer)
+            plane = frames.mean(0, dtype=np.float32)
+            writeTiff(tw, plane[::-1], umxpx, photometric='minisblack',
+                      contiguous=True)
+
+    metaName = os.path.splitext(filename)[0] + '_metadata.hdf5'
+    attrs = [('Step [um]', stepUm),
+             ('Frames per plane', nFrames),
+             ('z positions [um]', np.array(positions))]
+    if umxpx is not None:
+        attrs.append(('Pixel size [um]', umxpx))
+    saveMetadata(metaName, attrs)
+
+    return positions
+
+
+def benchmarkFrames(frameShape, n=16):
+    """ Frames that compress like the camera data: background with shot
+    noise and a few bright spots."""
+
+    rng = np.random.RandomState(0)
+    frames = rng.poisson(100, (n,) + tuple(frameShape)).astype(np.uint16)
+    for frame in frames:
+        x = rng.randint(0, frameShape[0], 20)
+        y = rng.randint(0, frameShape[1], 20)
+        frame[x, y] += rng.randint(200, 2000, 20).astype(np.uint16)
+    return frames
+
+
+def syncFile(filename):
+    """ Waits until the data of filename is on the disk."""
+    with open(filename, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def dropFromCache(filename):
+    """ Asks the OS to drop filename, already synced to the disk, from its
+    page cache, so it's read back from the disk. Returns False where it's
+    not possible, like on Windows."""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    with open(filename, 'rb') as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return True
+
+
+def benchmarkHDF5(folder, frameShape, settings, nframes=256, batch=8,
+                  readFrames=32):
+    """ Measures the sustained write and read speeds for each (chunkFrames,
+    compression) in settings. Frames are written in batches of batch
+    frames, like during a recording, and the time includes syncing the file
+    to the disk, so the OS cache doesn't hide a slow disk. They're read
+    back in ranges of readFrames frames, like the analysis slices the
+    imageData of a Stack, after dropping the file from the cache when the
+    OS allows it. Returns a list of (chunkFrames, compression, write MB/s,
+    read MB/s, compression ratio, whether the reads came from the cache).
+    """
+
+    frames = benchmarkFrames(frameShape)
+    shape = (nframes,) + tuple(frameShape)
+    mb = np.prod(shape) * 2 / 2**20
+    filename = os.path.join(folder, 'tormenta_benchmark.hdf5')
+
+    results = []
+    try:
+        for chunkFrames, compression in settings:
+            t0 = time.time()
+            store = HDF5Store(filename, 'data', shape, chunkFrames,
+                              compression)
+            for i in range(0, nframes, batch):
+                k = np.arange(i, min(i + batch, nframes)) % len(frames)
+                store.write(i, frames[k])
+            store.close(nframes, [])
+            syncFile(filename)
+            tWrite = time.time() - t0
+
+            cached = not(dropFromCache(filename))
+            t0 = time.time()
+            with hdf.File(filename, 'r') as f:
+                data = f['data']
+                for i in range(0, nframes, readFrames):
+                    data[i:i + readFrames]
+            tRead = time.time() - t0
+
+            ratio = mb * 2**20 / os.path.getsize(filename)
+            results.append((chunkFrames, compression, mb / tWrite,
+                            mb / tRead, ratio, cached))
+            os.remove(filename)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    return results
@@ -12,8 +12,8 @@ import os
 import datetime
 import time
 import re
+import queue
 from tkinter import Tk, filedialog, messagebox
-import h5py as hdf
 import tifffile as tiff     # http://www.lfd.uci.edu/~gohlke/pythonlibs/#vlfd
 from lantz import Q_
 
@@ -26,6 +26,7 @@ from pyqtgraph.console import ConsoleWidget
 # tormenta imports
 from tormenta.control.filter_table import FilterTable
 import tormenta.utils as utils
+import tormenta.workers as workers
 import tormenta.control.lasercontrol as lasercontrol
 import tormenta.control.focus as focus
 import tormenta.control.molecules_counter as moleculesCounter
@@ -33,7 +34,11 @@ import tormenta.control.ontime as ontime
 import tormenta.control.guitools as guitools
 import tormenta.control.pyqtsubclasses as pyqtsub
 import tormenta.control.viewbox_tools as viewbox_tools
+import tormenta.control.acquisition as acquisition
 import tormenta.analysis.registration as reg
+import tormenta.analysis.fiducials as fiducials
+import tormenta.analysis.stack as stack
+import tormenta.analysis.tools as tools
 
 
 class RecordingWidget(QtGui.QFrame):
@@ -54,12 +59,22 @@ class RecordingWidget(QtGui.QFrame):
 
         self.Hname = None
         self.H = None
+        self.transformer = None
         self.corrShape = None
         self.cropShape = None
         self.xlim = None
         self.ylim = None
         self.shape = self.main.shape
 
+        # Snaps are saved in the background
+        self.snapWriter = SnapWriter()
+        self.snapWriter.sigSaved.connect(self.snapSaved)
+        self.snapWriter.sigFailed.connect(self.snapFailed)
+        self.snapThread = QtCore.QThread(self)
+        self.snapWriter.moveToThread(self.snapThread)
+        self.snapThread.started.connect(self.snapWriter.run)
+        self.snapThread.start()
+
         # Title
         recTitle = QtGui.QLabel('<h2><strong>Recording</strong></h2>')
         recTitle.setTextFormat(QtCore.Qt.RichText)
@@ -98,7 +113,46 @@ class RecordingWidget(QtGui.QFrame):
         self.recFormat = QtGui.QComboBox(self)
         self.recFormat.addItem('tiff')
         self.recFormat.addItem('hdf5')
-        self.recFormat.setFixedWidth(50)
+        self.recFormat.addItem('tiff-mmap')
+        self.recFormat.addItem('raw')
+        self.recFormat.setToolTip('tiff-mmap: preallocated tiff file, '
+                                  'written through a memory map\n'
+                                  'raw: plain frame stream, converted to '
+                                  'hdf5 in the background afterwards')
+        self.recFormat.setFixedWidth(75)
+
+        # HDF5 layout: frames per chunk and lossless compression
+        self.chunkEdit = QtGui.QLineEdit('1')
+        self.chunkEdit.setFixedWidth(30)
+        self.chunkEdit.setToolTip('Frames per HDF5 chunk')
+        self.compression = QtGui.QComboBox(self)
+        self.compression.addItems([str(c) for c in acquisition.compressions])
+        self.compression.setToolTip('HDF5 lossless compression')
+        self.benchButton = QtGui.QPushButton('Benchmark')
+        self.benchButton.setToolTip('Measure the HDF5 writing speed of each '
+                                    'layout against the camera data rate')
+        self.benchButton.clicked.connect(self.benchmark)
+
+        # Live preview during the recording
+        self.previewRateEdit = QtGui.QLineEdit('10')
+        self.previewRateEdit.setFixedWidth(30)
+        self.previewRateEdit.setToolTip('Maximum preview refresh rate (Hz)')
+        self.previewMode = QtGui.QComboBox(self)
+        self.previewMode.addItems(['Full', 'Bin 2', 'Bin 4', 'Decimate 2',
+                                   'Decimate 4'])
+        self.previewMode.setToolTip('Preview reduction during the recording')
+
+        # Fiducial drift tracking during the recording
+        self.driftBox = QtGui.QCheckBox('Track drift')
+        self.driftBox.setToolTip('Track the brightest emitters in the field '
+                                 'of view and save their drift trace')
+
+        # On-line localization and super-resolution preview
+        self.localizeBox = QtGui.QCheckBox('Localize')
+        self.localizeBox.setToolTip('Localize the molecules during the '
+                                    'recording and show the super-resolution '
+                                    'image. Frames are skipped if the '
+                                    'localization falls behind.')
 
         # Number of frames and measurement timing
         self.currentFrame = QtGui.QLabel('0 /')
@@ -145,10 +199,19 @@ class RecordingWidget(QtGui.QFrame):
         recGrid.addWidget(self.tRemaining, 5, 3, 2, 2)
         recGrid.addWidget(QtGui.QLabel('File size'), 6, 0)
         recGrid.addWidget(self.fileSizeLabel, 6, 2)
-        recGrid.addWidget(buttonWidget, 7, 0, 1, 5)
+        recGrid.addWidget(self.driftBox, 6, 3, 1, 2)
+        recGrid.addWidget(QtGui.QLabel('HDF5 chunk'), 7, 0)
+        recGrid.addWidget(self.chunkEdit, 7, 1)
+        recGrid.addWidget(self.compression, 7, 2)
+        recGrid.addWidget(self.benchButton, 7, 3, 1, 2)
+        recGrid.addWidget(QtGui.QLabel('Preview (Hz)'), 8, 0)
+        recGrid.addWidget(self.previewRateEdit, 8, 1)
+        recGrid.addWidget(self.previewMode, 8, 2)
+        recGrid.addWidget(self.localizeBox, 8, 3, 1, 2)
+        recGrid.addWidget(buttonWidget, 9, 0, 1, 5)
 
         recGrid.setColumnMinimumWidth(0, 70)
-        recGrid.setRowMinimumHeight(7, 40)
+        recGrid.setRowMinimumHeight(9, 40)
 
         self.writable = True
         self.readyToRecord = False
@@ -174,8 +237,55 @@ class RecordingWidget(QtGui.QFrame):
         self.filenameEdit.setEnabled(value)
         self.numExpositionsEdit.setEnabled(value)
         self.recFormat.setEditable(value)
+        self.driftBox.setEnabled(value)
+        self.localizeBox.setEnabled(value)
+        self.chunkEdit.setEnabled(value)
+        self.compression.setEnabled(value)
+        self.benchButton.setEnabled(value)
+        self.previewRateEdit.setEnabled(value)
+        self.previewMode.setEnabled(value)
         self._writable = value
 
+    def previewOptions(self):
+        """ Returns (maximum rate, binning, decimate) for the preview."""
+        try:
+            rate = max(0.1, float(self.previewRateEdit.text()))
+        except ValueError:
+            rate = 10
+        mode = self.previewMode.currentText().split(' ')
+        binning = 1 if len(mode) == 1 else int(mode[1])
+        return rate, binning, mode[0] == 'Decimate'
+
+    def hdf5Options(self):
+        """ Returns (chunkFrames, compression) for the hdf5 recordings."""
+        try:
+            chunkFrames = max(1, int(self.chunkEdit.text()))
+        except ValueError:
+            chunkFrames = 1
+        compression = acquisition.compressions[
+            self.compression.currentIndex()]
+        return chunkFrames, compression
+
+    def benchmark(self):
+        folder = self.folderEdit.text()
+        if not(os.path.exists(folder)):
+            self.folderWarning()
+            return
+
+        chunks = sorted(set([1, 4, 16, self.hdf5Options()[0]]))
+        settings = [(c, z) for c in chunks for z in acquisition.compressions]
+        frameShape = (self.main.shape[0], self.main.shape[1])
+        cameraRate = 2*np.prod(frameShape) / 2**20
+        cameraRate /= self.main.t_acc_real.magnitude
+
+        self.benchWorker = BenchmarkWorker(folder, frameShape, settings,
+                                           cameraRate)
+        self.benchThread = QtCore.QThread(self)
+        self.benchWorker.moveToThread(self.benchThread)
+        self.benchWorker.finished.connect(self.benchThread.quit)
+        self.benchThread.started.connect(self.benchWorker.run)
+        self.benchThread.start()
+
     def n(self):
         text = self.numExpositionsEdit.text()
         if text == '':
@@ -243,78 +353,54 @@ class RecordingWidget(QtGui.QFrame):
         return attrs
 
     def loadH(self):
-        self.Hname = utils.getFilename('Load affine matrix',
-                                       [('Numpy arrays', '.npy')],
+        self.Hname = utils.getFilename('Load channel registration',
+                                       [('Numpy arrays', '.npy'),
+                                        ('Warps', '.npz')],
                                        self.folderEdit.text())
-        self.H = np.load(self.Hname)
+        self.H = reg.load_registration(self.Hname)
         chShape = (self.main.side, self.main.shape[1])
         print(chShape)
-        output = reg.get_affine_shapes(chShape, self.H)
+        output = reg.get_affine_shapes(chShape, self.H, self.Hname)
         self.xlim, self.ylim, self.cropShape = output
+        self.transformer = reg.make_transformer(self.H, chShape)
 
     def snap(self):
-
-        folder = self.folderEdit.text()
-        if os.path.exists(folder):
-
-            image = self.main.andor.most_recent_image16(self.main.shape)
-            time.sleep(0.01)
-
-            dim = (self.main.umxpx * np.array(self.main.shape)).astype(np.int)
-            sh = str(dim[0]) + 'x' + str(dim[1])
-            rootname = os.path.join(folder, self.filenameEdit.text()) + '_wf'
-            savename = rootname + sh + '.tif'
-            savename = guitools.getUniqueName(savename)
-            image = np.flipud(image.astype(np.uint16))
-            tiff.imsave(savename, image, software='Tormenta', imagej=True,
-                        resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                        metadata={'spacing': 1, 'unit': 'um'})
-            guitools.attrsToTxt(os.path.splitext(savename)[0], self.getAttrs())
-
-            # Two-color-corrected snap saving
-            imageFramePar = self.main.tree.p.param('Field of view')
-            shapeStr = imageFramePar.param('Shape').value()
-            twoColors = shapeStr.startswith('Two-colors')
-            if twoColors and (self.H is not None):
-                side = int(shapeStr.split()[1][:-2])
-
-                # Corrected image
-                im0 = image[:side, :]
-                im1 = reg.h_affine_transform(image[-side:, :], self.H)
-
-                dim = (self.main.umxpx * np.array(im0.shape)).astype(np.int)
-                sh = str(dim[0]) + 'x' + str(dim[1])
-                corrName = rootname + sh + '.tif'
-                tiff.imsave(utils.insertSuffix(corrName, '_corrected_ch0'),
-                            im0, software='Tormenta', imagej=True,
-                            resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                            metadata={'spacing': 1, 'unit': 'um'})
-
-                tiff.imsave(utils.insertSuffix(corrName, '_corrected_ch1'),
-                            im1, software='Tormenta', imagej=True,
-                            resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                            metadata={'spacing': 1, 'unit': 'um'})
-
-                # Corrected and cropped image
-                crop2chShape = (2*self.cropShape[0], self.cropShape[1])
-                im0c = im0[self.xlim[0]:self.xlim[1],
-                           self.ylim[0]:self.ylim[1]]
-                im1c = im1[self.xlim[0]:self.xlim[1],
-                           self.ylim[0]:self.ylim[1]]
-
-                dim = (self.main.umxpx * np.array(crop2chShape)).astype(np.int)
-                sh = str(dim[0]) + 'x' + str(dim[1])
-                cropName = rootname + sh + '.tif'
-                ch0Name = utils.insertSuffix(cropName, '_corrected_crop_ch0')
-                tiff.imsave(ch0Name, im0c, software='Tormenta', imagej=True,
-                            resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                            metadata={'spacing': 1, 'unit': 'um'})
-                ch1Name = utils.insertSuffix(cropName, '_corrected_crop_ch1')
-                tiff.imsave(ch1Name, im1c, software='Tormenta', imagej=True,
-                            resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                            metadata={'spacing': 1, 'unit': 'um'})
-        else:
+        """ Reads the most recent camera frame and queues it to be saved by
+        the snap writer. The liveview is stopped during the recordings, so
+        the frame on screen can be old."""
+
+        andor = self.main.andor
+        frame = andor.n_images_acquired
+        image = andor.most_recent_image16_into(
+            self.snapWriter.buffer(tuple(self.main.shape)))
+
+        # Two-color-corrected snaps are saved too
+        imageFramePar = self.main.tree.p.param('Field of view')
+        shapeStr = imageFramePar.param('Shape').value()
+        side = None
+        if shapeStr.startswith('Two-colors') and (self.H is not None):
+            side = int(shapeStr.split()[1][:-2])
+
+        job = {'folder': self.folderEdit.text(),
+               'filename': self.filenameEdit.text(),
+               'frame': frame, 'image': image,
+               'umxpx': self.main.umxpx, 'attrs': self.getAttrs(),
+               'side': side, 'transformer': self.transformer,
+               'cropShape': self.cropShape, 'xlim': self.xlim,
+               'ylim': self.ylim}
+        self.snapWriter.put(job)
+
+    def snapSaved(self, names):
+        self.main.statusBar().showMessage('Saved ' + ', '.join(
+            os.path.basename(name) for name in names), 5000)
+
+    def snapFailed(self, message):
+        if message == "Folder doesn't exist":
             self.folderWarning()
+        else:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' Snap failed: ' +
+                  message)
+            self.main.statusBar().showMessage('Snap failed: ' + message, 5000)
 
     def folderWarning(self):
         root = Tk()
@@ -322,35 +408,50 @@ class RecordingWidget(QtGui.QFrame):
         messagebox.showwarning(title='Warning', message="Folder doesn't exist")
         root.destroy()
 
-    def tiffWarning(self):
-        root = Tk()
-        root.withdraw()
-        message = "Tiff format size limit is 2GB"
-        messagebox.showwarning(title='Warning', message=message)
-        root.destroy()
+    def updateGUI(self):
+
+        # Preview frames can be binned, k is the size of their pixels
+        image, index = self.worker.preview.take()
+        k = self.worker.preview.binning
 
-    def updateGUI(self, image):
+        # Levels and histograms are updated at a lower rate
+        levels = self.main.histogramDue()
 
         if self.main.dualView:
-            im1 = np.transpose(image[:self.main.side, :])
-            self.main.hist1.setLevels(*guitools.bestLimits(im1))
-            im0 = np.transpose(image[-self.main.side:, :])
-            self.main.hist.setLevels(*guitools.bestLimits(im0))
+            side = self.main.side // k
+            im1 = image[:side, :]
+            self.main.img1.setImage(im1, autoLevels=False)
+            self.main.img1.setScale(k)
+            im0 = image[-side:, :]
+            self.main.img.setImage(im0, autoLevels=False)
+            self.main.img.setScale(k)
+            if levels:
+                self.main.hist1.setLevels(
+                    *guitools.bestLimits(guitools.subsampled(im1)))
+                self.main.hist.setLevels(
+                    *guitools.bestLimits(guitools.subsampled(im0)))
 
         else:
             self.main.img.setImage(image, autoLevels=False)
+            self.main.img.setScale(k)
 
-            if self.main.moleculeWidget.enabled:
-                self.main.moleculeWidget.graph.update(image)
+            # The counter works on full resolution frames only
+            if self.main.moleculeWidget.enabled and k == 1:
+                self.main.moleculeWidget.offer(image)
 
             if self.main.crosshair.showed:
-                    ycoord = int(np.round(self.crosshair.hLine.pos()[1]))
-                    xcoord = int(np.round(self.crosshair.vLine.pos()[0]))
-                    self.xProfile.setData(image[:, ycoord])
-                    self.yProfile.setData(image[xcoord])
+                    crosshair = self.main.crosshair
+                    ycoord = int(np.round(crosshair.hLine.pos()[1])) // k
+                    xcoord = int(np.round(crosshair.vLine.pos()[0])) // k
+                    self.main.xProfile.setData(image[:, ycoord])
+                    self.main.yProfile.setData(image[xcoord])
 
-        # fps calculation
+        if levels:
+            self.main.updateHistograms()
+
+        # fps calculation and recording performance
         self.main.fpsMath()
+        self.main.recStatus.setText(self.worker.status())
 
         # Elapsed and remaining times and frames
         eSecs = np.round(ptime.time() - self.startTime)
@@ -394,10 +495,6 @@ class RecordingWidget(QtGui.QFrame):
                 self.folderWarning()
                 self.recButton.setChecked(False)
 
-            elif guitools.fileSizeGB(shape) > 2 and recFormat == 'tiff':
-                self.tiffWarning()
-                self.recButton.setChecked(False)
-
             else:
                 self.writable = False
                 self.readyToRecord = False
@@ -414,13 +511,27 @@ class RecordingWidget(QtGui.QFrame):
                 shapeStr = imageFramePar.param('Shape').value()
                 twoColors = shapeStr.startswith('Two-colors')
                 twoColors = twoColors and (self.H is not None)
+
+                # Fiducials are taken from the last liveview frame, flipped
+                # like the recorded frames
+                tracker = None
+                if self.driftBox.isChecked():
+                    image = np.flipud(self.main.image)
+                    positions = fiducials.fiducials_from_frames(image)
+                    tracker = fiducials.FiducialTracker(positions)
+
                 self.worker = RecWorker(self.main.andor, self.main.umxpx,
                                         shape, self.main.t_exp_real, self.name,
                                         recFormat, self.dataname,
                                         self.getAttrs(), twoColors, self.H,
                                         self.cropShape, self.xlim, self.ylim,
-                                        self.main.side)
+                                        self.main.side, tracker,
+                                        self.hdf5Options(),
+                                        self.previewOptions(),
+                                        self.localizeBox.isChecked())
                 self.worker.sigUpdate.connect(self.updateGUI)
+                if self.worker.localizer is not None:
+                    self.showLocalizations()
                 self.recordingThread = QtCore.QThread(self)
                 self.worker.moveToThread(self.recordingThread)
                 self.worker.sigDone.connect(self.endRecording)
@@ -435,8 +546,32 @@ class RecordingWidget(QtGui.QFrame):
         else:
             self.worker.pressed = False
 
+    def showLocalizations(self):
+        """ Window with the super-resolution image of the on-line
+        localization, refreshed once a second during the recording."""
+        self.srView = pg.ImageView(
+            imageItem=pg.ImageItem(axisOrder='row-major'))
+        self.srView.setWindowTitle('Super-resolution preview')
+        self.srView.resize(600, 600)
+        self.srView.show()
+        self.srTimer = QtCore.QTimer()
+        self.srTimer.timeout.connect(self.updateLocalizations)
+        self.srTimer.start(1000)
+
+    def updateLocalizations(self):
+        localizer = self.worker.localizer
+        self.srView.setImage(localizer.take(), autoRange=False,
+                             autoLevels=True, autoHistogramRange=False)
+        self.srView.setWindowTitle(
+            'Super-resolution preview: {} frames localized, {} skipped'.format(
+                localizer.localized, localizer.skipped))
+
     def endRecording(self):
 
+        if self.worker.localizer is not None:
+            self.srTimer.stop()
+            self.updateLocalizations()
+
         # Attenuate excitation x1000, turn blue laser off
         if self.main.flipAfter.isChecked():
             self.main.flipperInPath(True)
@@ -446,16 +581,24 @@ class RecordingWidget(QtGui.QFrame):
         if self.main.focusWidget.focusDataBox.isChecked():
             self.main.focusWidget.exportData()
         else:
-            self.main.focusWidget.graph.savedDataSignal = []
+            self.main.focusWidget.graph.savedData.clear()
             self.main.focusWidget.graph.mean = 0
             self.main.focusWidget.n = 1
             self.main.focusWidget.max_dev = 0
 
-        def converterFunction():
-            return pyqtsub.TiffConverterThread(self.savename)
+        # Raw recordings are converted to hdf5 once the acquisition is over
+        if self.worker.recFormat == 'raw':
+            chunkFrames, compression = self.worker.hdf5Options
+            self.rawConverter = acquisition.RawConverter(
+                self.worker.filenames, dataname=self.dataname,
+                chunkFrames=chunkFrames, compression=compression)
+            self.rawConverter.start()
 
-        self.main.exportlastAction.triggered.connect(converterFunction)
-        self.main.exportlastAction.setEnabled(True)
+        # Raw recordings are exported once converted to hdf5
+        if self.worker.recFormat in ['hdf5', 'raw']:
+            self.main.lastRecording = [os.path.splitext(f)[0] + '.hdf5'
+                                       for f in self.worker.filenames]
+            self.main.exportlastAction.setEnabled(True)
 
         self.writable = True
         self.readyToRecord = True
@@ -463,6 +606,9 @@ class RecordingWidget(QtGui.QFrame):
         self.recButton.setChecked(False)
         self.main.tree.writable = True
         self.main.liveviewButton.setEnabled(True)
+        self.main.img.setScale(1)
+        if self.main.dualView:
+            self.main.img1.setScale(1)
         self.main.liveviewStart(update=False)
         self.main.laserWidgets.worker.sigDone.disconnect()
         for c in self.main.laserWidgets.controls:
@@ -480,7 +626,8 @@ class RecWorker(QtCore.QObject):
     :param shape: size of recording data in (number of frames, width, heigth)
     :param t_exp: Camera's configured exposition time for this measurement
     :param savename: chosen filename for the recording data
-    :param fileformat: format for the recording data. Either 'tiff' or 'hdf5'
+    :param fileformat: format for the recording data. Either 'tiff', 'hdf5',
+    'tiff-mmap' or 'raw'
     :param dataname: array name
     :param attrs: data attributes for storing of system's configuration
     :param twoColors: (bool) whether the recording is a twoColors measurement
@@ -491,22 +638,47 @@ class RecWorker(QtCore.QObject):
     :param ylim: (tuple) y coordinate of the area to be saved of one of the
     channels relative to the whole area of the channel
     :param side: y size of each channel
-
+    :param tracker: optional
+    :class:`FiducialTracker <tormenta.analysis.fiducials.FiducialTracker>`
+    fed with every recorded frame. The drift trace is saved with the data.
+    :param hdf5Options: (frames per chunk, compression) of the hdf5 datasets,
+    see :func:`datasetOptions <tormenta.control.acquisition.datasetOptions>`
+    :param previewOptions: (maximum rate, binning, decimate) of the preview,
+    see :class:`Preview <tormenta.control.acquisition.Preview>`
+    :param localize: (bool) whether to localize the molecules during the
+    recording, see
+    :class:`OnlineLocalizer <tormenta.control.acquisition.OnlineLocalizer>`.
+    The localizations are saved in <savename>_online_locs.hdf5.
+
+    The camera is read in the recording thread into a
+    :class:`FrameRing <tormenta.control.acquisition.FrameRing>` of ringMB
+    megabytes. Raw and corrected data are written, and the drift tracked,
+    each in its own thread, as well as the on-line localization. Their queue
+    depths are available through ring.stats() and the high-water marks are
+    saved with the attributes.
+
+    The readout keeps the camera lag (frames acquired but not read yet), the
+    frames lost in the camera buffer and the time per frame spent in the
+    readout, the preview, the buffer and each consumer, see
+    :class:`Timings <tormenta.control.acquisition.Timings>`. They're shown
+    in the status bar through status() and saved with the attributes.
 
     ============================== ===========================================
     **Signals:**
-    sigUpdate(self, array)         Emitted when there is new data to be
-                                   displayed in the image view.
+    sigUpdate(self)                Emitted when there is a new preview to
+                                   be displayed in the image view.
     sigDone(self)                  Emitted when the measurement is over.
     ============================== ===========================================
     """
 
-    sigUpdate = QtCore.pyqtSignal(np.ndarray)
+    sigUpdate = QtCore.pyqtSignal()
     sigDone = QtCore.pyqtSignal()
 
     def __init__(self, andor, umPerPx, shape, t_exp, savename, fileformat,
                  dataname, attrs, twoColors, H, cropShape, xlim, ylim, side,
-                 *args, **kwargs):
+                 tracker=None, hdf5Options=(1, None),
+                 previewOptions=(10, 1, False), localize=False, *args,
+                 **kwargs):
         super().__init__(*args, **kwargs)
 
         self.andor = andor
@@ -532,6 +704,38 @@ class RecWorker(QtCore.QObject):
         self.xlim = xlim
         self.ylim = ylim
 
+        self.tracker = tracker
+        if self.tracker is not None:
+            self.tracker.reset()
+        self.hdf5Options = hdf5Options
+        self.chunkFrames, self.compression = hdf5Options
+        self.preview = acquisition.Preview(self.frameShape, *previewOptions,
+                                           notify=self.sigUpdate.emit)
+
+        self.localizer = None
+        if localize:
+            fwhm = tools.get_fwhm(670, 1.42) / (1000*self.umxpx)
+            self.localizer = acquisition.OnlineLocalizer(self.frameShape,
+                                                         fwhm)
+
+        # Size of the buffer between the camera readout and the writers
+        self.ringMB = 512
+
+        # Frames are read from the camera into a preallocated buffer and
+        # copied only once, into the ring buffer
+        self.readBuffer = np.zeros((16,) + self.frameShape, dtype=np.uint16)
+
+    def trackDrift(self, frames):
+        if self.tracker is not None:
+            for frame in frames:
+                self.tracker.update(frame)
+
+    def saveDrift(self, h5file):
+        if self.tracker is not None:
+            h5file.create_dataset(name='drift', data=self.tracker.drift())
+            h5file.create_dataset(name='fiducials',
+                                  data=self.tracker.positions)
+
     def start(self):
 
         # Acquisition preparation
@@ -540,8 +744,15 @@ class RecWorker(QtCore.QObject):
         else:
             self.andor.shutter(0, 1, 0, 0, 0)
 
-        # Frame counter
+        # Frame counter, and readout time, camera frame number and frames
+        # lost before being read, see FrameLog
         self.j = 0
+        self.frameLog = acquisition.FrameLog(self.n)
+
+        # Frames waiting in the camera
+        self.lag = 0
+        self.maxLag = 0
+        self.timings = acquisition.Timings()
 
         self.andor.free_int_mem()
         self.andor.acquisition_mode = 'Kinetics'
@@ -549,192 +760,335 @@ class RecWorker(QtCore.QObject):
         self.andor.start_acquisition()
         time.sleep(np.min((5 * self.t_exp.magnitude, 1)))
 
-        self.savename = (self.savename + '.' + self.recFormat)
+        ext = self.recFormat.replace('-mmap', '')
+        self.savename = (self.savename + '.' + ext)
         self.savename = guitools.getUniqueName(self.savename)
 
-        if self.recFormat == 'tiff':
+        # Readout, writing and processing run in different threads connected
+        # by the ring buffer, so a slow disk doesn't delay the readout
+        frameBytes = np.prod(self.frameShape) * 2
+        capacity = int(np.clip(self.ringMB * 2**20 // frameBytes, 16, self.n))
+        self.ring = acquisition.FrameRing(capacity, self.frameShape)
+
+        stores = self.makeStores()
+        consumers = [acquisition.RingConsumer(self.ring, store.write, name,
+                                              timings=self.timings)
+                     for name, store, extra in stores]
+        if self.tracker is not None:
+            consumers.append(acquisition.RingConsumer(
+                self.ring, lambda start, frames: self.trackDrift(frames),
+                'drift', timings=self.timings))
+        if self.localizer is not None:
+            consumers.append(acquisition.RingConsumer(
+                self.ring, self.localizer.write, 'localization',
+                timings=self.timings))
+        for consumer in consumers:
+            consumer.start()
 
-            self.tags = [('resolution_unit', 'H', 1, 3, True)]
-            self.resolution = (1/self.umxpx, 1/self.umxpx)
+        try:
+            self.readout()
+        finally:
+            self.ring.close()
+            for consumer in consumers:
+                consumer.join()
+                if consumer.error is not None:
+                    print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                          ' Recording ' + consumer.name + ' failed: ' +
+                          repr(consumer.error))
+
+            stats = self.ring.stats()
+            attrs = self.attrs + [('Ring buffer capacity', capacity)]
+            attrs += [(name + ' high-water mark', stats[name][1])
+                      for name in stats]
+            attrs += [('Camera maximum lag', self.maxLag),
+                      ('Lost frames', self.lost)]
+            attrs += self.timings.attrs()
+            if self.lost > 0:
+                print(time.strftime("%Y-%m-%d %H:%M:%S") + ' ' +
+                      str(self.lost) + ' frames were lost during the '
+                      'recording')
+            # Each file gets the frames its consumer actually wrote
+            for (name, store, extra), consumer in zip(stores, consumers):
+                storeAttrs = attrs
+                if consumer.error is not None:
+                    storeAttrs = attrs + [('Recording error',
+                                           repr(consumer.error))]
+                store.close(consumer.frames, storeAttrs, extra)
+            if self.localizer is not None:
+                base = os.path.splitext(self.savename)[0]
+                self.localizer.close(base + '_online_locs.hdf5')
 
-            if not(self.twoColors):
-                self.singleColorTIFF()
+        self.sigDone.emit()
+
+    def makeStores(self):
+        """ Returns (name, store, extra) for the raw data and, in two-color
+        recordings, for the corrected data. extra saves the drift or the
+        registration with the attributes."""
+
+        raw = self.savename
+        corrected = utils.insertSuffix(self.savename, '_corrected')
+
+        if self.recFormat in ['tiff', 'tiff-mmap']:
+            if self.recFormat == 'tiff':
+                TiffStore = acquisition.TiffStore
             else:
-                self.twoColorTIFF()
+                TiffStore = acquisition.TiffMemmapStore
+            metaName = os.path.splitext(raw)[0] + '_metadata.hdf5'
+            rawStore = TiffStore(raw, self.umxpx, self.shape, metaName)
+            if self.twoColors:
+                corrMetaName = utils.insertSuffix(metaName, '_corrected')
+                corrStore = TiffStore(corrected, self.umxpx, self.corrShape,
+                                      corrMetaName)
+
+        elif self.recFormat == 'raw':
+            rawStore = acquisition.RawStore(
+                raw, self.shape, timestamps=self.frameLog.timestamps,
+                frameNumbers=self.frameLog.frameNumbers)
+            if self.twoColors:
+                corrStore = acquisition.RawStore(corrected, self.corrShape)
 
         elif self.recFormat == 'hdf5':
-            if not(self.twoColors):
-                self.singleColorHDF5()
-            else:
-                self.twoColorHDF5()
+            options = (self.chunkFrames, self.compression)
+            rawStore = acquisition.HDF5Store(raw, self.dataname, self.shape,
+                                             *options)
+            if self.twoColors:
+                corrStore = acquisition.HDF5Store(corrected, self.dataname,
+                                                  self.corrShape, *options)
+
+        self.filenames = [raw]
+        stores = [('raw', rawStore, self.saveDrift)]
+        if self.twoColors:
+            self.filenames.append(corrected)
+            chShape = (self.side, self.frameShape[1])
+            corrStore = acquisition.CorrectedStore(
+                corrStore, self.H, chShape, self.side, self.xlim, self.ylim)
+            stores.append(('corrected', corrStore,
+                           lambda h5file: reg.store_registration(h5file,
+                                                                 self.H)))
+        return stores
+
+    def readout(self):
+        """ Reads the new frames from the camera into the ring buffer until
+        the measurement is over or it's stopped."""
+
+        while self.j < self.n and self.pressed:
+            time.sleep(self.t_exp.magnitude)
+            acquired = self.andor.n_images_acquired
+            if acquired > self.j:
+
+                # Frames waiting in the camera when we get to read them
+                self.lag = acquired - self.j
+                self.maxLag = max(self.maxLag, self.lag)
+
+                i, j = self.andor.new_images_index
+
+                # New frames are read into readBuffer, in pieces if needed
+                for first in range(i, j + 1, len(self.readBuffer)):
+                    last = min(first + len(self.readBuffer) - 1, j)
+                    self.readFrames(first, last)
+                self.j = j
+
+    def readFrames(self, first, last):
+        """ Reads frames first to last (1-based, inclusive) from the camera
+        and puts them in the ring buffer."""
+
+        t0 = time.perf_counter()
+        newImages = self.andor.images16_into(
+            first, last, self.readBuffer[:last - first + 1])
+        t1 = time.perf_counter()
+        self.frameLog.add(first, last, time.time())
+        self.preview.offer(newImages[-1], last)
+        t2 = time.perf_counter()
+        self.ring.put(newImages[:, ::-1])
+        t3 = time.perf_counter()
+
+        n = len(newImages)
+        self.timings.add('readout', t1 - t0, n)
+        self.timings.add('preview', t2 - t1, n)
+        self.timings.add('buffer', t3 - t2, n)
+
+    @property
+    def lost(self):
+        """ Frames overwritten in the camera buffer before being read."""
+        return self.frameLog.lost
+
+    def status(self):
+        """ Short summary of the recording performance for the status
+        bar."""
+        return ('lag {} / lost {} / readout {:.1f}, write {:.1f} '
+                'ms per frame').format(self.lag, self.lost,
+                                       self.timings.perFrame('readout'),
+                                       self.timings.perFrame('raw'))
 
-        self.sigDone.emit()
 
-    def singleColorTIFF(self):
-
-        with tiff.TiffWriter(self.savename, software='Tormenta') as storeFile:
-
-            while self.j < self.shape[0] and self.pressed:
-                time.sleep(self.t_exp.magnitude)
-                if self.andor.n_images_acquired > self.j:
-                    i, self.j = self.andor.new_images_index
-                    newImages = self.andor.images16(i, self.j, self.frameShape,
-                                                    1, self.n)
-                    self.sigUpdate.emit(np.transpose(newImages[-1]))
-#                    self.sigUpdate.emit(newImages[-1])
-
-                    newData = newImages[:, ::-1].astype(np.uint16)
-
-                    # This is done frame by frame in order to have a
-                    # contiguously saved tiff so it's easily opened in ImageJ
-                    # or in python through tifffile
-                    for frame in newData:
-                        storeFile.save(frame, photometric='minisblack',
-                                       resolution=self.resolution,
-                                       extratags=self.tags)
-
-        # Saving parameters
-        metaName = os.path.splitext(self.savename)[0] + '_metadata.hdf5'
-        with hdf.File(metaName, "w") as metaFile:
-            for item in self.attrs:
-                if item[1] is not None:
-                    metaFile[item[0]] = item[1]
-
-    def twoColorTIFF(self):
-
-        cropName = utils.insertSuffix(self.savename, '_corrected')
-
-        with tiff.TiffWriter(self.savename, software='Tormenta') as storeFile,\
-                tiff.TiffWriter(cropName, software='Tormenta') as cropFile:
-
-            while self.j < self.shape[0] and self.pressed:
-
-                time.sleep(self.t_exp.magnitude)
-                if self.andor.n_images_acquired > self.j:
-                    i, self.j = self.andor.new_images_index
-                    newImages = self.andor.images16(i, self.j, self.frameShape,
-                                                    1, self.n)
-                    self.sigUpdate.emit(np.transpose(newImages[-1]))
-#                    self.sigUpdate.emit(newImages[-1])
-                    newData = newImages[:, ::-1]
-
-                    # This is done frame by frame in order to have contiguously
-                    # saved tiff files so they're correctly opened in ImageJ
-                    # or in python through tifffile
-                    for frame in newData:
-                        # Corrected image
-                        im0 = frame[:self.side, :]
-                        im1 = reg.h_affine_transform(frame[-self.side:, :],
-                                                     self.H)
-
-                        # Corrected and cropped image
-                        im1c = im1[self.xlim[0]:self.xlim[1],
-                                   self.ylim[0]:self.ylim[1]]
-                        im0c = im0[self.xlim[0]:self.xlim[1],
-                                   self.ylim[0]:self.ylim[1]]
-                        imc = np.vstack((im0c, im1c)).astype(np.uint16)
-                        cropFile.save(imc, photometric='minisblack',
-                                      resolution=self.resolution,
-                                      extratags=self.tags)
-
-                        # Raw image
-                        storeFile.save(frame, photometric='minisblack',
-                                       resolution=self.resolution,
-                                       extratags=self.tags)
-
-        # Saving parameters
-        metaName = os.path.splitext(self.savename)[0] + '_metadata.hdf5'
-        corrMetaName = utils.insertSuffix(metaName, '_corrected')
-        with hdf.File(metaName, "w") as metaFile, \
-                hdf.File(corrMetaName, "w") as corrMetaFile:
-            for item in self.attrs:
-                if item[1] is not None:
-                    metaFile[item[0]] = item[1]
-                    corrMetaFile[item[0]] = item[1]
-            corrMetaFile.create_dataset(name='Affine matrix', data=self.H)
-
-    def singleColorHDF5(self):
-
-        with hdf.File(self.savename, "w") as storeFile:
-            storeFile.create_dataset(name=self.dataname, shape=self.shape,
-                                     maxshape=self.shape, dtype=np.uint16)
-            dataset = storeFile[self.dataname]
-
-            while self.j < self.shape[0] and self.pressed:
-
-                time.sleep(self.t_exp.magnitude)
-                if self.andor.n_images_acquired > self.j:
-                    i, self.j = self.andor.new_images_index
-                    newImages = self.andor.images16(i, self.j, self.frameShape,
-                                                    1, self.n)
-                    self.sigUpdate.emit(np.transpose(newImages[-1]))
-#                    self.sigUpdate.emit(newImages[-1])
-                    dataset[i - 1:self.j] = newImages[:, ::-1]
-
-            # Crop dataset if it's stopped before finishing
-            if self.j < self.shape[0]:
-                dataset.resize((self.j, self.shape[1], self.shape[2]))
-
-            # Saving parameters
-            for item in self.attrs:
-                if item[1] is not None:
-                    dataset.attrs[item[0]] = item[1]
-
-    def twoColorHDF5(self):
-
-        cropSavename = utils.insertSuffix(self.savename, '_corrected')
-
-        with hdf.File(self.savename, "w") as storeFile, \
-                hdf.File(cropSavename, "w") as cropStoreFile:
-
-            storeFile.create_dataset(name=self.dataname, shape=self.shape,
-                                     maxshape=self.shape, dtype=np.uint16)
-            dataset = storeFile[self.dataname]
-
-            cropStoreFile.create_dataset(name=self.dataname,
-                                         shape=self.corrShape,
-                                         maxshape=self.corrShape,
-                                         dtype=np.uint16)
-            cropDataset = cropStoreFile[self.dataname]
-
-            while self.j < self.shape[0] and self.pressed:
-
-                time.sleep(self.t_exp.magnitude)
-                if self.andor.n_images_acquired > self.j:
-                    i, self.j = self.andor.new_images_index
-                    newImages = self.andor.images16(i, self.j, self.frameShape,
-                                                    1, self.n)
-                    self.sigUpdate.emit(np.transpose(newImages[-1]))
-#                    self.sigUpdate.emit(newImages[-1])
-                    data = newImages[:, ::-1]
-
-                    # Corrected image
-                    im0 = data[:, :self.side, :]
-                    im1 = np.zeros(data[:, -128:, :].shape)
-                    for k in np.arange(len(im1)):
-                        newData = data[k, -self.side:, :]
-                        im1[k] = reg.h_affine_transform(newData, self.H)
-
-                    # Corrected and cropped image
-                    im0c = im0[:, self.xlim[0]:self.xlim[1],
-                               self.ylim[0]:self.ylim[1]]
-                    im1c = im1[:, self.xlim[0]:self.xlim[1],
-                               self.ylim[0]:self.ylim[1]]
-                    cropDataset[i - 1:self.j, :self.cropShape[0], :] = im0c
-                    cropDataset[i - 1:self.j, self.cropShape[0]:, :] = im1c
-
-            # Crop dataset if it's stopped before finishing
-            if self.j < self.shape[0]:
-                dataset.resize((self.j, self.shape[1], self.shape[2]))
-                newCropShape = (self.j, self.corrShape[1], self.corrShape[2])
-                cropDataset.resize(newCropShape)
-
-            # Saving parameters
-            for item in self.attrs:
-                if item[1] is not None:
-                    dataset.attrs[item[0]] = item[1]
-                    cropDataset.attrs[item[0]] = item[1]
-            cropStoreFile.create_dataset(name='Affine matrix', data=self.H)
+def saveSnapTiff(name, image, umxpx):
+    tiff.imsave(name, image, software='Tormenta', imagej=True,
+                resolution=(1/umxpx, 1/umxpx),
+                metadata={'spacing': 1, 'unit': 'um'})
+
+
+class SnapWriter(QtCore.QObject):
+    """
+    **Bases:** :class:`QtCore.QObject`
+
+    Saves the snaps queued by put in its own thread, so slow disks don't
+    freeze the GUI. Each job is a dict with the frame and everything needed
+    to save it, taken from the GUI when the snap was requested. Pending
+    jobs are saved together and in order, and consecutive snaps of the same
+    camera frame are saved only once. The frames are read into the buffers
+    handed out by buffer, that are reused once their job is done.
+
+    ============================== ===========================================
+    **Signals:**
+    sigSaved(names)                Emitted with the filenames of the snaps
+                                   saved after each burst of requests.
+    sigFailed(message)             Emitted when a snap couldn't be saved.
+    ============================== ===========================================
+    """
+
+    sigSaved = QtCore.pyqtSignal(list)
+    sigFailed = QtCore.pyqtSignal(str)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = queue.Queue()
+        self.free = queue.Queue()
+        self.lastFrame = None
+
+    def buffer(self, shape):
+        """ A uint16 frame of shape to read a snap into."""
+        while True:
+            try:
+                frame = self.free.get_nowait()
+            except queue.Empty:
+                return np.empty(shape, dtype=np.uint16)
+            # Buffers of a previous frame shape are dropped
+            if frame.shape == shape:
+                return frame
+
+    def put(self, job):
+        self.queue.put(job)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        running = True
+        while running:
+            jobs = [self.queue.get()]
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            names = []
+            for job in jobs:
+                if job is None:
+                    running = False
+                    continue
+                if job['frame'] is not None and job['frame'] == self.lastFrame:
+                    self.free.put(job['image'])
+                    continue
+                try:
+                    names.extend(self.save(job))
+                    self.lastFrame = job['frame']
+                except Exception as e:
+                    self.sigFailed.emit(str(e))
+                self.free.put(job['image'])
+
+            if len(names) > 0:
+                self.sigSaved.emit(names)
+
+    def save(self, job):
+        """ Saves the snap described in job and returns the filenames."""
+
+        folder = job['folder']
+        if not(os.path.exists(folder)):
+            raise IOError("Folder doesn't exist")
+
+        image = job['image']
+        umxpx = job['umxpx']
+        dim = (umxpx * np.array(image.shape)).astype(np.int)
+        sh = str(dim[0]) + 'x' + str(dim[1])
+        rootname = os.path.join(folder, job['filename']) + '_wf'
+        savename = rootname + sh + '.tif'
+        savename = guitools.getUniqueName(savename)
+        image = np.flipud(image)
+        saveSnapTiff(savename, image, umxpx)
+        guitools.attrsToTxt(os.path.splitext(savename)[0], job['attrs'])
+        names = [savename]
+
+        # Two-color-corrected snap saving
+        side = job['side']
+        if side is not None:
+
+            # Corrected image
+            im0 = image[:side, :]
+            im1 = job['transformer'].transform(image[-side:, :])
+
+            dim = (umxpx * np.array(im0.shape)).astype(np.int)
+            sh = str(dim[0]) + 'x' + str(dim[1])
+            corrName = rootname + sh + '.tif'
+            names.append(utils.insertSuffix(corrName, '_corrected_ch0'))
+            saveSnapTiff(names[-1], im0, umxpx)
+            names.append(utils.insertSuffix(corrName, '_corrected_ch1'))
+            saveSnapTiff(names[-1], im1, umxpx)
+
+            # Corrected and cropped image
+            cropShape, xlim, ylim = job['cropShape'], job['xlim'], job['ylim']
+            crop2chShape = (2*cropShape[0], cropShape[1])
+            im0c = im0[xlim[0]:xlim[1], ylim[0]:ylim[1]]
+            im1c = im1[xlim[0]:xlim[1], ylim[0]:ylim[1]]
+
+            dim = (umxpx * np.array(crop2chShape)).astype(np.int)
+            sh = str(dim[0]) + 'x' + str(dim[1])
+            cropName = rootname + sh + '.tif'
+            names.append(utils.insertSuffix(cropName, '_corrected_crop_ch0'))
+            saveSnapTiff(names[-1], im0c, umxpx)
+            names.append(utils.insertSuffix(cropName, '_corrected_crop_ch1'))
+            saveSnapTiff(names[-1], im1c, umxpx)
+
+        return names
+
+
+class BenchmarkWorker(QtCore.QObject):
+    """ Runs acquisition.benchmarkHDF5 and prints the write and read speeds
+    of each layout next to the data rate of the camera, in MB/s."""
+
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, folder, frameShape, settings, cameraRate, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.folder = folder
+        self.frameShape = frameShape
+        self.settings = settings
+        self.cameraRate = cameraRate
+
+    def run(self):
+        try:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' HDF5 benchmark, '
+                  'camera data rate {:.1f} MB/s'.format(self.cameraRate))
+            results = acquisition.benchmarkHDF5(self.folder, self.frameShape,
+                                                self.settings)
+            text = '{:>6} {:>6} {:>10.1f} {:>10.1f} {:>6.2f} {}'
+            print('{:>6} {:>6} {:>10} {:>10} {:>6}'.format(
+                'chunk', 'filter', 'write', 'read', 'ratio'))
+            for (chunkFrames, compression, write, read, ratio,
+                 cached) in results:
+                keepsUp = 'ok' if write > self.cameraRate else 'too slow'
+                print(text.format(chunkFrames, str(compression), write, read,
+                                  ratio, keepsUp))
+            if any(result[-1] for result in results):
+                print('Reads were measured from the OS cache')
+
+        except Exception as e:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' HDF5 benchmark '
+                  'failed: ' + repr(e))
+
+        finally:
+            self.finished.emit()
 
 
 class TemperatureStabilizer(QtCore.QObject):
@@ -812,8 +1166,13 @@ class TormentaGUI(QtGui.QMainWindow):
                  aptMotor, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Processes shared by the recording and analysis jobs, with some of
+        # them kept for the recording
+        self.workers = workers.shared()
+
         self.andor = andor
         self.shape = self.andor.detector_shape
+        self.framePool = acquisition.FramePool(self.shape)
         self.side = 512
         self.frameStart = (1, 1)
         self.redlaser = redlaser
@@ -827,6 +1186,12 @@ class TormentaGUI(QtGui.QMainWindow):
         self.lastTime = ptime.time()
         self.fps = None
 
+        # Index of the frame on screen and histogram refresh period (s)
+        self.frameIndex = None
+        self.histPeriod = 0.5
+        self.lastHistTime = 0
+        self.liveviewError = None
+
         self.umxpx = 0.133
 
         # Actions in menubar
@@ -845,7 +1210,7 @@ class TormentaGUI(QtGui.QMainWindow):
 
         self.exportTiffAction = QtGui.QAction('Export HDF5 to Tiff...', self)
         self.exportTiffAction.setStatusTip('Export HDF5 file to Tiff format')
-        self.exportTiffAction.triggered.connect(pyqtsub.TiffConverterThread)
+        self.exportTiffAction.triggered.connect(lambda: self.exportTiff())
         fileMenu.addAction(self.exportTiffAction)
 
         def tiff2pngFunction():
@@ -862,6 +1227,10 @@ class TormentaGUI(QtGui.QMainWindow):
         self.exportlastAction.setShortcut('Ctrl+L')
         self.exportlastAction.setStatusTip('Export last recording to Tiff ' +
                                            'format')
+        self.exportlastAction.triggered.connect(
+            lambda: self.exportTiff(self.lastRecording))
+        self.lastRecording = None
+        self.tiffConverters = []
         fileMenu.addAction(self.exportlastAction)
 
         fileMenu.addSeparator()
@@ -917,6 +1286,20 @@ class TormentaGUI(QtGui.QMainWindow):
         self.transformerThread.started.connect(self.transformer.run)
         self.HtransformAction.triggered.connect(self.transformerThread.start)
 
+        text = 'Localize two-color stacks...'
+        self.locTwoColorsAction = QtGui.QAction(text, self)
+        tip = ('Localize both raw channels and register channel 1 ' +
+               'localizations with an affine transformation matrix')
+        self.locTwoColorsAction.setStatusTip(tip)
+        analysisMenu.addAction(self.locTwoColorsAction)
+        self.locTwoColorsThread = QtCore.QThread(self)
+        self.locTwoColors = stack.LocalizeTwoColors()
+        self.locTwoColors.moveToThread(self.locTwoColorsThread)
+        self.locTwoColors.finished.connect(self.locTwoColorsThread.quit)
+        self.locTwoColorsThread.started.connect(self.locTwoColors.run)
+        self.locTwoColorsAction.triggered.connect(
+            self.locTwoColorsThread.start)
+
         text = 'Subtract background from stacks...'
         self.bkgSubtAction = QtGui.QAction(text, self)
         tip = 'Remove noise from data using a running median filter'
@@ -1031,6 +1414,10 @@ class TormentaGUI(QtGui.QMainWindow):
         # Status bar info
         self.fpsBox = QtGui.QLabel('0 fps', self)
         self.statusBar().addPermanentWidget(self.fpsBox)
+        self.recStatus = QtGui.QLabel(self)
+        self.recStatus.setToolTip('Recording lag and lost frames, readout '
+                                  'and writing times')
+        self.statusBar().addPermanentWidget(self.recStatus)
         self.tempStatus = QtGui.QLabel(self)
         self.statusBar().addPermanentWidget(self.tempStatus)
         self.temp = QtGui.QLabel(self)
@@ -1170,7 +1557,8 @@ class TormentaGUI(QtGui.QMainWindow):
             self.updateLevels(self.andor.most_recent_image16(self.shape))
             self.vb.setXRange(0, self.shape[0], padding=0)
             self.vb.setYRange(0, self.shape[1], padding=0)
-            self.hist.setHistogramRange(np.min(self.image), np.max(self.image))
+            image = guitools.subsampled(self.image)
+            self.hist.setHistogramRange(np.min(image), np.max(image))
             self.vb.setLimits(xMin=-0.5, xMax=self.shape[0] - 0.5, minXRange=4,
                               yMin=-0.5, yMax=self.shape[1] - 0.5, minYRange=4)
 
@@ -1178,11 +1566,12 @@ class TormentaGUI(QtGui.QMainWindow):
 
         self.vb1 = self.imageWidget.addViewBox(row=3, col=1)
         self.vb1.setMouseMode(pg.ViewBox.RectMode)
-        self.img1 = pg.ImageItem()
+        self.img1 = pg.ImageItem(axisOrder='row-major')
         self.img1.translate(-0.5, -0.5)
         self.vb1.addItem(self.img1)
         self.vb1.setAspectLocked(True)
         self.hist1 = pg.HistogramLUTItem(image=self.img1)
+        self.img1.sigImageChanged.disconnect(self.hist1.imageChanged)
         self.hist1.vb.setLimits(yMin=0, yMax=20000)
         self.hist1.gradient.setColorMap(self.cubehelixCM)
         for tick in self.hist1.gradient.ticks:
@@ -1199,24 +1588,27 @@ class TormentaGUI(QtGui.QMainWindow):
         self.vb1.setYRange(0, self.side, padding=0)
         self.vb1.setLimits(xMin=-0.5, xMax=xrange - 0.5, minXRange=4,
                            yMin=-0.5, yMax=self.side - 0.5, minYRange=4)
-        self.hist1.setHistogramRange(np.min(self.image[:, :self.side]),
-                                     np.max(self.image[:, :self.side]))
+        im1 = guitools.subsampled(self.image[:, :self.side])
+        self.hist1.setHistogramRange(np.min(im1), np.max(im1))
         self.vb.setXRange(0, xrange, padding=0)
         self.vb.setYRange(0, self.side, padding=0)
         self.vb.setLimits(xMin=-0.5, xMax=xrange - 0.5, minXRange=4,
                           yMin=-0.5, yMax=self.side - 0.5, minYRange=4)
-        self.hist.setHistogramRange(np.min(self.image[:, -self.side:]),
-                                    np.max(self.image[:, -self.side:]))
+        im0 = guitools.subsampled(self.image[:, -self.side:])
+        self.hist.setHistogramRange(np.min(im0), np.max(im0))
 
     def setSingleView(self):
 
         self.vb = self.imageWidget.addViewBox(row=1, col=1)
         self.vb.setMouseMode(pg.ViewBox.RectMode)
-        self.img = pg.ImageItem()
+        # Frames are shown in row-major order, so they don't need to be
+        # transposed, and the histograms are updated by updateHistograms
+        self.img = pg.ImageItem(axisOrder='row-major')
         self.img.translate(-0.5, -0.5)
         self.vb.addItem(self.img)
         self.vb.setAspectLocked(True)
         self.hist = pg.HistogramLUTItem(image=self.img)
+        self.img.sigImageChanged.disconnect(self.hist.imageChanged)
         self.hist.vb.setLimits(yMin=0, yMax=20000)
         self.hist.gradient.setColorMap(self.cubehelixCM)
         for tick in self.hist.gradient.ticks:
@@ -1327,12 +1719,13 @@ class TormentaGUI(QtGui.QMainWindow):
 
     def updateLevels(self, image):
         if self.dualView:
-            im1 = np.transpose(image[:self.side, :])
+            im1 = guitools.subsampled(image[:self.side, :])
             self.hist1.setLevels(*guitools.bestLimits(im1))
-            im0 = np.transpose(image[-self.side:, :])
+            im0 = guitools.subsampled(image[-self.side:, :])
             self.hist.setLevels(*guitools.bestLimits(im0))
 
         else:
+            image = guitools.subsampled(image)
             self.hist.setLevels(*guitools.bestLimits(image))
 #        std = np.std(image)
 #        self.hist.setLevels(np.min(image) - std, np.max(image) + std)
@@ -1520,19 +1913,22 @@ class TormentaGUI(QtGui.QMainWindow):
         self.recWidget.recButton.setEnabled(True)
 
         # Initial image
-        self.image = self.andor.most_recent_image16(self.shape)
+        self.image = self.readLiveFrame()
+        self.frameIndex = None
         if self.dualView:
-            self.img.setImage(np.transpose(self.image[:, -self.side:]))
-            self.hist.setHistogramRange(np.min(self.image[:, -self.side:]),
-                                        np.max(self.image[:, -self.side:]))
-            self.img1.setImage(np.transpose(self.image[:, :self.side]))
+            self.img.setImage(self.image[:, -self.side:])
+            im0 = guitools.subsampled(self.image[:, -self.side:])
+            self.hist.setHistogramRange(np.min(im0), np.max(im0))
+            self.img1.setImage(self.image[:, :self.side])
             self.vb1.scene().sigMouseMoved.connect(self.mouseMoved)
-            self.hist1.setHistogramRange(np.min(self.image[:, :self.side]),
-                                         np.max(self.image[:, :self.side]))
+            im1 = guitools.subsampled(self.image[:, :self.side])
+            self.hist1.setHistogramRange(np.min(im1), np.max(im1))
 
         else:
-            self.img.setImage(np.transpose(self.image), autoLevels=False)
-            self.hist.setHistogramRange(np.min(self.image), np.max(self.image))
+            self.img.setImage(self.image, autoLevels=False)
+            image = guitools.subsampled(self.image)
+            self.hist.setHistogramRange(np.min(image), np.max(image))
+        self.updateHistograms()
 
         self.vb.scene().sigMouseMoved.connect(self.mouseMoved)
         if update:
@@ -1584,20 +1980,31 @@ class TormentaGUI(QtGui.QMainWindow):
 
         self.sigLiveviewEnded.emit()
 
+    def readLiveFrame(self):
+        """ Most recent frame, read into one of a few preallocated buffers
+        that are replaced only if the frame shape changes."""
+        if self.framePool.shape != tuple(self.shape):
+            self.framePool = acquisition.FramePool(self.shape)
+        return self.andor.most_recent_image16_into(self.framePool.next())
+
     def updateView(self):
-        """ Image update while in Liveview mode
+        """ Image update while in Liveview mode. The view is only redrawn if
+        the camera has a new frame.
         """
         try:
-            self.image = self.andor.most_recent_image16(self.shape)
+            index = self.andor.n_images_acquired
+            if index == self.frameIndex:
+                return
+            self.frameIndex = index
+
+            self.image = self.readLiveFrame()
             if self.dualView:
-                self.img1.setImage(np.transpose(self.image[:self.side]),
-                                   autoLevels=False)
-                self.img.setImage(np.transpose(self.image[-self.side:]),
-                                  autoLevels=False)
+                self.img1.setImage(self.image[:self.side], autoLevels=False)
+                self.img.setImage(self.image[-self.side:], autoLevels=False)
             else:
                 if self.moleculeWidget.enabled:
-                    self.moleculeWidget.graph.update(self.image)
-                self.img.setImage(np.transpose(self.image), autoLevels=False)
+                    self.moleculeWidget.offer(self.image)
+                self.img.setImage(self.image, autoLevels=False)
 
                 if self.crosshair.showed:
                     ycoord = int(np.round(self.crosshair.hLine.pos()[0]))
@@ -1605,10 +2012,46 @@ class TormentaGUI(QtGui.QMainWindow):
                     self.xProfile.setData(self.image[:, ycoord])
                     self.yProfile.setData(self.image[xcoord])
 
+            if self.histogramDue():
+                self.updateHistograms()
             self.fpsMath()
+            self.liveviewError = None
 
-        except:
-            pass
+        # Keep the liveview running, but report each new error once
+        except Exception as e:
+            if repr(e) != self.liveviewError:
+                self.liveviewError = repr(e)
+                print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                      ' Liveview update failed: ' + self.liveviewError)
+
+    def histogramDue(self):
+        """ True at most once every histPeriod seconds."""
+        now = ptime.time()
+        if now - self.lastHistTime < self.histPeriod:
+            return False
+        self.lastHistTime = now
+        return True
+
+    def updateHistograms(self):
+        """ Recomputes the histograms of the images on screen. pyqtgraph
+        takes them from a subsampled image."""
+        self.hist.imageChanged()
+        if self.dualView:
+            self.hist1.imageChanged()
+
+    def exportTiff(self, filenames=None):
+        """ Exports hdf5 files to TIFF in the background. If filenames is
+        None, they're asked for."""
+        converter = pyqtsub.TiffConverterThread(filenames)
+        converter.converter.sigProgress.connect(self.exportProgress)
+        converter.finished.connect(
+            lambda: self.tiffConverters.remove(converter))
+        self.tiffConverters.append(converter)
+        converter.start()
+
+    def exportProgress(self, filename, fraction):
+        self.statusBar().showMessage('Exporting {}: {:.0%}'.format(
+            os.path.split(filename)[1], fraction), 2000)
 
     def fpsMath(self):
         now = ptime.time()
@@ -1636,4 +2079,11 @@ class TormentaGUI(QtGui.QMainWindow):
 
         self.laserWidgets.closeEvent(*args, **kwargs)
         self.focusWidget.closeEvent(*args, **kwargs)
+        self.moleculeWidget.closeEvent(*args, **kwargs)
+        for converter in list(self.tiffConverters):
+            converter.stop()
+        self.recWidget.snapWriter.stop()
+        self.recWidget.snapThread.quit()
+        self.recWidget.snapThread.wait()
+        workers.shutdown()
         super().closeEvent(*args, **kwargs)
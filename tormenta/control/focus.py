@@ -7,7 +7,7 @@ Created on Wed Oct  1 13:41:48 2014
 
 import numpy as np
 import time
-import scipy.ndimage as ndi
+import threading
 import matplotlib.pyplot as plt
 
 import pyqtgraph as pg
@@ -19,6 +19,7 @@ from lantz import Q_
 
 import tormenta.control.instruments as instruments
 import tormenta.control.pi as pi
+from tormenta.control.timeseries import TimeSeries
 
 
 class FocusWidget(QtGui.QFrame):
@@ -32,7 +33,9 @@ class FocusWidget(QtGui.QFrame):
 
         self.webcam = instruments.Webcam()
 
-        self.z = scanZ
+        # The lock loop, the GUI and the calibrations move the stage from
+        # different threads
+        self.z = instruments.LockedStage(scanZ)
         self.z.zHostPosition = 'left'
         self.z.zobject.HostBackLashEnable = False
 
@@ -44,7 +47,10 @@ class FocusWidget(QtGui.QFrame):
 
         self.setFrameStyle(QtGui.QFrame.Panel | QtGui.QFrame.Raised)
 
-        self.scansPerS = 10
+        # The lock loop runs as fast as the webcam allows, the graphs are
+        # redrawn at plotsPerS
+        self.scansPerS = 30
+        self.plotsPerS = 10
         self.ProcessData = ProcessData(self.webcam)
 
         # Focus lock widgets
@@ -70,16 +76,24 @@ class FocusWidget(QtGui.QFrame):
         self.focusDataBox = QtGui.QCheckBox('Save focus data')
         self.focusPropertiesDisplay = QtGui.QLabel(' st_dev = 0  max_dev = 0')
 
+        self.n = 1
+        self.max_dev = 0
+        self.std = 0
         self.graph = FocusLockGraph(self, self.mainRec)
 
-        self.focusTime = 1000 / self.scansPerS
+        self.focusLoop = FocusLoop(self.ProcessData, self.z, self.scansPerS,
+                                   self.graph.record)
+        self.focusLoop.sigLocked.connect(self.focusLocked)
+        self.focusLoop.sigUnlocked.connect(self.focusUnlocked)
+        self.focusThread = QtCore.QThread(self)
+        self.focusLoop.moveToThread(self.focusThread)
+        self.focusThread.started.connect(self.focusLoop.run)
+        self.focusThread.start()
+
+        self.plotCount = 0
         self.focusTimer = QtCore.QTimer()
         self.focusTimer.timeout.connect(self.update)
-        self.focusTimer.start(self.focusTime)
-
-        self.locked = False
-        self.n = 1
-        self.max_dev = 0
+        self.focusTimer.start(1000 / self.plotsPerS)
 
         self.focusCalib = FocusCalibration(self)
         self.focusCalibThread = QtCore.QThread(self)
@@ -126,83 +140,59 @@ class FocusWidget(QtGui.QFrame):
     def zMoveEdit(self):
         self.zMove(float(self.moveEdit.text())/1000 * self.um)
 
+    @property
+    def locked(self):
+        return self.focusLoop.locked
+
     def zMove(self, step):
         if self.locked:
-            self.unlockFocus()
+            self.focusLoop.unlockFocus()
             self.z.zMoveRelative(step)
-            self.update()
-            self.lockButton.setChecked(True)
-            self.toggleFocus(1)
+            self.focusLoop.lockFocus(float(self.kpEdit.text()),
+                                     float(self.kiEdit.text()), delay=1)
 
         else:
             self.z.zMoveRelative(step)
 
     def update(self):
-        try:
-            self.ProcessData.update()
-            self.graph.update()
+        """ Redraws the graphs with the data of the lock loop. The webcam
+        image is redrawn at half the rate."""
+        self.graph.update()
+        self.plotCount += 1
+        if self.plotCount % 2 == 0:
             self.webcamgraph.update()
-        except:
-            pass
-
-        if self.locked:
-            self.updatePI()
 
     def toggleFocus(self, delay=0):
         if self.lockButton.isChecked():
-
             self.graph.reset()
-            self.ProcessData.update(delay)
-            self.setPoint = self.ProcessData.focusSignal
-            self.graph.line = self.graph.plot.addLine(y=self.setPoint, pen='r')
-            self.PI = pi.PI(self.setPoint, 0.001, np.float(self.kpEdit.text()),
-                            np.float(self.kiEdit.text()))
-
-            self.lockN = 1
-            self.lockMean = self.setPoint
-            self.graph.setLine = self.graph.plot.addLine(y=self.lockMean,
-                                                         pen='c')
-            self.initialZ = self.z.zPosition
-            self.locked = True
+            self.focusLoop.lockFocus(float(self.kpEdit.text()),
+                                     float(self.kiEdit.text()), delay)
 
         else:
             self.unlockFocus()
 
     def unlockFocus(self):
-        if self.locked:
-            self.locked = False
-            self.lockButton.setChecked(False)
-            self.graph.plot.removeItem(self.graph.line)
-            self.graph.plot.removeItem(self.graph.setLine)
-
-    def updatePI(self):
+        self.focusLoop.unlockFocus()
 
-        self.distance = self.z.zPosition - self.initialZ
-        cm = self.ProcessData.focusSignal
-        out = self.PI.update(cm)
+    def focusLocked(self, setPoint):
+        self.setPoint = setPoint
+        self.lockButton.setChecked(True)
+        self.graph.addLockLines(setPoint)
 
-        self.lockN += 1
-        self.lockMean += (cm - self.lockMean)/(self.lockN + 1)
-        self.graph.setLine.setValue(self.lockMean)
-
-        # Safety unlocking
-        if abs(self.distance) > 10 * self.um or abs(out) > 5:
-            self.unlockFocus()
-        else:
-            self.z.zMoveRelative(out * self.um)
+    def focusUnlocked(self):
+        self.lockButton.setChecked(False)
+        self.graph.removeLockLines()
 
     def exportData(self):
 
-        self.sizeofData = np.size(self.graph.savedDataSignal)
-        self.savedData = [np.ones(self.sizeofData)*self.setPoint,
-                          self.graph.savedDataSignal, self.graph.savedDataTime]
+        time, signal = self.graph.savedData.history()
+        self.savedData = [np.ones(len(time))*self.setPoint, signal[0], time]
         np.savetxt(self.mainRec.name + '_focusdata', self.savedData)
-        self.graph.savedDataSignal = []
-        self.graph.savedDataTime = []
+        self.graph.savedData.clear()
 
-    def analizeFocus(self):
-
-        signal = self.ProcessData.focusSignal
+    def analizeFocus(self, signal):
+        """ Adds signal to the statistics of the focus during a recording.
+        Called from the lock loop."""
 
         if self.n == 1:
             self.mean = signal
@@ -212,53 +202,219 @@ class FocusWidget(QtGui.QFrame):
             self.mean2 += (signal**2 - self.mean2)/self.n
 
         # Stats
-        self.std = np.sqrt(self.mean2 - self.mean**2)
-        self.max_dev = np.max([self.max_dev,
-                              self.ProcessData.focusSignal - self.setPoint])
-        statData = 'std = {}    max_dev = {}'.format(np.round(self.std, 3),
-                                                     np.round(self.max_dev, 3))
-        self.graph.statistics.setText(statData)
+        self.std = np.sqrt(max(self.mean2 - self.mean**2, 0))
+        self.max_dev = np.max([self.max_dev, signal - self.setPoint])
 
         self.n += 1
 
     def closeEvent(self, *args, **kwargs):
         self.focusTimer.stop()
+        self.focusLoop.stop()
+        self.focusThread.quit()
+        self.focusThread.wait()
         self.webcam.stop()
         super().closeEvent(*args, **kwargs)
 
 
-class ProcessData(QtCore.QObject):
+class FocusLoop(QtCore.QObject):
+    """ Focus lock loop, run in a thread of its own at a fixed rate of
+    scansPerS so the lock doesn't depend on the GUI. Every tick the focus
+    signal is measured and handed to record(t, signal), and if the focus is
+    locked the PI output is sent to the stage z. z is also moved from other
+    threads, so it should be an instruments.LockedStage. mutex only guards
+    the PI state.
+
+    ============================== ===========================================
+    **Signals:**
+    sigLocked(setPoint)            Emitted when the lock starts, with the
+                                   focus signal it keeps.
+    sigUnlocked()                  Emitted when the lock is released,
+                                   including the safety unlocking.
+    ============================== ===========================================
+    """
+
+    sigLocked = QtCore.pyqtSignal(float)
+    sigUnlocked = QtCore.pyqtSignal()
+
+    def __init__(self, processData, z, scansPerS=30, record=None, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.processData = processData
+        self.z = z
+        self.period = 1 / scansPerS
+        self.record = record
+        self.um = Q_(1, 'um')
 
-    def __init__(self, webcam, *args, **kwargs):
+        self.PI = None
+        self.pendingLock = None
+        self.lockMean = 0
+        self.running = True
+        self.mutex = threading.Lock()
+
+    @property
+    def locked(self):
+        return self.PI is not None or self.pendingLock is not None
+
+    def lockFocus(self, kp, ki, delay=0):
+        """ Locks the focus to the signal measured delay seconds from now."""
+        with self.mutex:
+            self.PI = None
+            self.pendingLock = (time.time() + delay, kp, ki)
+
+    def unlockFocus(self):
+        """ Releases the lock. Once this returns, the loop doesn't move the
+        stage anymore."""
+        with self.mutex:
+            wasLocked = self.locked
+            self.PI = None
+            self.pendingLock = None
+        if wasLocked:
+            self.sigUnlocked.emit()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        nextTick = time.time()
+        error = None
+        while self.running:
+            try:
+                self.tick()
+                error = None
+            except Exception as e:
+                # Every new error is reported once
+                if repr(e) != error:
+                    error = repr(e)
+                    print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                          ' Focus lock error: ' + error)
+
+            # Fixed rate. If a tick took longer than the period, the next
+            # one starts right away and the schedule is reset.
+            nextTick += self.period
+            wait = nextTick - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                nextTick = time.time()
+
+    def tick(self):
+        self.processData.update()
+        signal = self.processData.focusSignal
+        if self.record is not None:
+            self.record(ptime.time(), signal)
+
+        unlocked = False
+        with self.mutex:
+            if (self.pendingLock is not None and
+                    time.time() >= self.pendingLock[0]):
+                start, kp, ki = self.pendingLock
+                self.pendingLock = None
+                self.PI = pi.PI(signal, 0.001, kp, ki)
+                self.lockN = 1
+                self.lockMean = signal
+                self.initialZ = self.z.zPosition
+                self.sigLocked.emit(signal)
+
+            elif self.PI is not None:
+                self.distance = self.z.zPosition - self.initialZ
+                out = self.PI.update(signal)
+
+                self.lockN += 1
+                self.lockMean += (signal - self.lockMean)/(self.lockN + 1)
+
+                # Safety unlocking
+                if abs(self.distance) > 10 * self.um or abs(out) > 5:
+                    self.PI = None
+                    unlocked = True
+                else:
+                    self.z.zMoveRelative(out * self.um)
+
+        if unlocked:
+            self.sigUnlocked.emit()
+
+
+class ProcessData(QtCore.QObject):
+    """ Focus signal from the webcam image of the reflected laser spot. The
+    signal is the center of mass of a roiSize ROI around the spot, that
+    follows the spot from frame to frame. The moments are integer sums on
+    the native dtype of the image, over the mean of the ROI border as
+    background. If the spot in the ROI is less than half as bright as
+    before, it's searched again in the whole image."""
+
+    def __init__(self, webcam, roiSize=64, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.webcam = webcam
         image = instruments.getWebcamImage(self.webcam)
         self.sensorSize = np.array(image.shape)
+        self.roiSize = roiSize
+        self.roi = None
+        self.peak = 0
         self.focusSignal = 0
+        self.massCenter = np.zeros(2)
+        self.image = image
+
+    def findSpot(self, image):
+        """ Brightest pixel of image, searched on a subsampled copy."""
+        sub = image[::4, ::4]
+        return 4*np.array(np.unravel_index(np.argmax(sub), sub.shape))
+
+    def roiAt(self, center):
+        """ (x0, x1, y0, y1) of the ROI centered at center, inside the
+        image."""
+        half = self.roiSize // 2
+        lims = []
+        for c, size in zip(np.round(center).astype(int), self.sensorSize):
+            c0 = min(max(c - half, 0), max(size - self.roiSize, 0))
+            lims.extend([int(c0), int(min(c0 + self.roiSize, size))])
+        return tuple(lims)
+
+    def centerOfMass(self, image, roi):
+        """ Center of mass of the roi of image over the background and the
+        peak height, or None if there's no spot."""
+        x0, x1, y0, y1 = roi
+        data = image[x0:x1, y0:y1]
+        if np.issubdtype(data.dtype, np.integer):
+            acc = np.int64
+        else:
+            acc = np.float64
+        rows = data.sum(1, dtype=acc)
+        cols = data.sum(0, dtype=acc)
+
+        # Background from the border of the ROI
+        nx, ny = data.shape
+        border = (rows[0] + rows[-1] + cols[0] + cols[-1] - data[0, 0] -
+                  data[0, -1] - data[-1, 0] - data[-1, -1])
+        bkg = acc(border) / (2*(nx + ny) - 4)
+
+        total = rows.sum() - bkg*nx*ny
+        if total <= 0:
+            return None, 0
+        x = np.arange(x0, x1, dtype=acc)
+        y = np.arange(y0, y1, dtype=acc)
+        cx = (np.dot(x, rows) - bkg*ny*x.sum()) / total
+        cy = (np.dot(y, cols) - bkg*nx*y.sum()) / total
+        return np.array([cx, cy]), data.max() - bkg
 
-    def update(self, delay=0):
-
-        time.sleep(delay)
+    def update(self):
 
-        runs = 1
-        imageArray = np.zeros((runs, self.sensorSize[0], self.sensorSize[1]),
-                              np.float)
-        # mucha CPU
-        for i in range(runs):
-            image = instruments.getWebcamImage(self.webcam).astype(np.float)
-            try:
-                imageArray[i] = image / np.sum(image)
-            except:
-                print(np.sum(image))
-
-        finalImage = np.sum(imageArray, 0)
-        self.massCenter = np.array(ndi.measurements.center_of_mass(finalImage))
-        self.massCenter[0] = self.massCenter[0] - self.sensorSize[0] / 2
-        self.massCenter[1] = self.massCenter[1] - self.sensorSize[1] / 2
+        image = instruments.getWebcamImage(self.webcam)
+        center = None
+        if self.roi is not None:
+            center, peak = self.centerOfMass(image, self.roi)
+        if center is None or peak < 0.5*self.peak:
+            # Lost the spot
+            self.roi = self.roiAt(self.findSpot(image))
+            center, peak = self.centerOfMass(image, self.roi)
+            if center is None:
+                center = self.sensorSize / 2
+
+        self.peak = peak
+        self.roi = self.roiAt(center)
+        self.massCenter = center - self.sensorSize / 2
         self.focusSignal = self.massCenter[0]
-
-        self.image = finalImage
+        self.image = image
 
 
 class FocusLockGraph(pg.GraphicsWindow):
@@ -271,14 +427,20 @@ class FocusLockGraph(pg.GraphicsWindow):
         self.main = main
         self.analize = self.focusWidget.analizeFocus
         self.focusDataBox = self.focusWidget.focusDataBox
-        self.savedDataSignal = []
-        self.savedDataTime = []
-        self.savedDataPosition = []
 
         self.setWindowTitle('Focus')
         self.setAntialiasing(True)
 
+        # Rolling plot and focus signal saved during the recordings. The
+        # saved data is kept at full resolution for the first 2**16 samples
+        # and decimated afterwards.
         self.npoints = 400
+        self.series = TimeSeries(self.npoints)
+        self.savedData = TimeSeries(2**16)
+        self.recording = False
+        self.lock = threading.Lock()
+        self.line = None
+        self.setLine = None
 
         # Graph without a fixed range
         self.statistics = pg.LabelItem(justify='right')
@@ -296,45 +458,54 @@ class FocusLockGraph(pg.GraphicsWindow):
             self.recButton = self.main.recButton
 
     def reset(self):
-        self.data = np.zeros(self.npoints)
-        self.time = np.zeros(self.npoints)
-        self.ptr = 0
-        self.startTime = ptime.time()
-
-        self.focusWidget.n = 1
-        self.focusWidget.max_dev = 0
-        self.focusWidget.mean = self.focusWidget.ProcessData.focusSignal
-        self.focusWidget.std = 0
+        with self.lock:
+            self.series.clear()
+            self.startTime = ptime.time()
+
+            self.focusWidget.n = 1
+            self.focusWidget.max_dev = 0
+            self.focusWidget.mean = self.focusWidget.ProcessData.focusSignal
+            self.focusWidget.std = 0
+
+    def record(self, t, signal):
+        """ Adds a sample of the focus signal. Called from the lock
+        loop."""
+        with self.lock:
+            t -= self.startTime
+            self.series.append(t, signal)
+            if self.recording:
+                self.savedData.append(t, signal)
+                self.analize(signal)
+
+    def addLockLines(self, setPoint):
+        self.removeLockLines()
+        self.line = self.plot.addLine(y=setPoint, pen='r')
+        self.setLine = self.plot.addLine(y=setPoint, pen='c')
+
+    def removeLockLines(self):
+        for line in (self.line, self.setLine):
+            if line is not None:
+                self.plot.removeItem(line)
+        self.line = None
+        self.setLine = None
 
     def update(self):
         """ Update the data displayed in the graphs
         """
-        self.focusSignal = self.focusWidget.ProcessData.focusSignal
-
-        if self.ptr < self.npoints:
-            self.data[self.ptr] = self.focusSignal
-            self.time[self.ptr] = ptime.time() - self.startTime
-            self.focusCurve.setData(self.time[1:self.ptr + 1],
-                                    self.data[1:self.ptr + 1])
+        with self.lock:
+            time, data = self.series.data()
+            self.focusCurve.setData(time, data[0])
+            statData = 'std = {}    max_dev = {}'.format(
+                np.round(self.focusWidget.std, 3),
+                np.round(self.focusWidget.max_dev, 3))
 
-        else:
-            self.data[:-1] = self.data[1:]
-            self.data[-1] = self.focusSignal
-            self.time[:-1] = self.time[1:]
-            self.time[-1] = ptime.time() - self.startTime
-
-            self.focusCurve.setData(self.time, self.data)
-
-        self.ptr += 1
+        if self.setLine is not None:
+            self.setLine.setValue(self.focusWidget.focusLoop.lockMean)
 
         if self.main is not None:
-
-            if self.recButton.isChecked():
-                self.savedDataSignal.append(self.focusSignal)
-                self.savedDataTime.append(self.time[-1])
-
-            if self.recButton.isChecked():
-                self.analize()
+            self.recording = self.recButton.isChecked()
+            if self.recording:
+                self.statistics.setText(statData)
 
 
 class WebcamGraph(pg.GraphicsWindow):
@@ -349,8 +520,17 @@ class WebcamGraph(pg.GraphicsWindow):
         self.view.setAspectLocked(True)  # square pixels
         self.view.addItem(self.img)
 
+        # ROI of the focus signal
+        self.roiItem = QtGui.QGraphicsRectItem()
+        self.roiItem.setPen(pg.mkPen('y'))
+        self.view.addItem(self.roiItem)
+
     def update(self):
-        self.img.setImage(self.focusWidget.ProcessData.image)
+        processData = self.focusWidget.ProcessData
+        self.img.setImage(processData.image)
+        if processData.roi is not None:
+            x0, x1, y0, y1 = processData.roi
+            self.roiItem.setRect(x0, y0, x1 - x0, y1 - y0)
 
 
 class FocusCalibration(QtCore.QObject):
@@ -43,10 +43,6 @@ def fileSizeGB(shape):
     return shape[0]*shape[1]*shape[2] / 2**29
 
 
-def nFramesPerChunk(shape):
-    return int(1.8 * 2**29 / (shape[1] * shape[2]))
-
-
 # Preset tools
 def savePreset(main, filename=None):
 
@@ -184,6 +180,13 @@ def tiff2png(main, filenames=None):
             im.save(os.path.splitext(filename)[0] + '.png')
 
 
+def subsampled(image, size=128):
+    """ View of image with about size pixels per side, for statistics that
+    don't need every pixel like the histogram limits."""
+    step = max(1, max(image.shape) // size)
+    return image[::step, ::step]
+
+
 def bestLimits(arr):
     # Best cmin, cmax algorithm taken from ImageJ routine:
     # http://cmci.embl.de/documents/120206pyip_cooking/
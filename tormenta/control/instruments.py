@@ -7,6 +7,8 @@ Created on Sun Dec 28 13:25:27 2014
 
 import numpy as np
 import importlib
+import threading
+import ctypes as ct
 
 from PyQt4 import QtCore
 
@@ -189,9 +191,43 @@ class ScanZ(object):
             return mockers.MockProscan()
 
 
+class LockedStage(object):
+    """ Wrapper of the focus stage driver that serializes its use, so the
+    commands sent by the focus lock loop, the GUI and the calibrations from
+    their own threads don't interleave on the serial port. Every attribute
+    read and write and every method call on the driver is done holding
+    lock, a reentrant lock shared with the wrapped zobject."""
+
+    def __init__(self, stage, lock=None):
+        if lock is None:
+            lock = threading.RLock()
+        object.__setattr__(self, 'stage', stage)
+        object.__setattr__(self, 'lock', lock)
+
+    def __getattr__(self, name):
+        with self.lock:
+            value = getattr(self.stage, name)
+        if name == 'zobject':
+            return LockedStage(value, self.lock)
+        if callable(value):
+            def locked(*args, **kwargs):
+                with self.lock:
+                    return value(*args, **kwargs)
+            return locked
+        return value
+
+    def __setattr__(self, name, value):
+        with self.lock:
+            setattr(self.stage, name, value)
+
+
 class Camera(object):
     """ Buffer class for testing whether the camera is connected. If it's not,
-    it returns a dummy class for program testing. """
+    it returns a dummy class for program testing.
+
+    Besides the lantz CCD interface, every camera class has
+    most_recent_image16_into(out) and images16_into(first, last, out), that
+    fill a preallocated uint16 array instead of returning a new one. """
 
     def __new__(cls, iName, *args):
 
@@ -243,3 +279,32 @@ class STORMCamera(CCD):
         self.vertAmps = ['+' + str(self.true_vert_amp(n))
                          for n in np.arange(self.n_vert_clock_amps)]
         self.vertAmps[0] = 'Normal'
+
+    def most_recent_image16_into(self, out):
+        """ most_recent_image16 into out, a C-contiguous uint16 array with
+        the shape of the image. Returns out."""
+        checkBuffer(out)
+        self.lib.GetMostRecentImage16(out.ctypes.data_as(
+            ct.POINTER(ct.c_uint16)), ct.c_ulong(out.size))
+        return out
+
+    def images16_into(self, first, last, out):
+        """ images16 of the images first to last (inclusive) into out, a
+        C-contiguous uint16 array with shape (last - first + 1, width,
+        height). Returns out."""
+        checkBuffer(out)
+        if len(out) != last - first + 1:
+            raise ValueError('Buffer of {} frames for {} images'.format(
+                len(out), last - first + 1))
+        validfirst = ct.c_long()
+        validlast = ct.c_long()
+        self.lib.GetImages16(ct.c_long(first), ct.c_long(last),
+                             out.ctypes.data_as(ct.POINTER(ct.c_uint16)),
+                             ct.c_ulong(out.size), ct.pointer(validfirst),
+                             ct.pointer(validlast))
+        return out
+
+
+def checkBuffer(out):
+    if out.dtype != np.uint16 or not(out.flags.c_contiguous):
+        raise ValueError('Camera buffers must be C-contiguous uint16 arrays')
@@ -6,6 +6,7 @@ Created on Tue Aug 12 20:02:08 2014
 """
 
 import logging
+import time
 import numpy as np
 import tifffile as tiff
 import os
@@ -104,20 +105,73 @@ class MockProscan(Driver):
         super().__init__()
         self.zobject = MockScanZ()
 
+    @property
+    def zPosition(self):
+        return self.zobject.zPosition
+
+    @zPosition.setter
+    def zPosition(self, value):
+        self.zobject.zPosition = value
+
+    def zMoveRelative(self, value):
+        self.zobject.zMoveRelative(value)
+
+    @property
+    def zMoving(self):
+        return self.zobject.zMoving
+
+    @property
+    def zHostPosition(self):
+        return self.zobject.zHostPosition
+
+    @zHostPosition.setter
+    def zHostPosition(self, value):
+        self.zobject.zHostPosition = value
+
 
 class MockScanZ(Driver):
+    """ Simulated focus stage. Moves start latency seconds after the command
+    and take settleTime seconds, during which the position goes linearly
+    from the start to the target. zMoving is True from the command until the
+    end of the move, so the code waiting for the stage can be tested."""
 
-    def __init__(self):
+    def __init__(self, settleTime=0.02, latency=0):
         super().__init__()
         self.um = Q_(1, 'um')
+        self.settleTime = settleTime
+        self.latency = latency
 
-        self._position = 1000 * self.um
+        self._start = 1000 * self.um
+        self._target = self._start
+        self._moveTime = 0
         self._hostPosition = 'left'
 
     @property
     def idn(self):
         return '''Simulated Prior's NanoScanZ'''
 
+    def _move(self, value):
+        try:
+            value.magnitude
+            value = value.to('um')
+        except:
+            pass
+        self._start = self._position
+        self._target = value
+        self._moveTime = time.time()
+
+    @property
+    def _position(self):
+        t = time.time() - self._moveTime - self.latency
+        if t >= self.settleTime:
+            return self._target
+        return self._start + max(t, 0)/self.settleTime*(self._target -
+                                                         self._start)
+
+    @property
+    def zMoving(self):
+        return time.time() - self._moveTime < self.latency + self.settleTime
+
     @property
     def position(self):
         '''Gets and sets current position.
@@ -136,11 +190,7 @@ class MockScanZ(Driver):
         inst.position = 0. Thus, the stage will return to 0 micrometers and the
         display screen will switch to ABS mode.
         '''
-        try:
-            value.magnitude
-            self._position = value.to('um')
-        except:
-            self._position = value
+        self._move(value)
 
     @property
     def zPosition(self):
@@ -160,17 +210,13 @@ class MockScanZ(Driver):
         inst.position = 0. Thus, the stage will return to 0 micrometers and the
         display screen will switch to ABS mode.
         '''
-        try:
-            value.magnitude
-            self._position = value.to('um')
-        except:
-            self._position = value
+        self._move(value)
 
     def moveRel(self, value):
-        self.position = self.position + value
+        self._move(self._target + value)
 
     def zMoveRelative(self, value):
-        self.position = self.position + value
+        self._move(self._target + value)
 
     @property
     def zUmPerRevolution(self):
@@ -437,6 +483,14 @@ class MockCamera(Driver):
         arr = np.repeat(im[np.newaxis, :, :], last - first + 1, axis=0)
         return arr.astype(np.uint16)
 
+    def most_recent_image16_into(self, out):
+        out[:] = np.reshape(self.most_recent_image16(out.shape), out.shape)
+        return out
+
+    def images16_into(self, first, last, out):
+        out[:] = self.images16(first, last, out.shape[1:], 1, last)
+        return out
+
     def set_n_kinetics(self, n):
         self.n = n
 
@@ -452,7 +506,7 @@ class MockCamera(Driver):
     @property
     def n_images_acquired(self):
         self.j += 1
-        if self.j == self.n:
+        if self.acq_mode == 'Kinetics' and self.j == self.n:
             self.status_state = 'Camera is idle, waiting for instructions.'
         return self.j
 
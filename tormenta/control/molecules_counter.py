@@ -5,6 +5,8 @@ Created on Thu Jun 25 09:47:28 2015
 @author: Federico Barabas
 """
 
+import time
+import threading
 import numpy as np
 
 import pyqtgraph as pg
@@ -13,6 +15,8 @@ import pyqtgraph.ptime as ptime
 
 import tormenta.analysis.maxima as maxima
 import tormenta.analysis.tools as tools
+from tormenta.control.timeseries import TimeSeries
+import tormenta.workers as workers
 
 
 class MoleculeWidget(QtGui.QFrame):
@@ -27,6 +31,7 @@ class MoleculeWidget(QtGui.QFrame):
         self.enableBox = QtGui.QCheckBox('Enable')
         self.enableBox.setEnabled(False)
         self.enableBox.stateChanged.connect(self.graph.getTime)
+        self.enableBox.stateChanged.connect(self.toggleCounter)
         self.lockButton = QtGui.QPushButton('Lock (no anda)')
         self.lockButton.setCheckable(True)
         self.lockButton.clicked.connect(self.toggleLock)
@@ -50,6 +55,9 @@ class MoleculeWidget(QtGui.QFrame):
         grid.setColumnMinimumWidth(0, 200)
         grid.setColumnMinimumWidth(4, 170)
 
+        # Molecules are counted in their own thread
+        self.counter = None
+
     @property
     def enabled(self):
         return self.enableBox.isChecked()
@@ -57,6 +65,130 @@ class MoleculeWidget(QtGui.QFrame):
     def toggleLock(self):
         pass
 
+    def toggleCounter(self):
+        if self.enabled and self.counter is None:
+            self.counter = MoleculeCounter()
+            self.counter.sigCounted.connect(self.graph.update)
+            self.counterThread = QtCore.QThread(self)
+            self.counter.moveToThread(self.counterThread)
+            self.counterThread.started.connect(self.counter.run)
+            self.counterThread.start()
+
+        elif not(self.enabled) and self.counter is not None:
+            self.stopCounter()
+
+    def stopCounter(self):
+        if self.counter is not None:
+            self.counter.stop()
+            self.counterThread.quit()
+            self.counterThread.wait()
+            self.counter = None
+
+    def alpha(self):
+        try:
+            return float(self.alphaEdit.text())
+        except ValueError:
+            return 5
+
+    def offer(self, image):
+        """ Hands image to the counter, that takes the most recent frame
+        each time it's done with the previous one."""
+        if self.counter is not None:
+            self.counter.offer(image, self.alpha())
+
+    def closeEvent(self, *args, **kwargs):
+        self.stopCounter()
+        super().closeEvent(*args, **kwargs)
+
+
+def countMolecules(image, alpha, fwhm, winSize, kernel, xkernel):
+    """ Number of single molecules and overlaps in image."""
+    peaks = maxima.Maxima(image, fw=fwhm, win_size=winSize, kernel=kernel,
+                          xkernel=xkernel)
+    peaks.find(alpha)
+    return len(peaks.positions), peaks.overlaps
+
+
+class MoleculeCounter(QtCore.QObject):
+    """ Counts the molecules of the liveview frames as interactive jobs of
+    pool, the shared WorkerPool by default, so the GUI isn't slowed down.
+    One frame is counted at a time. Frames are offered by the GUI at any rate,
+    but only the most recent one is kept: every count is done on the
+    newest frame and the older ones are dropped.
+
+    ============================== ===========================================
+    **Signals:**
+    sigCounted(t, n, overlaps)     Emitted with the number of molecules and
+                                   overlaps of the frame offered at time t.
+    ============================== ===========================================
+    """
+
+    sigCounted = QtCore.pyqtSignal(float, int, int)
+
+    def __init__(self, pool=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if pool is None:
+            pool = workers.shared()
+        self.pool = pool
+        self.fwhm = tools.get_fwhm(670, 1.42) / 120
+        self.winSize = int(np.ceil(self.fwhm))
+        self.kernel = tools.kernel(self.fwhm)
+        self.xkernel = tools.xkernel(self.fwhm)
+
+        self.frame = None
+        self.frameTime = 0
+        self.alpha = 5
+        self.new = False
+        self.running = True
+        self.failed = False
+        self.cond = threading.Condition()
+
+    def offer(self, image, alpha):
+        with self.cond:
+            if self.frame is None or self.frame.shape != image.shape:
+                self.frame = np.empty_like(image)
+            self.frame[:] = image
+            self.frameTime = ptime.time()
+            self.alpha = alpha
+            self.new = True
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not(self.new) and self.running:
+                    self.cond.wait()
+                if not(self.running):
+                    break
+                image = self.frame.copy()
+                t = self.frameTime
+                alpha = self.alpha
+                self.new = False
+
+            args = (image, alpha, self.fwhm, self.winSize,
+                    self.kernel, self.xkernel)
+            try:
+                job = self.pool.submit(countMolecules, args,
+                                       workers.INTERACTIVE)
+                n, overlaps = job.get()
+            except Exception as e:
+                # Reported once until a count succeeds again, the frames
+                # keep coming at the liveview rate
+                if not(self.failed):
+                    print(time.strftime("%Y-%m-%d %H:%M:%S") + ' Molecule '
+                          'count failed: ' + repr(e))
+                    self.failed = True
+                continue
+
+            self.failed = False
+            self.sigCounted.emit(t, n, overlaps)
+
 
 class MoleculesGraph(pg.PlotWidget):
 
@@ -65,6 +197,7 @@ class MoleculesGraph(pg.PlotWidget):
 
         self.main = mainWidget
         self.npoints = 200
+        self.series = TimeSeries(self.npoints, 2)
 
         self.setAntialiasing(True)
 
@@ -93,46 +226,18 @@ class MoleculesGraph(pg.PlotWidget):
         self.updateViews()
         self.plot1.vb.sigResized.connect(self.updateViews)
 
-        self.fwhm = tools.get_fwhm(670, 1.42) / 120
-        self.kernel = tools.kernel(self.fwhm)
-
     def updateViews(self):
         self.plot2.setGeometry(self.plot1.vb.sceneBoundingRect())
         self.plot2.linkedViewChanged(self.plot1.vb, self.plot2.XAxis)
 
     def getTime(self):
         if self.main.enabled:
-            self.ptr = 0
-            self.dataN = np.zeros(self.npoints, dtype=np.int)
-            self.dataOverlaps = np.zeros(self.npoints, dtype=np.int)
-            self.time = np.zeros(self.npoints)
+            self.series.clear()
             self.startTime = ptime.time()
 
-    def update(self, image):
-
-        peaks = maxima.Maxima(image, self.fwhm, self.kernel)
-        peaks.find(float(self.main.alphaEdit.text()))
-        nMaxima = len(peaks.positions)
-        nOverlaps = peaks.overlaps
-
-        if self.ptr < self.npoints:
-            self.dataN[self.ptr] = nMaxima
-            self.dataOverlaps[self.ptr] = nOverlaps
-            self.time[self.ptr] = ptime.time() - self.startTime
-            self.curve1.setData(self.time[1:self.ptr + 1],
-                                self.dataN[1:self.ptr + 1])
-            self.curve2.setData(self.time[1:self.ptr + 1],
-                                self.dataOverlaps[1:self.ptr + 1])
-
-        else:
-            self.dataN[:-1] = self.dataN[1:]
-            self.dataN[-1] = nMaxima
-            self.dataOverlaps[:-1] = self.dataOverlaps[1:]
-            self.dataOverlaps[-1] = nOverlaps
-            self.time[:-1] = self.time[1:]
-            self.time[-1] = ptime.time() - self.startTime
-
-            self.curve1.setData(self.time, self.dataN)
-            self.curve2.setData(self.time, self.dataOverlaps)
-
-        self.ptr += 1
+    def update(self, t, nMaxima, nOverlaps):
+        """ Adds the counts of a frame taken at time t."""
+        self.series.append(t - self.startTime, nMaxima, nOverlaps)
+        time, (dataN, dataOverlaps) = self.series.data()
+        self.curve1.setData(time, dataN)
+        self.curve2.setData(time, dataOverlaps)
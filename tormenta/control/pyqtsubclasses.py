@@ -7,17 +7,22 @@ Created on Tue Jun  7 11:50:36 2016
 
 import os
 import time
+import queue
 import numpy as np
 import h5py as hdf
 import tifffile as tiff
 from PyQt4 import QtCore
 from pyqtgraph.parametertree import Parameter, ParameterTree
-import multiprocessing as mp
 from lantz import Q_
 
 import tormenta.control.guitools as guitools
 import tormenta.utils as utils
-from tormenta.analysis.stack import subtractChunk
+import tormenta.workers as workers
+from tormenta.analysis.stack import subtract_background
+from tormenta.analysis.registration import TiffStack
+from tormenta.control.acquisition import (needsBigTiff, tiffWriter,
+                                          writeTiff, acquireZStack,
+                                          stagePosition)
 
 
 class CamParamTree(ParameterTree):
@@ -203,14 +208,19 @@ class CamParamTree(ParameterTree):
 
 
 class Calibrate3D(QtCore.QObject):
+    """ Acquires the z stack for the astigmatism calibration with
+    acquisition.acquireZStack, nFrames averaged frames per plane read from
+    the camera buffer, while the liveview keeps the camera running."""
 
     sigDone = QtCore.pyqtSignal()
 
-    def __init__(self, main, step=0.025, rangeUm=2, *args, **kwargs):
+    def __init__(self, main, step=0.025, rangeUm=2, nFrames=8, *args,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         self.main = main
         self.step = Q_(step, 'um')
         self.rangeUm = Q_(rangeUm, 'um')
+        self.nFrames = nFrames
 
     def start(self):
 
@@ -222,102 +232,179 @@ class Calibrate3D(QtCore.QObject):
         name = '3Dcalibration_step{}'.format(self.step)
         savename = guitools.getUniqueName(os.path.join(path, name) + '.tiff')
 
-        steps = (self.rangeUm // self.step).magnitude
-        self.main.focusWidget.zMove(-0.5*steps*self.step)
-        self.main.focusWidget.zMove(self.step)
-        time.sleep(0.1)
+        steps = int((self.rangeUm // self.step).magnitude)
+        focusWidget = self.main.focusWidget
+        z0 = stagePosition(focusWidget.z)
+        focusWidget.zMove(-0.5*steps*self.step)
+        start = z0 - 0.5*steps*self.step.to('um').magnitude
+        try:
+            acquireZStack(self.main.andor, focusWidget.z, steps, self.step,
+                          savename, self.main.shape, self.nFrames,
+                          self.main.umxpx, focusWidget.zMove, start)
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' 3D calibration '
+                  'saved in ' + os.path.split(savename)[1])
+        except Exception as e:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' 3D calibration '
+                  'failed: ' + repr(e))
+        finally:
+            # Back to the initial position, also if the stack was cut short
+            focusWidget.zMove(Q_(z0 - stagePosition(focusWidget.z), 'um'))
+
+            self.main.recWidget.writable = True
+            self.main.tree.writable = True
+            self.main.liveviewButton.setEnabled(True)
+            self.sigDone.emit()
 
-        stack = np.zeros((int(steps), self.main.shape[0], self.main.shape[1]),
-                         dtype=np.uint16)
 
-        for s in np.arange(steps, dtype=int):
-            self.main.focusWidget.zMove(self.step)
-            time.sleep(0.1)     # Waiting for the motor to get to new position
-            image = self.main.img.image.astype(np.uint16)
-            stack[s] = image
+# HDF <--> Tiff converter
+def exportTiff(filename, blockFrames=256, progress=None):
+    """ Exports every stack in the hdf5 file filename to a TIFF file, named
+    after the file and the dataset. Frames are copied in blocks of
+    blockFrames, so the data never has to fit in memory, and stacks larger
+    than 2 GB are saved as BigTIFF. progress(done, total) is called after
+    each block. Returns the names of the new files."""
+
+    names = []
+    with hdf.File(filename, mode='r') as file:
+        datanames = [name for name in file
+                     if isinstance(file[name], hdf.Dataset) and
+                     file[name].ndim >= 2]
+        # 2D datasets are saved as a single frame
+        nframes = {name: len(file[name]) if file[name].ndim > 2 else 1
+                   for name in datanames}
+        total = sum(nframes.values())
+        done = 0
+
+        for dataname in datanames:
+            data = file[dataname]
+            name = os.path.splitext(filename)[0] + '_' + dataname
+            guitools.attrsToTxt(name, [at for at in data.attrs.items()])
+            names.append(name + '.tiff')
+
+            with tiffWriter(names[-1], data.shape) as tw:
+                for i in range(0, nframes[dataname], blockFrames):
+                    if data.ndim > 2:
+                        block = data[i:i + blockFrames]
+                    else:
+                        block = data[:]
+                    writeTiff(tw, block, description=dataname,
+                              contiguous=True)
+                    done += min(blockFrames, nframes[dataname] - i)
+                    if progress is not None:
+                        progress(done, total)
 
-        tiff.imsave(savename, stack, software='Tormenta',
-                    photometric='minisblack',
-                    resolution=(1/self.main.umxpx, 1/self.main.umxpx),
-                    extratags=[('resolution_unit', 'H', 1, 3, True)])
+    return names
 
-        self.main.focusWidget.zMove(-0.5*steps*self.step)
 
-        self.main.recWidget.writable = True
-        self.main.tree.writable = True
-        self.main.liveviewButton.setEnabled(True)
-        self.sigDone.emit()
+def exportTiffJob(filename, blockFrames=256):
+    """ exportTiff reporting its progress to the WorkerPool running it."""
+    return exportTiff(filename, blockFrames, workers.report)
 
 
-# HDF <--> Tiff converter
 class TiffConverterThread(QtCore.QThread):
+    """ Thread running a TiffConverter, that quits once the conversion is
+    over. Connect to the converter signals before calling start."""
 
-    def __init__(self, filename=None):
+    def __init__(self, filenames=None, pool=None):
         super().__init__()
 
-        self.converter = TiffConverter(filename, self)
+        self.converter = TiffConverter(filenames, pool)
         self.converter.moveToThread(self)
         self.started.connect(self.converter.run)
-        self.start()
+        self.converter.sigDone.connect(self.quit)
+
+    def stop(self):
+        self.converter.stop()
+        self.wait()
 
 
 class TiffConverter(QtCore.QObject):
+    """
+    **Bases:** :class:`QtCore.QObject`
+
+    Exports hdf5 files to TIFF with exportTiff, each file as a background
+    job of pool, the shared WorkerPool by default. If filenames is None,
+    they're asked for.
+
+    ============================== ===========================================
+    **Signals:**
+    sigProgress(name, fraction)    Emitted as blocks of frames of the file
+                                   name are exported.
+    sigDone(names)                 Emitted with the names of the exported
+                                   files when all of them are done.
+    ============================== ===========================================
+    """
+
+    sigProgress = QtCore.pyqtSignal(str, float)
+    sigDone = QtCore.pyqtSignal(list)
 
-    def __init__(self, filenames, thread, *args, **kwargs):
+    def __init__(self, filenames=None, pool=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.filenames = filenames
-        self.thread = thread
-
-    def run(self):
-
-        self.filenames = guitools.getFilenames("Select HDF5 files",
-                                               [('HDF5 files', '.hdf5')])
+        if pool is None:
+            pool = workers.shared()
+        self.pool = pool
+        self.running = True
 
-        if len(self.filenames) > 0:
-            for filename in self.filenames:
-                print('Exporting ', os.path.split(filename)[1])
+    def stop(self):
+        """ Cancels the exports that didn't start yet. The ones already
+        running finish in the pool."""
+        self.running = False
 
-                file = hdf.File(filename, mode='r')
-
-                for dataname in file:
+    def run(self):
 
-                    data = file[dataname]
-                    filesize = guitools.fileSizeGB(data.shape)
-                    filename = (os.path.splitext(filename)[0] + '_' + dataname)
-                    attList = [at for at in data.attrs.items()]
-                    guitools.attrsToTxt(filename, attList)
-
-                    if filesize < 2:
-                        time.sleep(5)
-                        tiff.imsave(filename + '.tiff', data,
-                                    description=dataname, software='Tormenta')
-                    else:
-                        n = guitools.nFramesPerChunk(data.shape)
-                        i = 0
-                        while i < filesize // 1.8:
-                            suffix = '_part{}'.format(i)
-                            partName = guitools.insertSuffix(filename, suffix,
-                                                             '.tiff')
-                            tiff.imsave(partName, data[i*n:(i + 1)*n],
-                                        description=dataname,
-                                        software='Tormenta')
-                            i += 1
-                        if filesize % 2 > 0:
-                            suffix = '_part{}'.format(i)
-                            partName = guitools.insertSuffix(filename, suffix,
-                                                             '.tiff')
-                            tiff.imsave(partName, data[i*n:],
-                                        description=dataname,
-                                        software='Tormenta')
-
-                file.close()
-                print('done')
-
-        self.filenames = None
-        self.thread.terminate()
-        # for opening attributes this should work:
-        # myprops = dict(line.strip().split('=') for line in
-        #                open('/Path/filename.txt'))
+        if self.filenames is None:
+            self.filenames = guitools.getFilenames("Select HDF5 files",
+                                                   [('HDF5 files', '.hdf5')])
+        filenames = [f for f in self.filenames if os.path.exists(f)]
+        for f in set(self.filenames) - set(filenames):
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' ' + f +
+                  " doesn't exist")
+
+        names = []
+        if len(filenames) > 0:
+            progressQueue = queue.Queue()
+            jobs = {}
+            try:
+                for filename in filenames:
+                    print(time.strftime("%Y-%m-%d %H:%M:%S") +
+                          ' Exporting ' + os.path.split(filename)[1])
+
+                    def progress(done, total, filename=filename):
+                        progressQueue.put((filename, done, total))
+                    jobs[filename] = self.pool.submit(
+                        exportTiffJob, (filename,), workers.BACKGROUND,
+                        progress=progress)
+
+                while self.running and len(jobs) > 0:
+                    self.reportProgress(progressQueue)
+                    for filename in [f for f in jobs if jobs[f].ready()]:
+                        try:
+                            names.extend(jobs.pop(filename).get())
+                            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' ' +
+                                  os.path.split(filename)[1] + ' done')
+                        except Exception as e:
+                            print(time.strftime("%Y-%m-%d %H:%M:%S") + ' ' +
+                                  os.path.split(filename)[1] +
+                                  ' export failed: ' + repr(e))
+
+            finally:
+                for job in jobs.values():
+                    job.cancel()
+
+        self.sigDone.emit(names)
+
+    def reportProgress(self, progressQueue, timeout=0.5):
+        """ Emits sigProgress for the messages of the workers that arrive
+        within timeout."""
+        try:
+            filename, done, total = progressQueue.get(timeout=timeout)
+            self.sigProgress.emit(filename, done / max(total, 1))
+            while True:
+                filename, done, total = progressQueue.get_nowait()
+                self.sigProgress.emit(filename, done / max(total, 1))
+        except queue.Empty:
+            pass
 
 
 class BkgSubtractor(QtCore.QObject):
@@ -341,43 +428,34 @@ class BkgSubtractor(QtCore.QObject):
                   ' Processing stack ' + os.path.split(filename)[1])
             ext = os.path.splitext(filename)[1]
             filename2 = utils.insertSuffix(filename, '_subtracted')
-            if ext == '.hdf5':
-                with hdf.File(filename, 'r') as f0, \
-                        hdf.File(filename2, 'w') as f1:
 
-                    self.data = f0['data'].value
-                    if len(self.data) > self.window:
-                        dataSub = self.mpSubtract()
-                        f1.create_dataset(name='data', data=dataSub)
+            # The stack is read and the result written block by block,
+            # straight into a preallocated file
+            if ext == '.hdf5':
+                with hdf.File(filename, 'r') as f0:
+                    data = f0['data']
+                    if len(data) > self.window:
+                        with hdf.File(filename2, 'w') as f1:
+                            out = f1.create_dataset(
+                                name='data', shape=data.shape,
+                                dtype=np.uint16, chunks=(1,) + data.shape[1:])
+                            subtract_background(data, out, self.window)
                     else:
                         print('Stack shorter than filter window --> ignore')
 
             elif ext in ['.tiff', '.tif']:
                 with tiff.TiffFile(filename) as tt:
-
-                    self.data = tt.asarray()
-                    if len(self.data) > self.window:
-                        dataSub = self.mpSubtract()
-                        tiff.imsave(filename2, dataSub)
-
+                    data = TiffStack(tt)
+                    if len(data) > self.window:
+                        out = tiff.memmap(filename2, shape=data.shape,
+                                          dtype=np.uint16,
+                                          bigtiff=needsBigTiff(data.shape))
+                        subtract_background(data, out, self.window)
+                        out.flush()
+                        del out
                     else:
                         print('Stack shorter than filter window --> ignore')
+
         print(time.strftime("%Y-%m-%d %H:%M:%S") +
               ' Background subtraction finished')
         self.finished.emit()
-
-    # Multiprocessing
-    def mpSubtract(self):
-        n = len(self.data)
-        cpus = mp.cpu_count() - 1
-        step = n // cpus
-        chunks = [[i*step, (i + 1)*step] for i in np.arange(cpus)]
-        chunks[-1][1] = n
-        args = [self.data[i:j] for i, j in chunks]
-        pool = mp.Pool(processes=cpus)
-        results = pool.map(subtractChunk, args)
-        pool.close()
-        pool.join()
-        data = np.concatenate(results[:])
-        data -= np.min(data)
-        return data.astype(np.uint16)
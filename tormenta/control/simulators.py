@@ -308,6 +308,14 @@ class SimCamera(Driver):
         arr = np.random.normal(100, 10, (last - first + 1, shape[0], shape[1]))
         return arr.astype(np.uint16)
 
+    def most_recent_image16_into(self, out):
+        out[:] = np.reshape(self.most_recent_image16(out.size), out.shape)
+        return out
+
+    def images16_into(self, first, last, out):
+        out[:] = self.images16(first, last, out.shape[1:], 1, last)
+        return out
+
     def set_n_kinetics(self, n):
         self.n = n
 
@@ -323,7 +331,7 @@ class SimCamera(Driver):
     @property
     def n_images_acquired(self):
         self.j += 1
-        if self.j == self.n:
+        if self.acq_mode == 'Kinetics' and self.j == self.n:
             self.status_state = 'Camera is idle, waiting for instructions.'
         return self.j
 
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Time series of fixed memory for the rolling plots of the GUI.
+"""
+
+import numpy as np
+
+
+class Ring(object):
+    """ Fixed size ring buffer of rows of nfields values with O(1) append.
+    Every row is written twice, at i and i + capacity, so the last capacity
+    rows are always a contiguous slice of the buffer. Fields are stored
+    in rows of the buffer: view()[k] is a contiguous array of field k."""
+
+    def __init__(self, capacity, nfields):
+        self.capacity = capacity
+        self.buffer = np.zeros((nfields, 2*capacity))
+        self.clear()
+
+    def clear(self):
+        self.i = 0
+        self.count = 0
+
+    def append(self, row):
+        self.buffer[:, self.i] = row
+        self.buffer[:, self.i + self.capacity] = row
+        self.i = (self.i + 1) % self.capacity
+        self.count += 1
+
+    @property
+    def wrapped(self):
+        return self.count > self.capacity
+
+    def view(self):
+        """ (nfields, n) view of the stored rows, oldest first."""
+        if self.wrapped:
+            return self.buffer[:, self.i:self.i + self.capacity]
+        else:
+            return self.buffer[:, :self.count]
+
+
+class TimeSeries(object):
+    """ Time series of ncols values per sample in fixed memory. The last
+    capacity samples are kept at full resolution, and older ones in levels
+    of decreasing resolution: every factor blocks of a level are reduced to
+    their minimum and maximum in the next one, so peaks are kept in the
+    decimated history. Each level holds capacity points, that is,
+    capacity/2 blocks of factor**level samples.
+
+    :param capacity: number of points in each level
+    :param ncols: number of values per sample
+    :param levels: number of levels, including the full resolution one
+    :param factor: number of blocks of a level reduced into one of the next
+    """
+
+    def __init__(self, capacity=400, ncols=1, levels=4, factor=10):
+
+        self.capacity = capacity
+        self.ncols = ncols
+        self.factor = factor
+        self.rings = [Ring(capacity, ncols + 1) for _ in range(levels)]
+
+        # Minimum and maximum of the block being reduced into each level.
+        # Times are the ones of the first and last samples of the block.
+        self.low = np.zeros((levels, ncols + 1))
+        self.high = np.zeros((levels, ncols + 1))
+        self.blocks = np.zeros(levels, dtype=int)
+        self.row = np.zeros(ncols + 1)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        for ring in self.rings:
+            ring.clear()
+        self.blocks[:] = 0
+        self.n = 0
+
+    def append(self, t, *values):
+        self.row[0] = t
+        self.row[1:] = values
+        self.rings[0].append(self.row)
+        self.n += 1
+        self.reduce(1, self.row, self.row)
+
+    def reduce(self, level, low, high):
+        """ Adds the block (low, high) to the one being reduced into level,
+        and stores it if it's complete."""
+
+        if level >= len(self.rings):
+            return
+
+        if self.blocks[level] == 0:
+            self.low[level] = low
+            self.high[level] = high
+        else:
+            np.minimum(self.low[level, 1:], low[1:],
+                       out=self.low[level, 1:])
+            np.maximum(self.high[level, 1:], high[1:],
+                       out=self.high[level, 1:])
+            self.high[level, 0] = high[0]
+        self.blocks[level] += 1
+
+        if self.blocks[level] == self.factor:
+            self.blocks[level] = 0
+            self.rings[level].append(self.low[level])
+            self.rings[level].append(self.high[level])
+            self.reduce(level + 1, self.low[level], self.high[level])
+
+    def data(self, level=0):
+        """ Times and (ncols, n) values of level, oldest first. They're
+        views of the buffer, valid until the next append."""
+        view = self.rings[level].view()
+        return view[0], view[1:]
+
+    def history(self):
+        """ Times and values of the whole series, at full resolution if it
+        fits in capacity samples or at the finest level that still holds
+        the first sample, up to its last complete block."""
+        for level, ring in enumerate(self.rings):
+            if not(ring.wrapped):
+                return self.data(level)
+        return self.data(len(self.rings) - 1)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ring buffer between the camera readout and the writers.
+"""
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from tormenta.control.acquisition import FrameRing, FramePool, FrameLog
+
+
+def frames(first, n, shape=(3, 4)):
+    """ n frames filled with their index."""
+    index = np.arange(first, first + n, dtype=np.uint16)
+    return np.ones((n,) + shape, dtype=np.uint16) * index[:, None, None]
+
+
+class Reader(threading.Thread):
+    """ Consumer that keeps the index of every frame it reads, slowly if
+    delay is given."""
+
+    def __init__(self, ring, name, maxFrames=None, delay=0):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.name = name
+        self.maxFrames = maxFrames
+        self.delay = delay
+        self.starts = []
+        self.values = []
+        ring.addConsumer(name)
+
+    def run(self):
+        while True:
+            item = self.ring.peek(self.name, self.maxFrames)
+            if item is None:
+                break
+            start, view = item
+            time.sleep(self.delay)
+            self.starts.append(start)
+            self.values.extend(view[:, 0, 0].tolist())
+            self.ring.release(self.name, len(view))
+
+
+class FrameRingTest(unittest.TestCase):
+
+    def test_every_frame_in_order(self):
+        ring = FrameRing(5, (3, 4))
+        readers = [Reader(ring, 'fast'), Reader(ring, 'slow', 2, 0.002)]
+        for reader in readers:
+            reader.start()
+        for first in range(0, 40, 3):
+            ring.put(frames(first, min(3, 40 - first)))
+        ring.close()
+        for reader in readers:
+            reader.join(5)
+            self.assertEqual(reader.values, list(range(40)))
+            self.assertEqual(reader.starts[0], 0)
+
+    def test_no_overwrite(self):
+        # The producer waits instead of overwriting unreleased frames
+        ring = FrameRing(4, (3, 4))
+        ring.addConsumer('stalled')
+        ring.put(frames(0, 4))
+        producer = threading.Thread(target=ring.put, args=(frames(4, 2),),
+                                    daemon=True)
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(ring.depth('stalled'), 4)
+
+        start, view = ring.peek('stalled')
+        self.assertEqual(start, 0)
+        np.testing.assert_array_equal(view[:, 0, 0], np.arange(4))
+        ring.release('stalled', 1)
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        ring.release('stalled', 3)
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+
+        start, view = ring.peek('stalled')
+        self.assertEqual(start, 4)
+        np.testing.assert_array_equal(view[:, 0, 0], [4, 5])
+
+    def test_batch_larger_than_ring(self):
+        ring = FrameRing(4, (3, 4))
+        reader = Reader(ring, 'writer')
+        reader.start()
+        ring.put(frames(0, 11))
+        ring.close()
+        reader.join(5)
+        self.assertEqual(reader.values, list(range(11)))
+
+    def test_stats(self):
+        ring = FrameRing(8, (3, 4))
+        ring.addConsumer('a')
+        ring.addConsumer('b')
+        ring.put(frames(0, 5))
+        ring.release('a', 5)
+        ring.put(frames(5, 2))
+        self.assertEqual(ring.stats(), {'a': (2, 5), 'b': (7, 7)})
+        self.assertEqual(ring.depth(), 7)
+
+    def test_removed_consumer(self):
+        # A failed consumer doesn't block the producer
+        ring = FrameRing(2, (3, 4))
+        ring.addConsumer('failed')
+        ring.put(frames(0, 2))
+        ring.removeConsumer('failed')
+        ring.put(frames(2, 2))
+        self.assertEqual(ring.depth(), 0)
+
+    def test_closed(self):
+        ring = FrameRing(4, (3, 4))
+        ring.addConsumer('writer')
+        ring.put(frames(0, 1))
+        ring.close()
+        self.assertEqual(ring.peek('writer')[0], 0)
+        ring.release('writer', 1)
+        self.assertIsNone(ring.peek('writer'))
+
+
+class FrameLogTest(unittest.TestCase):
+
+    def test_no_losses(self):
+        log = FrameLog(10)
+        log.add(1, 3, 0.5)
+        log.add(4, 4, 0.7)
+        self.assertEqual(log.lost, 0)
+        np.testing.assert_array_equal(log.frameNumbers[:log.stored],
+                                      [1, 2, 3, 4])
+        np.testing.assert_array_equal(log.timestamps[:4],
+                                      [0.5, 0.5, 0.5, 0.7])
+
+    def test_losses(self):
+        # Frames 4, 5 and 9 were overwritten in the camera before being read
+        log = FrameLog(10)
+        log.add(1, 3, 1.)
+        log.add(6, 8, 2.)
+        log.add(10, 11, 3.)
+        self.assertEqual(log.lost, 3)
+        self.assertEqual(log.stored, 8)
+
+        # Timestamps and frame numbers are indexed like the stored frames
+        np.testing.assert_array_equal(log.frameNumbers[:8],
+                                      [1, 2, 3, 6, 7, 8, 10, 11])
+        np.testing.assert_array_equal(log.timestamps[:8],
+                                      [1, 1, 1, 2, 2, 2, 3, 3])
+
+    def test_first_frames_lost(self):
+        log = FrameLog(5)
+        log.add(3, 4, 1.)
+        self.assertEqual(log.lost, 2)
+
+
+class FramePoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = FramePool((3, 4), n=2)
+        a, b, c = pool.next(), pool.next(), pool.next()
+        self.assertEqual(a.shape, (3, 4))
+        self.assertFalse(np.shares_memory(a, b))
+        self.assertTrue(np.shares_memory(a, c))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the precomputed resampling and of the crop search of the channel
+registration.
+"""
+
+import itertools
+import unittest
+
+import numpy as np
+from scipy.ndimage import affine_transform
+
+import tormenta.analysis.registration as reg
+
+
+def largest_rectangle_area(a):
+    """ Area of the largest rectangle of nonzero elements, by brute
+    force."""
+    best = 0
+    rows = itertools.combinations(range(a.shape[0] + 1), 2)
+    for x0, x1 in rows:
+        for y0, y1 in itertools.combinations(range(a.shape[1] + 1), 2):
+            if a[x0:x1, y0:y1].all():
+                best = max(best, (x1 - x0)*(y1 - y0))
+    return best
+
+
+class RemapperTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.image = rng.rand(40, 50)
+        self.H = np.array([[1.01, 0.02, 1.3],
+                           [-0.015, 0.99, -0.7],
+                           [0, 0, 1]])
+
+    def test_affine_transform(self):
+        transformer = reg.AffineTransformer(self.H, self.image.shape)
+        result = transformer.transform(self.image)
+        expected = affine_transform(self.image, self.H[:2, :2],
+                                    offset=self.H[:2, 2], order=1)
+        mask = transformer.mask
+        self.assertGreater(mask.sum(), 0.8*mask.size)
+        np.testing.assert_allclose(result[mask], expected[mask], atol=1e-6)
+        self.assertTrue(np.all(result[~mask] == 0))
+
+    def test_block(self):
+        transformer = reg.AffineTransformer(self.H, self.image.shape)
+        block = np.array([self.image, 2*self.image, 3*self.image])
+        result = transformer.transform(block)
+        self.assertEqual(result.shape, block.shape)
+        for frame, expected in zip(result, block):
+            np.testing.assert_allclose(frame,
+                                       transformer.transform(expected))
+
+    def test_integer_frames(self):
+        frame = (1000*self.image).astype(np.uint16)
+        transformer = reg.AffineTransformer(self.H, frame.shape)
+        result = transformer.transform(frame)
+        expected = affine_transform(frame.astype(float), self.H[:2, :2],
+                                    offset=self.H[:2, 2], order=1)
+        self.assertEqual(result.dtype, np.uint16)
+        mask = transformer.mask
+        np.testing.assert_allclose(result[mask], expected[mask], atol=0.5)
+
+
+class LargestRectangleTest(unittest.TestCase):
+
+    def test_brute_force(self):
+        rng = np.random.RandomState(1)
+        for _ in range(200):
+            shape = rng.randint(1, 8, 2)
+            a = (rng.rand(*shape) > 0.25).astype(int)
+            xlim, ylim = reg.find_largest_rectangle(a)
+            rectangle = a[xlim[0]:xlim[1], ylim[0]:ylim[1]]
+            self.assertEqual(rectangle.size, largest_rectangle_area(a))
+            self.assertTrue(np.all(rectangle))
+
+    def test_full(self):
+        xlim, ylim = reg.find_largest_rectangle(np.ones((5, 7), dtype=int))
+        self.assertEqual((xlim, ylim), ((0, 5), (0, 7)))
+
+    def test_affine_shapes(self):
+        H = np.array([[1, 0, 2.5], [0, 1, -3.2], [0, 0, 1]])
+        xlim, ylim, cropShape = reg.get_affine_shapes((30, 40), H)
+        mask = reg.AffineTransformer(H, (30, 40)).mask
+        self.assertTrue(np.all(mask[xlim[0]:xlim[1], ylim[0]:ylim[1]]))
+        self.assertEqual(cropShape, (mask.any(1).sum(), mask.any(0).sum()))
+
+
+if __name__ == '__main__':
+    unittest.main()
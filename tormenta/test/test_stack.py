@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the block by block background subtraction.
+"""
+
+import unittest
+
+import numpy as np
+
+import tormenta.workers as workers
+from tormenta.analysis.stack import (bkg_estimation, subtract_stack,
+                                     subtract_background)
+
+
+class SubtractStackTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = workers.WorkerPool(2)
+        rng = np.random.RandomState(0)
+        cls.data = rng.poisson(300, (150, 6, 7)).astype(np.uint16)
+        cls.data[40:60, 2, 3] += 2000
+        cls.window = 21
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def expected(self):
+        """ Background subtraction of the whole stack at once."""
+        subtracted = self.data - bkg_estimation(self.data, self.window)
+        return np.clip(subtracted, -2**15, 2**15 - 1).astype(np.int16)
+
+    def test_blocks_match_whole_stack(self):
+        # The halos make the block edges match the one-shot filter, also
+        # with blocks smaller than the window
+        expected = self.expected()
+        for blockSize in [16, 32, 150, 200]:
+            starts = []
+            blocks = []
+            for start, block in subtract_stack(self.data, self.window,
+                                               blockSize, self.pool):
+                starts.append(start)
+                blocks.append(block)
+            self.assertEqual(starts, list(range(0, 150, blockSize)))
+            result = np.concatenate(blocks)
+            self.assertEqual(result.dtype, np.int16)
+            np.testing.assert_array_equal(result, expected)
+
+    def test_subtract_background(self):
+        expected = self.expected().astype(np.int32)
+        out = np.zeros(self.data.shape, dtype=np.uint16)
+        offset = subtract_background(self.data, out, self.window, 32,
+                                     self.pool)
+        self.assertEqual(offset, expected.min())
+        np.testing.assert_array_equal(out, expected - offset)
+
+
+if __name__ == '__main__':
+    unittest.main()
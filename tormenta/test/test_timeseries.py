@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the fixed memory time series of the rolling plots.
+"""
+
+import unittest
+
+import numpy as np
+
+from tormenta.control.timeseries import Ring, TimeSeries
+
+
+class RingTest(unittest.TestCase):
+
+    def test_before_wrapping(self):
+        ring = Ring(5, 2)
+        for i in range(3):
+            ring.append((i, 10*i))
+        np.testing.assert_array_equal(ring.view(), [[0, 1, 2], [0, 10, 20]])
+        self.assertFalse(ring.wrapped)
+
+    def test_wrapped(self):
+        ring = Ring(5, 2)
+        for i in range(13):
+            ring.append((i, 10*i))
+        view = ring.view()
+        self.assertTrue(ring.wrapped)
+        np.testing.assert_array_equal(view[0], np.arange(8, 13))
+        np.testing.assert_array_equal(view[1], 10*np.arange(8, 13))
+        # The fields are contiguous views of the buffer
+        self.assertTrue(view[0].flags['C_CONTIGUOUS'])
+        self.assertIs(view.base, ring.buffer)
+
+    def test_clear(self):
+        ring = Ring(4, 1)
+        for i in range(6):
+            ring.append((i,))
+        ring.clear()
+        ring.append((7,))
+        np.testing.assert_array_equal(ring.view(), [[7]])
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def test_full_resolution(self):
+        series = TimeSeries(capacity=20, ncols=2, levels=3, factor=4)
+        for i in range(50):
+            series.append(i, i, -i)
+        self.assertEqual(len(series), 50)
+        t, values = series.data()
+        np.testing.assert_array_equal(t, np.arange(30, 50))
+        np.testing.assert_array_equal(values, [np.arange(30, 50),
+                                               -np.arange(30, 50)])
+
+    def test_decimation(self):
+        factor = 4
+        series = TimeSeries(capacity=20, ncols=1, levels=3, factor=factor)
+        rng = np.random.RandomState(0)
+        samples = rng.rand(192)
+        for i, value in enumerate(samples):
+            series.append(i, value)
+
+        # Level 1 keeps the minimum and maximum of every block of factor
+        # samples, with the times of the first and last sample of the block
+        blocks = samples.reshape(-1, factor)
+        t, (values,) = series.data(1)
+        nblocks = len(t) // 2
+        last = blocks[-nblocks:]
+        np.testing.assert_array_equal(values[0::2], last.min(1))
+        np.testing.assert_array_equal(values[1::2], last.max(1))
+        starts = factor*np.arange(len(blocks) - nblocks, len(blocks))
+        np.testing.assert_array_equal(t[0::2], starts)
+        np.testing.assert_array_equal(t[1::2], starts + factor - 1)
+
+        # Level 2 keeps them for blocks of factor**2 samples
+        t, (values,) = series.data(2)
+        blocks = samples.reshape(-1, factor**2)[-(len(t) // 2):]
+        np.testing.assert_array_equal(values[0::2], blocks.min(1))
+        np.testing.assert_array_equal(values[1::2], blocks.max(1))
+
+    def test_history(self):
+        series = TimeSeries(capacity=20, ncols=1, levels=3, factor=4)
+        for i in range(10):
+            series.append(i, i)
+        t, values = series.history()
+        np.testing.assert_array_equal(t, np.arange(10))
+
+        # Past the capacity, the finest level that still holds the start,
+        # up to its last complete block of 16 samples
+        for i in range(10, 60):
+            series.append(i, i)
+        t, (values,) = series.history()
+        self.assertEqual((t[0], t[-1]), (0, 47))
+        self.assertEqual((values.min(), values.max()), (0, 47))
+
+
+if __name__ == '__main__':
+    unittest.main()
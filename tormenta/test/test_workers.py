@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the shared process pool: priorities, the acquisition reserve and
+cancelling.
+"""
+
+import time
+import unittest
+
+import tormenta.workers as workers
+
+
+def started(name, duration=0):
+    """ Returns name with the time the job started."""
+    t = time.time()
+    time.sleep(duration)
+    return name, t
+
+
+def fail():
+    raise ValueError('failed job')
+
+
+def reporting(n):
+    for i in range(n):
+        workers.report(i, n)
+    return n
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_results(self):
+        self.pool = workers.WorkerPool(2)
+        jobs = [self.pool.submit(started, (i,)) for i in range(6)]
+        self.assertEqual([job.get(10)[0] for job in jobs], list(range(6)))
+        with self.assertRaises(ValueError):
+            self.pool.submit(fail).get(10)
+
+    def test_priority(self):
+        # With the only process busy, the interactive job submitted last
+        # runs before the queued background ones
+        self.pool = workers.WorkerPool(1, reserved=0)
+        busy = self.pool.submit(started, ('busy', 0.3), workers.BACKGROUND)
+        background = [self.pool.submit(started, (i,), workers.BACKGROUND)
+                      for i in range(3)]
+        interactive = self.pool.submit(started, ('interactive',),
+                                       workers.INTERACTIVE)
+        busy.get(10)
+        tInteractive = interactive.get(10)[1]
+        self.assertTrue(all(tInteractive <= job.get(10)[1]
+                            for job in background))
+        times = [job.get(10)[1] for job in background]
+        self.assertEqual(times, sorted(times))
+
+    def test_reserve(self):
+        # Background jobs never take the reserved process, so an
+        # acquisition job starts right away
+        self.pool = workers.WorkerPool(2, reserved=1)
+        self.assertEqual(self.pool.limit(workers.BACKGROUND), 1)
+        self.assertEqual(self.pool.limit(workers.ACQUISITION), 2)
+        background = [self.pool.submit(started, (i, 0.3))
+                      for i in range(2)]
+        time.sleep(0.05)
+        self.assertEqual(self.pool.load(), (1, 1))
+
+        t0 = time.time()
+        acquisition = self.pool.submit(started, ('acquisition',),
+                                       workers.ACQUISITION)
+        self.assertLess(acquisition.get(10)[1] - t0, 0.2)
+        for job in background:
+            job.get(10)
+
+    def test_default_reserve(self):
+        self.pool = workers.WorkerPool(1)
+        self.assertEqual(self.pool.reserved, 0)
+        self.pool.close()
+        for processes, reserved in [(2, 1), (4, 1), (8, 2)]:
+            self.pool = workers.WorkerPool(processes)
+            self.assertEqual(self.pool.reserved, reserved)
+            self.pool.close()
+        self.pool = workers.WorkerPool(3, reserved=5)
+        self.assertEqual(self.pool.reserved, 2)
+
+    def test_cancel(self):
+        self.pool = workers.WorkerPool(1, reserved=0)
+        busy = self.pool.submit(started, ('busy', 0.3))
+        queued = self.pool.submit(started, ('queued',))
+        time.sleep(0.05)
+        self.assertFalse(busy.cancel())
+        self.assertTrue(queued.cancel())
+        self.assertFalse(queued.cancel())
+        with self.assertRaises(RuntimeError):
+            queued.get(1)
+        self.assertEqual(busy.get(10)[0], 'busy')
+
+    def test_close_cancels_queued(self):
+        self.pool = workers.WorkerPool(1, reserved=0)
+        busy = self.pool.submit(started, ('busy', 0.2))
+        queued = self.pool.submit(started, ('queued',))
+        time.sleep(0.05)
+        self.pool.close()
+        self.assertEqual(busy.get(1)[0], 'busy')
+        with self.assertRaises(RuntimeError):
+            queued.get(1)
+        with self.assertRaises(RuntimeError):
+            self.pool.submit(started, ('late',))
+
+    def test_progress(self):
+        self.pool = workers.WorkerPool(1)
+        reports = []
+        job = self.pool.submit(reporting, (3,),
+                               progress=lambda *v: reports.append(v))
+        self.assertEqual(job.get(10), 3)
+        t0 = time.time()
+        while len(reports) < 3 and time.time() - t0 < 5:
+            time.sleep(0.01)
+        self.assertEqual(reports, [(0, 3), (1, 3), (2, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the z stack acquisition with the simulated stage and camera.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import h5py as hdf
+    import tifffile as tiff
+    from lantz import Q_
+    import tormenta.control.mockers as mockers
+    import tormenta.control.acquisition as acquisition
+except ImportError as e:
+    raise unittest.SkipTest(repr(e))
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class LaggyScanZ(mockers.MockScanZ):
+    """ Stage that starts moving some time after the command and doesn't
+    report its motion, like a controller polled for its position only."""
+    zMoving = None
+
+
+class ZStackTest(unittest.TestCase):
+
+    def setUp(self):
+        # MockCamera loads its image from the working directory
+        self.cwd = os.getcwd()
+        os.chdir(root)
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'zstack.tiff')
+
+        self.camera = mockers.MockCamera()
+        self.camera.acquisition_mode = 'Run till abort'
+        self.camera.set_image((64, 64), (0, 0))
+        self.camera.start_acquisition()
+
+    def tearDown(self):
+        self.camera.abort_acquisition()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def acquire(self, stage, steps=5, step=Q_(50, 'nm')):
+        z0 = acquisition.stagePosition(stage)
+        positions = acquisition.acquireZStack(
+            self.camera, stage, steps, step, self.filename, (64, 64),
+            nFrames=3, umxpx=0.133)
+        targets = z0 + step.to('um').magnitude*np.arange(1, steps + 1)
+        return np.array(positions), targets
+
+    def checkFiles(self, steps, positions):
+        with tiff.TiffFile(self.filename) as tf:
+            stack = tf.asarray()
+        self.assertEqual(stack.shape, (steps, 64, 64))
+        self.assertEqual(stack.dtype, np.float32)
+
+        metaName = os.path.splitext(self.filename)[0] + '_metadata.hdf5'
+        with hdf.File(metaName, 'r') as f:
+            np.testing.assert_allclose(f['z positions [um]'][()],
+                                       positions)
+            self.assertEqual(f['Frames per plane'][()], 3)
+
+    def test_mockScanZ(self):
+        stage = mockers.MockScanZ(settleTime=0.02)
+        positions, targets = self.acquire(stage)
+        np.testing.assert_allclose(positions, targets, atol=1e-9)
+        np.testing.assert_allclose(np.diff(positions), 0.05, atol=1e-9)
+        self.checkFiles(5, positions)
+
+    def test_mockProscan(self):
+        stage = mockers.MockProscan()
+        positions, targets = self.acquire(stage)
+        np.testing.assert_allclose(positions, targets, atol=1e-9)
+        self.checkFiles(5, positions)
+
+    def test_commandLatency(self):
+        # Without the target, the stable reads before the move would pass
+        stage = LaggyScanZ(settleTime=0.02, latency=0.05)
+        positions, targets = self.acquire(stage, steps=3)
+        np.testing.assert_allclose(positions, targets, atol=0.005)
+        self.checkFiles(3, positions)
+
+    def test_waitSettledTimeout(self):
+        stage = mockers.MockScanZ(settleTime=0.02)
+        z0 = acquisition.stagePosition(stage)
+        with self.assertRaises(TimeoutError):
+            acquisition.waitSettled(stage, z0 + 1, timeout=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
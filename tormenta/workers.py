@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool shared by the acquisition and the analysis.
+"""
+
+import os
+import atexit
+import heapq
+import itertools
+import threading
+import multiprocessing as mp
+
+# Job priorities, lower runs first
+ACQUISITION = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+
+
+class Job(object):
+    """ Result of a job submitted to a WorkerPool, with the interface of
+    multiprocessing's AsyncResult."""
+
+    def __init__(self, pool, func, args, priority, init, progress):
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.init = init
+        self.progress = progress
+        self.started = False
+        self.cancelled = False
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def ready(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not(self.event.wait(timeout)):
+            raise mp.TimeoutError
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        """ Drops the job if it didn't start yet. Returns True if it was
+        dropped."""
+        return self.pool.cancel(self)
+
+
+class Initializer(object):
+    """ Per process state for the jobs of a WorkerPool, the equivalent of the
+    initializer of a multiprocessing Pool. func(*args) is run once in each
+    process before the first job that needs it, and again if a job with
+    another Initializer of the same func ran in between."""
+
+    counter = itertools.count()
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.token = (os.getpid(), next(Initializer.counter))
+
+
+# Per process state of the workers
+_current = {'job': None, 'progress': None, 'init': {}}
+
+
+def _initWorker(progressQueue):
+    _current['progress'] = progressQueue
+
+
+def _run(jobId, init, func, args, reports):
+    _current['job'] = jobId if reports else None
+    try:
+        if init is not None:
+            key = (init.func.__module__, init.func.__name__)
+            if _current['init'].get(key) != init.token:
+                init.func(*init.args)
+                _current['init'][key] = init.token
+        return func(*args)
+    finally:
+        # Tells the progress thread that no more reports will come
+        if reports:
+            _current['progress'].put((jobId, None))
+        _current['job'] = None
+
+
+def report(*values):
+    """ Sends values to the progress callback of the job running in this
+    process. Does nothing outside a WorkerPool."""
+    if _current['progress'] is not None and _current['job'] is not None:
+        _current['progress'].put((_current['job'], values))
+
+
+class WorkerPool(object):
+    """ Pool of processes shared by the acquisition and analysis jobs, so they
+    don't start pools of their own and together never use more than
+    processes cores. Jobs wait in a queue by priority and then by order of
+    submission.
+
+    reserved of the processes are kept for ACQUISITION jobs, so a
+    recording can always use them however many analysis jobs are queued.
+    By default it's a quarter of the processes, and at least one if there
+    is more than one process.
+
+    :param processes: number of processes. By default, two cores are left for
+    the GUI process, that reads the camera and writes the data.
+    :param reserved: processes that only ACQUISITION jobs can use
+    """
+
+    def __init__(self, processes=None, reserved=None):
+
+        if processes is None:
+            processes = max(1, mp.cpu_count() - 2)
+        if reserved is None:
+            reserved = max(processes // 4, 1)
+        self.processes = processes
+        self.reserved = max(0, min(reserved, processes - 1))
+
+        self.progressQueue = mp.Queue()
+        self.pool = mp.Pool(processes, initializer=_initWorker,
+                            initargs=(self.progressQueue,))
+        self.lock = threading.Lock()
+        self.queue = []
+        self.running = {}
+        self.listeners = {}
+        self.ids = itertools.count()
+        self.closed = False
+
+        self.progressThread = threading.Thread(target=self.dispatchProgress,
+                                               daemon=True)
+        self.progressThread.start()
+
+    def limit(self, priority):
+        """ Maximum number of running jobs for a given priority."""
+        if priority <= ACQUISITION:
+            return self.processes
+        else:
+            return self.processes - self.reserved
+
+    def submit(self, func, args=(), priority=BACKGROUND, init=None,
+               progress=None):
+        """ Queues func(*args) and returns its Job. init is an Initializer
+        for the process and progress(*values) is called in a thread of this
+        process with the values given to report by func."""
+
+        job = Job(self, func, args, priority, init, progress)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('The worker pool is closed')
+            heapq.heappush(self.queue, (priority, next(self.ids), job))
+            self.dispatch()
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job.started or job.cancelled:
+                return False
+            job.cancelled = True
+            job.error = RuntimeError('Job cancelled')
+            job.event.set()
+            return True
+
+    def dispatch(self):
+        """ Starts the queued jobs that fit within the limits. Called with
+        the lock held."""
+        while len(self.queue) > 0:
+            priority, jobId, job = self.queue[0]
+            if job.cancelled:
+                heapq.heappop(self.queue)
+                continue
+            if len(self.running) >= self.limit(priority):
+                break
+            heapq.heappop(self.queue)
+            job.started = True
+            self.running[jobId] = job
+            reports = job.progress is not None
+            if reports:
+                self.listeners[jobId] = job.progress
+            self.pool.apply_async(
+                _run, (jobId, job.init, job.func, job.args, reports),
+                callback=lambda result, i=jobId: self.finish(i, result),
+                error_callback=lambda e, i=jobId: self.finish(i, error=e))
+
+    def finish(self, jobId, result=None, error=None):
+        with self.lock:
+            job = self.running.pop(jobId)
+            job.result = result
+            job.error = error
+            job.event.set()
+            if not(self.closed):
+                self.dispatch()
+
+    def dispatchProgress(self):
+        """ Calls the progress callbacks with the values of report. Runs in
+        a thread of its own."""
+        while True:
+            try:
+                item = self.progressQueue.get()
+            except (EOFError, OSError):
+                break
+            if item is None:
+                break
+            jobId, values = item
+            if values is None:
+                self.listeners.pop(jobId, None)
+            elif jobId in self.listeners:
+                self.listeners[jobId](*values)
+
+    def load(self):
+        """ Number of running and queued jobs."""
+        with self.lock:
+            return len(self.running), len(self.queue)
+
+    def close(self):
+        """ Cancels the queued jobs, waits for the running ones and stops the
+        processes."""
+        with self.lock:
+            self.closed = True
+            for priority, jobId, job in self.queue:
+                job.cancelled = True
+                job.error = RuntimeError('Job cancelled')
+                job.event.set()
+            self.queue = []
+        self.pool.close()
+        self.pool.join()
+        self.progressQueue.put(None)
+        self.progressThread.join()
+
+
+_shared = {'pool': None}
+_sharedLock = threading.Lock()
+
+
+def shared():
+    """ The WorkerPool of the application, started the first time it's
+    needed. It can be called from any thread."""
+    with _sharedLock:
+        if _shared['pool'] is None:
+            _shared['pool'] = WorkerPool()
+            atexit.register(shutdown)
+        return _shared['pool']
+
+
+def shutdown():
+    with _sharedLock:
+        pool = _shared['pool']
+        _shared['pool'] = None
+    if pool is not None:
+        pool.close()